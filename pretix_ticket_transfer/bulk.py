@@ -0,0 +1,171 @@
+"""
+Transfers started by the organizer for many orders at once.
+
+The uploaded CSV has one transfer per row: the order code, the position numbers
+(``#1``, ``#2`` as shown on the order page, separated by spaces) and the
+recipient's email address. All rows are validated up front with one query for
+the orders and one for the positions, so the organizer sees every problem
+before anything is changed. The transfers then run in chunks, each chunk in one
+transaction with a savepoint per row. A failing row only rolls back itself, and
+the notifications of a chunk are sent once it has been committed. A row whose
+order is locked by someone else fails at once instead of waiting with the locks
+of the chunk, it can be uploaded again.
+"""
+import csv
+import io
+import re
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import DatabaseError, transaction
+from django.utils.translation import gettext as _
+from pretix.base.models import Order, OrderPosition
+from pretix.base.services.locking import LockTimeoutException
+from pretix.base.services.orders import OrderError
+
+from .user_split import transferable_positions, user_split
+
+BULK_CHUNK_SIZE = 25
+BULK_MAX_ROWS = 5000
+
+BULK_COLUMNS = ('order', 'positions', 'email')
+REPORT_COLUMNS = ('line', 'order', 'positions', 'email', 'result', 'new_order', 'error')
+
+RE_POSITION_SEPARATOR = re.compile(r'[\s,;|+]+')
+
+
+class BulkTransferError(Exception):
+    pass
+
+
+def parse_bulk_csv(data):
+    """
+    Parses the uploaded ``data`` (bytes) into rows of order code, position
+    numbers and email. A first row naming the columns is skipped.
+    """
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = data.decode('iso-8859-1')
+    text = text.strip()
+    if not text:
+        raise BulkTransferError(_('The file is empty.'))
+    try:
+        dialect = csv.Sniffer().sniff(text.split('\n')[0], delimiters=';,\t')
+    except csv.Error:
+        dialect = csv.excel
+
+    rows = []
+    for line, record in enumerate(csv.reader(io.StringIO(text), dialect=dialect), start=1):
+        if not any(c.strip() for c in record):
+            continue
+        record = [c.strip() for c in record] + [''] * (len(BULK_COLUMNS) - len(record))
+        if line == 1 and record[0].lower() == 'order':
+            continue
+        rows.append({
+            'line': line,
+            'order': record[0].upper(),
+            'positions': [p.lstrip('#') for p in RE_POSITION_SEPARATOR.split(record[1]) if p],
+            'email': record[2],
+        })
+    if len(rows) > BULK_MAX_ROWS:
+        raise BulkTransferError(_('Please upload at most {num} rows at once.').format(num=BULK_MAX_ROWS))
+    return rows
+
+
+def validate_bulk_rows(event, rows):
+    """
+    Checks all ``rows`` against the current state of ``event`` and sets ``pids``
+    and ``error`` on every row. Rows with an error are not transferred.
+    """
+    orders = {
+        o.code: o for o in Order.objects.filter(event=event, code__in={r['order'] for r in rows})
+    }
+    positionids = {int(p) for r in rows for p in r['positions'] if p.isdigit()}
+    positions = {
+        (p.order_id, p.positionid): p for p in transferable_positions(
+            event, OrderPosition.objects.filter(order__in=orders.values(), positionid__in=positionids)
+        )
+    }
+
+    seen = set()
+    for r in rows:
+        r['pids'] = []
+        r['error'] = None
+        order = orders.get(r['order'])
+        if not order:
+            r['error'] = _('Order not found')
+            continue
+        if order.status != Order.STATUS_PAID:
+            r['error'] = _('Order is not paid')
+            continue
+        try:
+            validate_email(r['email'])
+        except ValidationError:
+            r['error'] = _('Invalid email address')
+            continue
+        if not r['positions']:
+            r['error'] = _('No tickets given')
+            continue
+
+        for positionid in r['positions']:
+            p = positions.get((order.pk, int(positionid))) if positionid.isdigit() else None
+            if not p:
+                r['error'] = _('Ticket #{positionid} can not be transferred').format(positionid=positionid)
+                break
+            if p.pk in seen:
+                r['error'] = _('Ticket #{positionid} is transferred twice').format(positionid=positionid)
+                break
+            r['pids'].append(p.pk)
+        if r['error']:
+            r['pids'] = []
+        else:
+            seen.update(r['pids'])
+    return rows
+
+
+def run_bulk_transfer(event, rows, user=None, progress=None):
+    """
+    Validates ``rows`` again and transfers the valid ones. ``progress`` is called
+    with the percentage done after every chunk. Sets ``result`` and
+    ``new_order`` on every row and returns the rows.
+    """
+    rows = validate_bulk_rows(event, rows)
+    orders = {o.code: o for o in Order.objects.filter(event=event, code__in={r['order'] for r in rows if not r['error']})}
+
+    for start in range(0, len(rows), BULK_CHUNK_SIZE):
+        with transaction.atomic():
+            for r in rows[start:start + BULK_CHUNK_SIZE]:
+                r['new_order'] = None
+                if r['error']:
+                    r['result'] = 'invalid'
+                    continue
+                try:
+                    with transaction.atomic():
+                        transfers = user_split(orders[r['order']], r['pids'], {'email': r['email']}, user=user)
+                        if not transfers:
+                            raise OrderError(_('Not all tickets could be transferred'))
+                except (OrderError, LockTimeoutException, DatabaseError) as e:
+                    r['result'] = 'failed'
+                    r['error'] = str(e)
+                else:
+                    r['result'] = 'done'
+                    r['new_order'] = transfers[0].target_order.code
+        if progress:
+            progress(round(min(start + BULK_CHUNK_SIZE, len(rows)) / len(rows) * 100, 2))
+    return rows
+
+
+def bulk_report_csv(rows):
+    """
+    Returns the per-row result of a bulk transfer as CSV.
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(REPORT_COLUMNS)
+    for r in rows:
+        writer.writerow([
+            r['line'], r['order'], ' '.join(r['positions']), r['email'],
+            r.get('result', ''), r.get('new_order') or '', r['error'] or '',
+        ])
+    return output.getvalue().encode('utf-8')
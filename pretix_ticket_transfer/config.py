@@ -0,0 +1,110 @@
+import json
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Optional
+
+from django.core.cache import cache
+from i18nfield.strings import LazyI18nString
+
+MESSAGE_KEYS = (
+    'pretix_ticket_transfer_title',
+    'pretix_ticket_transfer_message',
+    'pretix_ticket_transfer_step2_message',
+    'pretix_ticket_transfer_step3_message',
+    'pretix_ticket_transfer_done_message',
+    'pretix_ticket_transfer_recipient_message',
+    'pretix_ticket_transfer_recipient_done_message',
+)
+
+CACHE_TIMEOUT = 3600
+
+# event pk -> (version, expiry, TransferConfig), only the latest version is kept per event
+_local = {}
+
+
+@dataclass(frozen=True)
+class TransferConfig:
+    """
+    Read-only snapshot of the transfer settings of one event, compiled once per
+    settings version so that hot paths do not need to touch the settings store.
+    """
+    version: str
+    items_all: Optional[bool]
+    items: frozenset = frozenset()
+    confirm_texts: tuple = ()
+    messages: dict = field(default_factory=dict)
+    surge_mode: bool = False
+    surge_concurrency: int = 4
+
+    def is_item_eligible(self, item_id):
+        if self.items_all is None:
+            return False  # default to false
+        return self.items_all or item_id in self.items
+
+    def message(self, key):
+        return self.messages.get(key) or LazyI18nString('')
+
+
+def _version_key(event):
+    return 'pretix_ticket_transfer_config_version:{}'.format(event.pk)
+
+
+def _config_key(event, version):
+    return 'pretix_ticket_transfer_config:{}:{}'.format(event.pk, version)
+
+
+def get_config_version(event):
+    """
+    Returns the current settings version of ``event``. A version that has been
+    evicted from the cache is replaced by a fresh one, so a stale config can
+    never be mistaken for the current one. Without a shared cache backend this
+    means the config is compiled on every call.
+    """
+    version = cache.get(_version_key(event))
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(_version_key(event), version, timeout=None):
+            version = cache.get(_version_key(event)) or version
+    return version
+
+
+def invalidate_transfer_config(event):
+    cache.set(_version_key(event), uuid.uuid4().hex, timeout=None)
+    _local.pop(event.pk, None)
+
+
+def compile_transfer_config(event, version):
+    settings = event.settings
+    items_all = settings.get('pretix_ticket_transfer_items_all')
+    items = frozenset()
+    if items_all is False:
+        items = frozenset(json.loads(settings.get('pretix_ticket_transfer_items') or '[]'))
+    return TransferConfig(
+        version=version,
+        items_all=items_all,
+        items=items,
+        confirm_texts=tuple(settings.pretix_ticket_transfer_confirm_texts),
+        messages={
+            key: settings.get(key, as_type=LazyI18nString)
+            for key in MESSAGE_KEYS
+        },
+        surge_mode=settings.pretix_ticket_transfer_surge_mode,
+        surge_concurrency=settings.pretix_ticket_transfer_surge_concurrency,
+    )
+
+
+def get_transfer_config(event):
+    version = get_config_version(event)
+
+    local = _local.get(event.pk)
+    if local and local[0] == version and local[1] > time.monotonic():
+        return local[2]
+
+    config = cache.get(_config_key(event, version))
+    if config is None:
+        config = compile_transfer_config(event, version)
+        cache.set(_config_key(event, version), config, timeout=CACHE_TIMEOUT)
+
+    _local[event.pk] = (version, time.monotonic() + CACHE_TIMEOUT, config)
+    return config
@@ -0,0 +1,98 @@
+"""
+Precomputed transfer eligibility of order positions.
+
+Whether a position may be transferred is kept in :py:class:`TicketTransferPosition`,
+so the transfer panel and the first wizard step read it with one indexed query
+instead of looking for check-ins and add-ons every time. The rows are updated by
+receivers when an order is placed or changed and when a check-in is created or
+deleted. ``ticket_transfer_rebuild_flags`` rebuilds them in bulk. The item rules
+(admission, item whitelist) are applied on read with the compiled event
+config. Only pages read the rows, every transfer checks the positions again
+under its lock.
+"""
+from decimal import Decimal
+
+from django.db import models
+from django.db.models import Exists, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from pretix.base.models import Checkin, Order, OrderPosition
+
+from .config import get_transfer_config
+from .models import TicketTransferPosition
+
+FLAG_FIELDS = ('event', 'transferable', 'price_with_addons', 'updated')
+
+
+def update_transfer_flags(positions):
+    """
+    Computes the flags of the ``positions`` queryset and stores them, in two
+    queries however many positions there are. Use ``OrderPosition.all`` to
+    include canceled positions.
+    """
+    addon_total = OrderPosition.objects.filter(
+        addon_to=OuterRef('pk')
+    ).order_by().values('addon_to').annotate(s=Sum('price')).values('s')
+    positions = positions.annotate(
+        has_checkins=Exists(Checkin.all.filter(position=OuterRef('pk'))),
+        addon_total=Coalesce(Subquery(addon_total), Value(Decimal('0.00')), output_field=models.DecimalField()),
+    ).values_list('pk', 'order__event_id', 'canceled', 'addon_to_id', 'has_checkins', 'price', 'addon_total')
+
+    flags = [
+        TicketTransferPosition(
+            position_id=pk, event_id=event_id,
+            transferable=not canceled and addon_to_id is None and not has_checkins,
+            price_with_addons=price + addon_total,
+        )
+        for pk, event_id, canceled, addon_to_id, has_checkins, price, addon_total in positions
+    ]
+    TicketTransferPosition.objects.bulk_create(
+        flags, update_conflicts=True, unique_fields=['position'], update_fields=FLAG_FIELDS,
+    )
+    return len(flags)
+
+
+def update_order_transfer_flags(order):
+    return update_transfer_flags(OrderPosition.all.filter(order=order))
+
+
+def _eligible_items(event, positions):
+    config = get_transfer_config(event)
+    if config.items_all is None:
+        return positions.none()   # default to false
+    positions = positions.filter(item__admission=True)
+    if not config.items_all:
+        positions = positions.filter(item_id__in=config.items)
+    return positions
+
+
+def flagged_transferable_positions(order):
+    """
+    Returns the positions of ``order`` that may be transferred according to
+    their flags, each annotated with ``price_with_addons``, or ``None`` if a
+    position has no flag yet.
+    """
+    positions = _eligible_items(
+        order.event, order.positions.filter(addon_to__isnull=True)
+    ).select_related('item', 'variation', 'ticket_transfer_flag')
+
+    pos = []
+    for p in positions:
+        flag = getattr(p, 'ticket_transfer_flag', None)
+        if flag is None:
+            return None
+        if flag.transferable:
+            p.price_with_addons = flag.price_with_addons
+            pos.append(p)
+    return pos
+
+
+def event_transferable_positions(event):
+    """
+    All positions of paid orders of ``event`` that may be transferred according
+    to their flags.
+    """
+    return _eligible_items(event, OrderPosition.objects.filter(
+        order__event=event,
+        order__status=Order.STATUS_PAID,
+        ticket_transfer_flag__transferable=True,
+    ))
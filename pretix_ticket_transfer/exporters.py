@@ -0,0 +1,118 @@
+import io
+import json
+from collections import OrderedDict
+
+from django import forms
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.translation import gettext_lazy as _, pgettext_lazy
+from pretix.base.exporter import ListExporter
+
+from .models import TicketTransfer
+
+
+class TicketTransferExporter(ListExporter):
+    identifier = 'ticket_transfer_ledger'
+    verbose_name = _('Ticket transfers')
+    category = pgettext_lazy('export_category', 'Order data')
+    description = _('Download a list of all ticket transfers with source and target orders, amounts and refunds.')
+    repeatable_read = False
+
+    chunk_size = 2000
+
+    @property
+    def export_form_fields(self) -> dict:
+        ff = super().export_form_fields
+        ff['_format'].choices = list(ff['_format'].choices) + [('json', _('JSON'))]
+        return ff
+
+    @property
+    def additional_form_fields(self) -> dict:
+        return OrderedDict([
+            ('state', forms.MultipleChoiceField(
+                label=_('Transfer state'),
+                choices=TicketTransfer.STATE_CHOICES,
+                widget=forms.CheckboxSelectMultiple,
+                required=False,
+                help_text=_('Leave empty to export transfers in all states.'),
+            )),
+        ])
+
+    def get_filename(self):
+        return '{}_ticket_transfers'.format(self.event.slug)
+
+    def get_queryset(self, form_data):
+        qs = TicketTransfer.objects.filter(event=self.event).select_related(
+            'source_order', 'target_order', 'refund'
+        ).order_by('pk')
+        if form_data.get('state'):
+            qs = qs.filter(state__in=form_data['state'])
+        return qs
+
+    def iterate_list(self, form_data):
+        qs = self.get_queryset(form_data)
+
+        yield [
+            _('Transfer ID'),
+            _('Flow'),
+            _('State'),
+            _('Source order'),
+            _('Target order'),
+            _('Recipient email'),
+            _('Positions'),
+            _('Amount'),
+            _('Refund state'),
+            _('Refund amount'),
+            _('Created'),
+            _('Last modified'),
+        ]
+        yield self.ProgressSetTotal(total=qs.count())
+
+        for t in qs.iterator(chunk_size=self.chunk_size):
+            yield [
+                t.pk,
+                _('intermediated') if t.is_intermediated else _('direct'),
+                t.get_state_display(),
+                t.source_order.code,
+                t.target_order.code if t.target_order else '',
+                t.target_order.email if t.target_order else '',
+                ', '.join(str(p) for p in t.positions),
+                t.amount,
+                t.refund.get_state_display() if t.refund else '',
+                t.refund.amount if t.refund else None,
+                t.created.astimezone(self.timezone).strftime('%Y-%m-%d %H:%M:%S'),
+                t.modified.astimezone(self.timezone).strftime('%Y-%m-%d %H:%M:%S'),
+            ]
+
+    def _render_json(self, form_data, output_file=None):
+        """
+        Writes one JSON object per transfer while iterating, so the whole ledger
+        is never held in memory when an output file is given.
+        """
+        out = io.TextIOWrapper(output_file, encoding='utf-8') if output_file else io.StringIO()
+        lines = self.iterate_list(form_data)
+        header = [str(h) for h in next(lines)]
+        total = 0
+        counter = 0
+        out.write('{"transfers": [')
+        for line in lines:
+            if isinstance(line, self.ProgressSetTotal):
+                total = line.total
+                continue
+            if counter:
+                out.write(',')
+            out.write(json.dumps(dict(zip(header, line)), cls=DjangoJSONEncoder))
+            counter += 1
+            if total and counter % max(10, total // 100) == 0:
+                self.progress_callback(counter / total * 100)
+        out.write(']}')
+
+        if output_file:
+            out.flush()
+            out.detach()
+            return self.get_filename() + '.json', 'application/json', None
+        return self.get_filename() + '.json', 'application/json', out.getvalue().encode('utf-8')
+
+    def render(self, form_data: dict, output_file=None):
+        if form_data.get('_format') == 'json':
+            return self._render_json(form_data, output_file=output_file)
+        return super().render(form_data, output_file=output_file)
@@ -0,0 +1,196 @@
+"""
+Optional timing of the transfer code paths.
+
+Every call of an instrumented operation produces one record with its wall time,
+its query count and the same numbers per phase. Records are passed to the
+configured sinks. Instrumentation is off unless sinks are configured in
+``pretix.cfg``::
+
+    [pretix_ticket_transfer]
+    instrumentation=log,prometheus
+
+``log`` writes one JSON line per record to the ``pretix_ticket_transfer.instrumentation``
+logger, ``prometheus`` feeds pretix' own metrics in Redis, which are served at ``/metrics``
+if ``[metrics]`` is enabled. Tests can install a :py:class:`MemorySink` with
+:py:func:`set_sinks`.
+"""
+import json
+import logging
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_sinks = None
+
+
+class LogSink:
+    def emit(self, record):
+        logger.info(json.dumps(record))
+
+
+class PrometheusSink:
+    def __init__(self):
+        from pretix.base.metrics import Counter, Histogram
+
+        self.duration = Histogram(
+            'pretix_ticket_transfer_duration_seconds', 'Wall time of ticket transfer operations and their phases',
+            ['operation', 'phase'],
+        )
+        self.queries = Counter(
+            'pretix_ticket_transfer_queries_total', 'Database queries of ticket transfer operations and their phases',
+            ['operation', 'phase'],
+        )
+
+    def emit(self, record):
+        op = record['operation']
+        self.duration.observe(record['duration_ms'] / 1000, operation=op, phase='total')
+        self.queries.inc(record['queries'], operation=op, phase='total')
+        for name, p in record['phases'].items():
+            self.duration.observe(p['duration_ms'] / 1000, operation=op, phase=name)
+            self.queries.inc(p['queries'], operation=op, phase=name)
+
+
+class MemorySink:
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def clear(self):
+        self.records = []
+
+
+SINKS = {
+    'log': LogSink,
+    'prometheus': PrometheusSink,
+}
+
+
+def get_sinks():
+    global _sinks
+    if _sinks is None:
+        names = settings.CONFIG_FILE.get('pretix_ticket_transfer', 'instrumentation', fallback='')
+        _sinks = [SINKS[n.strip()]() for n in names.split(',') if n.strip()]
+    return _sinks
+
+
+def set_sinks(sinks):
+    """
+    Replaces the configured sinks, e.g. with a :py:class:`MemorySink` in tests.
+    Returns the previous sinks so they can be restored.
+    """
+    global _sinks
+    previous = _sinks
+    _sinks = sinks
+    return previous
+
+
+class _Noop:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NOOP = _Noop()
+
+
+class _Trace:
+    def __init__(self, operation, sinks):
+        self.operation = operation
+        self.sinks = sinks
+        self.queries = 0
+        self.phases = {}
+
+    def _count(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        _local.trace = self
+        self._wrapper = connection.execute_wrapper(self._count)
+        self._wrapper.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        duration = time.perf_counter() - self.start
+        self._wrapper.__exit__(exc_type, exc_value, tb)
+        _local.trace = None
+        record = {
+            'operation': self.operation,
+            'duration_ms': round(duration * 1000, 3),
+            'queries': self.queries,
+            'phases': self.phases,
+            'error': exc_type.__name__ if exc_type else None,
+        }
+        for sink in self.sinks:
+            try:
+                sink.emit(record)
+            except Exception:
+                logger.exception('Could not emit instrumentation record')
+        return False
+
+
+class _Phase:
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.queries = self.trace.queries
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        duration = (time.perf_counter() - self.start) * 1000
+        p = self.trace.phases.setdefault(self.name, {'duration_ms': 0, 'queries': 0, 'calls': 0})
+        p['duration_ms'] = round(p['duration_ms'] + duration, 3)
+        p['queries'] += self.trace.queries - self.queries
+        p['calls'] += 1
+        return False
+
+
+def trace(operation):
+    """
+    Context manager that records ``operation``. Nested traces are ignored, their
+    phases count towards the outer one.
+    """
+    sinks = get_sinks()
+    if not sinks or getattr(_local, 'trace', None) is not None:
+        return NOOP
+    return _Trace(operation, sinks)
+
+
+def phase(name):
+    """
+    Context manager that records a phase of the current trace. Phases with the
+    same name are summed up.
+    """
+    t = getattr(_local, 'trace', None)
+    if t is None:
+        return NOOP
+    return _Phase(t, name)
+
+
+def instrumented(operation):
+    """
+    Decorator that records every call of the decorated function as ``operation``.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not get_sinks():
+                return func(*args, **kwargs)
+            with trace(operation):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,98 @@
+"""
+Locking for transfers that change an order.
+
+A transfer locks the source order first and its positions second, always in
+primary key order, so two transfers, a check-in or a payment on the same order
+queue up behind each other instead of deadlocking. Waiting for a lock is
+bounded. If the lock can not be acquired in time, the whole transfer is tried
+again after a jittered, growing pause, and after ``LOCK_ATTEMPTS`` attempts it
+fails with an :py:class:`TransferBusyError` the user can act on. Only the
+outermost transaction is tried again, see ``retry_on_contention``.
+"""
+import functools
+import logging
+import random
+import time
+
+from django.db import OperationalError, connection, transaction
+from django.utils.translation import gettext_lazy as _
+from pretix.base.models import Order, OrderPosition
+from pretix.base.services.locking import LockTimeoutException
+from pretix.base.services.orders import OrderError
+from pretix.helpers import OF_SELF
+
+logger = logging.getLogger(__name__)
+
+LOCK_TIMEOUT_MS = 2000
+LOCK_ATTEMPTS = 3
+LOCK_BACKOFF = 0.2
+
+# lock_not_available, deadlock_detected, serialization_failure
+CONTENTION_PGCODES = ('55P03', '40P01', '40001')
+
+
+class TransferBusyError(OrderError):
+    pass
+
+
+def _is_contention(e):
+    if isinstance(e, LockTimeoutException):
+        return True
+    pgcode = getattr(e.__cause__, 'pgcode', None) or getattr(e.__cause__, 'sqlstate', None)
+    if pgcode:
+        return pgcode in CONTENTION_PGCODES
+    return 'locked' in str(e)
+
+
+def lock_transfer(order, pids):
+    """
+    Locks ``order`` and its positions ``pids`` for the surrounding transaction,
+    in that order, and brings ``order`` up to date with the locked row. Must be
+    called inside a transaction, before anything is read for the transfer.
+    """
+    postgres = connection.vendor == 'postgresql'
+    if postgres:
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL lock_timeout = %s', ['{}ms'.format(LOCK_TIMEOUT_MS)])
+
+    locked = Order.objects.select_for_update(of=OF_SELF).get(pk=order.pk)
+    list(OrderPosition.all.filter(order_id=order.pk, pk__in=pids).select_for_update(of=OF_SELF).order_by('pk').values_list('pk', flat=True))
+
+    if postgres:
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL lock_timeout TO DEFAULT')
+
+    # whatever changed the order before the lock has been committed, the
+    # positions are checked again afterwards, so the transfer goes on from here
+    for f in ('status', 'total', 'meta_info', 'last_modified', 'email', 'locale'):
+        setattr(order, f, getattr(locked, f))
+    order.__dict__.pop('meta_info_data', None)
+    order._prefetched_objects_cache = {}
+    return order
+
+
+def retry_on_contention(func):
+    """
+    Runs ``func`` in its own transaction and runs it again with jittered
+    exponential backoff if it fails on a lock held by someone else. Called
+    inside a transaction, ``func`` only gets a savepoint: it runs once and a
+    lock error goes straight to the caller, which holds locks of its own and
+    has to retry its whole transaction.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if connection.in_atomic_block:
+            # waiting here would keep the caller's locks and could not clear contention they cause
+            return func(*args, **kwargs)
+        for attempt in range(LOCK_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    return func(*args, **kwargs)
+            except (OperationalError, LockTimeoutException) as e:
+                if not _is_contention(e):
+                    raise
+                logger.info('Ticket transfer waited for a lock (attempt %d): %s', attempt + 1, e)
+                if attempt + 1 == LOCK_ATTEMPTS:
+                    raise TransferBusyError(_('This order is being changed at the moment. Please try again in a minute.'))
+                time.sleep(random.uniform(0, LOCK_BACKOFF * 2 ** attempt))
+    return wrapper
@@ -0,0 +1,184 @@
+import json
+import platform
+import statistics
+import time
+
+import pretix
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+from django_scopes import scope, scopes_disabled
+from pretix.base.models import Checkin, Event, Order, OrderPosition
+
+from ... import __version__
+from ...models import (
+    TICKET_TRANSFER_SENT_STATES, TICKET_TRANSFER_START, TicketTransfer,
+)
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Time and count queries of the ticket transfer hot paths and print the results as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--organizer', default='benchmark')
+        parser.add_argument('--event', default='transfer')
+        parser.add_argument('--repeat', type=int, default=10)
+        parser.add_argument('--output', help='Write the results to this file instead of stdout')
+        parser.add_argument('--skip-writes', action='store_true',
+                            help='Skip benchmarks that change data (they are always rolled back)')
+
+    def handle(self, *args, **options):
+        with scopes_disabled():
+            try:
+                event = Event.objects.select_related('organizer').get(
+                    organizer__slug=options['organizer'], slug=options['event']
+                )
+            except Event.DoesNotExist:
+                raise CommandError('Event {}/{} does not exist, create it with ticket_transfer_fixtures.'.format(
+                    options['organizer'], options['event']
+                ))
+
+        self.repeat = options['repeat']
+        self.results = {}
+        with scope(organizer=event.organizer):
+            self._run(event, skip_writes=options['skip_writes'])
+
+        report = {
+            'plugin': __version__,
+            'pretix': pretix.__version__,
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'timestamp': now().isoformat(),
+            'event': '{}/{}'.format(event.organizer.slug, event.slug),
+            'repeat': self.repeat,
+            'results': self.results,
+        }
+        out = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(out)
+        else:
+            self.stdout.write(out)
+
+    def measure(self, name, func, setup=None, rollback=False):
+        """
+        Calls ``func`` ``repeat`` times and records wall time and query count. If
+        ``setup`` is given, its return value is passed to ``func`` and it is not
+        measured. With ``rollback``, every run happens in a transaction that is
+        rolled back afterwards, so the fixture data is not changed.
+        """
+        times = []
+        queries = []
+        for i in range(self.repeat):
+            try:
+                with transaction.atomic():
+                    args = setup(i) if setup else ()
+                    with CaptureQueriesContext(connection) as ctx:
+                        t0 = time.perf_counter()
+                        func(*args)
+                        times.append((time.perf_counter() - t0) * 1000)
+                    queries.append(len(ctx.captured_queries))
+                    if rollback:
+                        raise Rollback()
+            except Rollback:
+                pass
+
+        self.results[name] = {
+            'runs': len(times),
+            'time_ms': {
+                'min': round(min(times), 3),
+                'median': round(statistics.median(times), 3),
+                'mean': round(statistics.mean(times), 3),
+                'max': round(max(times), 3),
+            },
+            'queries': {
+                'min': min(queries),
+                'max': max(queries),
+            },
+        }
+        self.stderr.write('{}: {} ms, {} queries'.format(
+            name, self.results[name]['time_ms']['median'], self.results[name]['queries']['max']
+        ))
+
+    def _run(self, event, skip_writes):
+        from ...signals import TransferSearchForm, orderinfo_source, orderinfo_target
+        from ...user_split import (
+            complete_transfer_after_payment, initiate_transfer_with_payment, user_split, user_split_positions,
+        )
+        from ...views import TicketTransferStats
+
+        request = RequestFactory().get('/')
+        request.event = event
+        request.organizer = event.organizer
+
+        transferred = TicketTransfer.objects.filter(event=event)
+        sources = list(transferred.filter(
+            state__in=TICKET_TRANSFER_SENT_STATES
+        ).values_list('source_order_id', flat=True)[:self.repeat])
+        targets = list(transferred.filter(
+            state=TICKET_TRANSFER_START
+        ).values_list('target_order_id', flat=True)[:self.repeat])
+        plain = list(event.orders.filter(status=Order.STATUS_PAID).exclude(
+            Exists(Checkin.all.filter(position__order=OuterRef('pk')))
+        ).exclude(
+            pk__in=transferred.values('source_order')
+        ).exclude(
+            pk__in=transferred.values('target_order')
+        ).values_list('pk', flat=True)[:self.repeat])
+        if not sources or not targets or not plain:
+            raise CommandError('The event does not contain enough orders and transfers.')
+        if OrderPosition.all.filter(order__event=event, ticket_transfer_flag__isnull=True).exists():
+            # orders without flags are checked live, which is not the path to measure
+            raise CommandError('The event has positions without transfer flags, run ticket_transfer_rebuild_flags first.')
+
+        def pick(pks, i):
+            # fetched again for every run, so no state is carried over between runs
+            return Order.objects.select_related('event').get(pk=pks[i % len(pks)])
+
+        self.measure('user_split_positions', lambda o: user_split_positions(o), setup=lambda i: (pick(plain, i),))
+        self.measure('orderinfo_source', lambda o: orderinfo_source(event, o, request), setup=lambda i: (pick(sources, i),))
+        self.measure('orderinfo_target', lambda o: orderinfo_target(event, o, request), setup=lambda i: (pick(targets, i),))
+
+        def stats():
+            view = TicketTransferStats()
+            view.request = request
+            view.get_counter()
+        self.measure('ticket_transfer_stats', stats)
+
+        def search(data):
+            form = TransferSearchForm(data, event=event, prefix='ticket_transfer')
+            form.is_valid()
+            form.filter_qs(event.orders.all()).count()
+        self.measure('filter_qs_open', search, setup=lambda i: ({'ticket_transfer-ticket_transfer': '1'},))
+        self.measure('filter_qs_sent', search, setup=lambda i: ({'ticket_transfer-ticket_transfer_sent': '23'},))
+
+        if skip_writes:
+            return
+
+        def split_setup(i):
+            order = pick(plain, i)
+            return order, [p.pk for p in user_split_positions(order)[:1]]
+
+        self.measure(
+            'user_split',
+            lambda order, pids: user_split(order, pids, {'email': 'benchmark@example.org'}),
+            setup=split_setup, rollback=True,
+        )
+
+        def complete_setup(i):
+            order, pids = split_setup(i)
+            new_order = initiate_transfer_with_payment(order, pids, {
+                'email': 'benchmark@example.org',
+                'bank_info': {'account_holder': 'Benchmark', 'iban': 'DE02120300000000202051'},
+            })
+            return new_order,
+
+        self.measure('complete_transfer_after_payment', complete_transfer_after_payment,
+                     setup=complete_setup, rollback=True)
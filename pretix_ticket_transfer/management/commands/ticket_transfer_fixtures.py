@@ -0,0 +1,175 @@
+import json
+import random
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.crypto import get_random_string
+from django.utils.http import int_to_base36
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import (
+    Checkin, Event, Item, Order, OrderPayment, OrderPosition, Organizer,
+)
+from pretix.base.models.orders import generate_secret
+
+from ...eligibility import update_transfer_flags
+from ...models import TICKET_TRANSFER_DONE, TICKET_TRANSFER_SENT, TICKET_TRANSFER_START, TicketTransfer
+
+BATCH_SIZE = 1000
+PSEUDONYMIZATION_CHARS = 'ABCDEFGHJKLMNPQRSTUVWXYZ3789'
+
+
+class Command(BaseCommand):
+    help = "Generate a synthetic event with many orders and transfers, e.g. for benchmarks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--organizer', default='benchmark')
+        parser.add_argument('--event', default='transfer')
+        parser.add_argument('--orders', type=int, default=1000)
+        parser.add_argument('--positions', type=int, default=2, help='Admission positions per order')
+        parser.add_argument('--addons', type=float, default=0.5, help='Share of positions with an add-on')
+        parser.add_argument('--checkins', type=float, default=0.1, help='Share of positions already checked in')
+        parser.add_argument('--transfers', type=int, default=100, help='Number of orders with an existing transfer')
+        parser.add_argument('--seed', type=int, default=1)
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        if options['transfers'] > options['orders']:
+            raise CommandError('There cannot be more transfers than orders.')
+        if Event.objects.filter(organizer__slug=options['organizer'], slug=options['event']).exists():
+            raise CommandError('Event {}/{} already exists.'.format(options['organizer'], options['event']))
+
+        rnd = random.Random(options['seed'])
+        with transaction.atomic():
+            event = self._create_event(options)
+            stats = self._create_orders(event, rnd, options)
+        self.stdout.write(json.dumps(stats, indent=2))
+
+    def _create_event(self, options):
+        organizer, __ = Organizer.objects.get_or_create(
+            slug=options['organizer'], defaults={'name': options['organizer']}
+        )
+        event = Event.objects.create(
+            organizer=organizer, slug=options['event'], name=options['event'],
+            date_from=now() + timedelta(days=30), currency='EUR',
+            plugins='pretix_ticket_transfer,pretix.plugins.banktransfer',
+        )
+        event.settings.pretix_ticket_transfer_items_all = True
+        ticket = Item.objects.create(event=event, name='Ticket', default_price=Decimal('50.00'), admission=True)
+        addon = Item.objects.create(event=event, name='Add-on', default_price=Decimal('10.00'), admission=False)
+        quota = event.quotas.create(name='Tickets', size=None)
+        quota.items.add(ticket, addon)
+        event.checkin_lists.create(name='Default', all_products=True)
+        return event
+
+    def _create_orders(self, event, rnd, options):
+        ticket = event.items.get(admission=True)
+        addon = event.items.get(admission=False)
+        clist = event.checkin_lists.get()
+        channel = event.organizer.sales_channels.get(identifier='web')
+        dt = now()
+        # order codes are unique per organizer, the event id keeps those of several
+        # generated events apart, the suffix always has the same length
+        prefix = int_to_base36(event.pk).upper()
+
+        def make_order(code, total, meta=None):
+            return Order(
+                code=code, event=event, organizer=event.organizer, status=Order.STATUS_PAID,
+                email='{}@example.org'.format(code.lower()), datetime=dt, expires=dt + timedelta(days=14),
+                total=total, locale='en', sales_channel=channel,
+                meta_info=json.dumps(meta) if meta else None,
+            )
+
+        def make_position(order, item, price, positionid, addon_to=None):
+            return OrderPosition(
+                order=order, organizer=event.organizer, item=item, price=price, positionid=positionid,
+                addon_to=addon_to, secret=generate_secret(), attendee_name_parts={},
+                pseudonymization_id=get_random_string(length=16, allowed_chars=PSEUDONYMIZATION_CHARS),
+                tax_rate=Decimal('0.00'), tax_value=Decimal('0.00'),
+            )
+
+        counts = {'orders': 0, 'positions': 0, 'addons': 0, 'checkins': 0, 'transfers': 0}
+        for start in range(0, options['orders'], BATCH_SIZE):
+            orders = []
+            targets = []
+            mains = []
+            addons = []
+            transfers = []
+            for i in range(start, min(start + BATCH_SIZE, options['orders'])):
+                order = make_order('{}S{:07d}'.format(prefix, i), Decimal('0.00'))
+                orders.append(order)
+                positionid = 1
+                for __ in range(options['positions']):
+                    p = make_position(order, ticket, ticket.default_price, positionid)
+                    mains.append(p)
+                    order.total += p.price
+                    positionid += 1
+                    if rnd.random() < options['addons']:
+                        addons.append(make_position(order, addon, addon.default_price, positionid, addon_to=p))
+                        order.total += addon.default_price
+                        positionid += 1
+
+                if i < options['transfers']:
+                    state = rnd.choice((TICKET_TRANSFER_START, TICKET_TRANSFER_DONE))
+                    moved = mains[-1]
+                    target = make_order('{}T{:07d}'.format(prefix, i), moved.price, {
+                        'doistep': {}, 'contact_form_data': {}, 'confirm_messages': [],
+                        'ticket_transfer': state,
+                    })
+                    targets.append(target)
+                    order.meta_info = json.dumps({
+                        'ticket_transfer_sent': TICKET_TRANSFER_SENT,
+                        'ticket_transfer_history': [{
+                            'positionid': moved.positionid,
+                            'item': ticket.name.data,
+                            'variation': None,
+                            'price': str(moved.price),
+                            'new_order': target.code,
+                        }],
+                    })
+                    order.total -= moved.price
+                    moved.order = target
+                    moved.positionid = 1
+                    addons_of_moved = [a for a in addons if a.addon_to is moved]
+                    for a in addons_of_moved:
+                        a.order = target
+                        order.total -= a.price
+                        target.total += a.price
+                    transfers.append((moved, TicketTransfer(
+                        event=event, source_order=order, target_order=target, state=state,
+                        amount=target.total,
+                    )))
+
+            Order.objects.bulk_create(orders + targets)
+            OrderPayment.objects.bulk_create([
+                OrderPayment(order=o, local_id=1, amount=o.total, state=OrderPayment.PAYMENT_STATE_CONFIRMED,
+                             provider='manual', payment_date=dt)
+                for o in orders + targets
+            ])
+            OrderPosition.all.bulk_create(mains)
+            OrderPosition.all.bulk_create(addons)
+            for moved, t in transfers:
+                t.positions = [moved.pk]
+            TicketTransfer.objects.bulk_create([t for __, t in transfers])
+            target_ids = {t.pk for t in targets}
+            checkins = [
+                Checkin(position=p, list=clist, datetime=dt, type=Checkin.TYPE_ENTRY)
+                for p in mains if p.order_id not in target_ids and rnd.random() < options['checkins']
+            ]
+            Checkin.objects.bulk_create(checkins)
+            # bulk inserts send no signals, the flags are computed like the receivers would
+            update_transfer_flags(OrderPosition.all.filter(pk__in=[p.pk for p in mains + addons]))
+
+            counts['orders'] += len(orders) + len(targets)
+            counts['positions'] += len(mains)
+            counts['addons'] += len(addons)
+            counts['checkins'] += len(checkins)
+            counts['transfers'] += len(transfers)
+
+        return {
+            'organizer': event.organizer.slug,
+            'event': event.slug,
+            **counts,
+        }
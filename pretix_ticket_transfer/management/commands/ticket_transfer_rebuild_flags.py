@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, OrderPosition
+
+from ...eligibility import update_transfer_flags
+
+BATCH_SIZE = 2000
+
+
+class Command(BaseCommand):
+    help = "Recompute the transfer flags of all order positions, e.g. after installing the plugin"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--organizer', help='Only events of this organizer')
+        parser.add_argument('--event', help='Only this event, requires --organizer')
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        if options['event'] and not options['organizer']:
+            raise CommandError('--event requires --organizer.')
+
+        events = Event.objects.filter(plugins__contains='pretix_ticket_transfer').select_related('organizer')
+        if options['organizer']:
+            events = events.filter(organizer__slug=options['organizer'])
+        if options['event']:
+            events = events.filter(slug=options['event'])
+
+        for event in events:
+            count = self._rebuild(event)
+            self.stdout.write('{}/{}: {} positions'.format(event.organizer.slug, event.slug, count))
+
+    def _rebuild(self, event):
+        # batches by primary key, so every batch is an index range scan and its own transaction
+        count = 0
+        last_pk = 0
+        while True:
+            pks = list(
+                OrderPosition.all.filter(order__event=event, pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:BATCH_SIZE]
+            )
+            if not pks:
+                return count
+            with transaction.atomic():
+                count += update_transfer_flags(OrderPosition.all.filter(pk__in=pks))
+            last_pk = pks[-1]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('pretixbase', '0269_order_api_meta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketTransfer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('positions', models.JSONField(default=list)),
+                ('state', models.PositiveSmallIntegerField(choices=[(1, 'open transfer'), (2, 'finalized transfer'), (3, 'pending payment'), (4, 'completed transfer')])),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ticket_transfers', to='pretixbase.event')),
+                ('source_order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ticket_transfers_out', to='pretixbase.order')),
+                ('target_order', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ticket_transfers_in', to='pretixbase.order')),
+            ],
+            options={
+                'ordering': ('-created',),
+                'indexes': [models.Index(fields=['event', 'state'], name='pretix_tick_event_i_64c71b_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,54 @@
+import json
+
+from django.db import migrations
+
+
+def backfill(apps, schema_editor):
+    Order = apps.get_model('pretixbase', 'Order')
+    OrderPosition = apps.get_model('pretixbase', 'OrderPosition')
+    LogEntry = apps.get_model('pretixbase', 'LogEntry')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    TicketTransfer = apps.get_model('pretix_ticket_transfer', 'TicketTransfer')
+
+    order_ct = ContentType.objects.filter(app_label='pretixbase', model='order').first()
+    qs = Order.objects.filter(meta_info__contains='"ticket_transfer":').only('pk', 'code', 'event_id', 'meta_info')
+    for target in qs.iterator():
+        try:
+            meta = json.loads(target.meta_info)
+        except ValueError:
+            continue
+        state = meta.get('ticket_transfer')
+        if state not in (1, 2, 3, 4):
+            continue
+
+        source_code = meta.get('transfer_from_order')
+        if not source_code and order_ct:
+            le = LogEntry.objects.filter(
+                content_type=order_ct, object_id=target.pk,
+                action_type='pretix_ticket_transfer.changed.split_from',
+            ).first()
+            if le and le.data:
+                source_code = json.loads(le.data).get('original_order')
+        source = Order.objects.filter(event_id=target.event_id, code=source_code).first() if source_code else None
+        if not source:
+            continue
+
+        TicketTransfer.objects.create(
+            event_id=target.event_id,
+            source_order=source,
+            target_order=target,
+            positions=list(OrderPosition.objects.filter(order=target, canceled=False).values_list('pk', flat=True)),
+            state=state,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('pretix_ticket_transfer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
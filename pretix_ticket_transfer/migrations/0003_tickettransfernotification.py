@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_ticket_transfer', '0002_backfill_tickettransfer'),
+        ('pretixbase', '0269_order_api_meta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketTransferNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('kind', models.CharField(max_length=50)),
+                ('invoices', models.JSONField(default=list)),
+                ('state', models.CharField(default='pending', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('sent', models.DateTimeField(blank=True, null=True)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='pretixbase.order')),
+                ('transfer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to='pretix_ticket_transfer.tickettransfer')),
+            ],
+            options={
+                'ordering': ('created',),
+                'indexes': [models.Index(fields=['state', 'created'], name='pretix_tick_state_d9d387_idx')],
+                'constraints': [models.UniqueConstraint(fields=('transfer', 'kind'), name='pretix_ticket_transfer_notification_unique')],
+            },
+        ),
+    ]
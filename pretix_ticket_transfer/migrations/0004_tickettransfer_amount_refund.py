@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_amount(apps, schema_editor):
+    Order = apps.get_model('pretixbase', 'Order')
+    TicketTransfer = apps.get_model('pretix_ticket_transfer', 'TicketTransfer')
+    TicketTransfer.objects.filter(amount__isnull=True, target_order__isnull=False).update(
+        amount=Subquery(Order.objects.filter(pk=OuterRef('target_order_id')).values('total')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_ticket_transfer', '0003_tickettransfernotification'),
+        ('pretixbase', '0269_order_api_meta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tickettransfer',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, max_digits=13, null=True),
+        ),
+        migrations.AddField(
+            model_name='tickettransfer',
+            name='refund',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='pretixbase.orderrefund'),
+        ),
+        migrations.RunPython(backfill_amount, migrations.RunPython.noop),
+    ]
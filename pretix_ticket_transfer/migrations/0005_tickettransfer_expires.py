@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:52
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_expires(apps, schema_editor):
+    Order = apps.get_model('pretixbase', 'Order')
+    TicketTransfer = apps.get_model('pretix_ticket_transfer', 'TicketTransfer')
+    TicketTransfer.objects.filter(state=3, expires__isnull=True, target_order__isnull=False).update(
+        expires=Subquery(Order.objects.filter(pk=OuterRef('target_order_id')).values('expires')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_ticket_transfer', '0004_tickettransfer_amount_refund'),
+        ('pretixbase', '0269_order_api_meta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tickettransfer',
+            name='expires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='tickettransfer',
+            name='state',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'open transfer'), (2, 'finalized transfer'), (3, 'pending payment'), (4, 'completed transfer'), (5, 'expired transfer')]),
+        ),
+        migrations.AddIndex(
+            model_name='tickettransfer',
+            index=models.Index(fields=['state', 'expires'], name='pretix_tick_state_eadc41_idx'),
+        ),
+        migrations.RunPython(backfill_expires, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_ticket_transfer', '0005_tickettransfer_expires'),
+        ('pretixbase', '0269_order_api_meta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tickettransfer',
+            name='completion_attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tickettransfer',
+            name='completion_error',
+            field=models.TextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='tickettransfer',
+            name='completion_queued',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tickettransfer',
+            name='completion_state',
+            field=models.CharField(max_length=20, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='tickettransfer',
+            index=models.Index(fields=['completion_state', 'completion_queued'], name='pretix_tick_complet_bc8ea2_idx'),
+        ),
+    ]
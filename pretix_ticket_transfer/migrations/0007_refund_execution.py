@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils.timezone import now
+
+
+def queue_created_refunds(apps, schema_editor):
+    # refunds that were never executed so far, e.g. because execution failed silently
+    TicketTransfer = apps.get_model('pretix_ticket_transfer', 'TicketTransfer')
+    TicketTransfer.objects.filter(refund__state='created', refund_execution__isnull=True).update(
+        refund_execution='queued', refund_next_attempt=now()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_ticket_transfer', '0006_tickettransfer_completion'),
+        ('pretixbase', '0269_order_api_meta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketTransferRefundAttempt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('started', models.DateTimeField()),
+                ('finished', models.DateTimeField()),
+                ('success', models.BooleanField()),
+                ('error', models.TextField(null=True)),
+            ],
+            options={
+                'ordering': ('started',),
+            },
+        ),
+        migrations.AddField(
+            model_name='tickettransfer',
+            name='refund_attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tickettransfer',
+            name='refund_execution',
+            field=models.CharField(max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='tickettransfer',
+            name='refund_next_attempt',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='tickettransfer',
+            index=models.Index(fields=['refund_execution', 'refund_next_attempt'], name='pretix_tick_refund__efd41e_idx'),
+        ),
+        migrations.AddField(
+            model_name='tickettransferrefundattempt',
+            name='refund',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='pretixbase.orderrefund'),
+        ),
+        migrations.AddField(
+            model_name='tickettransferrefundattempt',
+            name='transfer',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='refund_attempt_history', to='pretix_ticket_transfer.tickettransfer'),
+        ),
+        migrations.RunPython(queue_created_refunds, migrations.RunPython.noop),
+    ]
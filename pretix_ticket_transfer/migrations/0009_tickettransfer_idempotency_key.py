@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_ticket_transfer', '0008_tickettransferpayout'),
+        ('pretixbase', '0269_order_api_meta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tickettransfer',
+            name='idempotency_key',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='tickettransfer',
+            index=models.Index(fields=['source_order', 'idempotency_key'], name='pretix_tick_source__1948a2_idx'),
+        ),
+    ]
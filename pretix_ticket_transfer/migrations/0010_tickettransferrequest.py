@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_ticket_transfer', '0009_tickettransfer_idempotency_key'),
+        ('pretixbase', '0269_order_api_meta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketTransferRequest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('token', models.CharField(max_length=64, unique=True)),
+                ('pids', models.JSONField(default=list)),
+                ('data', models.JSONField(default=dict)),
+                ('state', models.CharField(default='queued', max_length=20)),
+                ('error', models.TextField(null=True)),
+                ('result', models.JSONField(default=list)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ticket_transfer_requests', to='pretixbase.event')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ticket_transfer_requests', to='pretixbase.order')),
+            ],
+            options={
+                'ordering': ('created',),
+                'indexes': [models.Index(fields=['event', 'state', 'created'], name='pretix_tick_event_i_2ca6c7_idx')],
+            },
+        ),
+    ]
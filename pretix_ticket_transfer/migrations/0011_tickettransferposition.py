@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_ticket_transfer', '0010_tickettransferrequest'),
+        ('pretixbase', '0269_order_api_meta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketTransferPosition',
+            fields=[
+                ('position', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='ticket_transfer_flag', serialize=False, to='pretixbase.orderposition')),
+                ('transferable', models.BooleanField()),
+                ('price_with_addons', models.DecimalField(decimal_places=2, max_digits=13)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='pretixbase.event')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['event', 'transferable'], name='pretix_tick_event_i_1332cc_idx')],
+            },
+        ),
+    ]
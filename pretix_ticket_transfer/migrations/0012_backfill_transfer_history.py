@@ -0,0 +1,79 @@
+import json
+from collections import defaultdict
+
+from django.db import migrations
+
+SPLIT_ACTIONS = ('pretix_ticket_transfer.changed.split', 'pretix.event.order.changed.split')
+
+
+def backfill_history(apps, schema_editor):
+    Order = apps.get_model('pretixbase', 'Order')
+    Item = apps.get_model('pretixbase', 'Item')
+    ItemVariation = apps.get_model('pretixbase', 'ItemVariation')
+    LogEntry = apps.get_model('pretixbase', 'LogEntry')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+
+    order_ct = ContentType.objects.filter(app_label='pretixbase', model='order').first()
+    if not order_ct:
+        return
+
+    splits = defaultdict(list)
+    for object_id, data in LogEntry.objects.filter(
+        content_type=order_ct, action_type__in=SPLIT_ACTIONS,
+    ).order_by('pk').values_list('object_id', 'data').iterator():
+        if data:
+            splits[object_id].append(json.loads(data))
+
+    # tickets of an expired transfer that went back to the order are no longer transferred
+    returned = set()
+    for object_id, data in LogEntry.objects.filter(
+        content_type=order_ct, action_type='pretix_ticket_transfer.changed.expired',
+    ).values_list('object_id', 'data').iterator():
+        data = json.loads(data) if data else {}
+        if data.get('returned'):
+            returned.add((object_id, data.get('new_order')))
+
+    items = {}
+    variations = {}
+    for order in Order.objects.filter(pk__in=list(splits)).only('pk', 'meta_info').iterator():
+        try:
+            meta = json.loads(order.meta_info) if order.meta_info else {}
+        except ValueError:
+            continue
+        if 'ticket_transfer_history' in meta:
+            continue
+
+        history = []
+        for data in splits[order.pk]:
+            if (order.pk, data.get('new_order')) in returned or data.get('old_price') is None:
+                continue
+            if data.get('old_item') not in items:
+                items[data.get('old_item')] = Item.objects.filter(pk=data.get('old_item')).values_list('name', flat=True).first()
+            if data.get('old_variation') and data['old_variation'] not in variations:
+                variations[data['old_variation']] = ItemVariation.objects.filter(pk=data['old_variation']).values_list('value', flat=True).first()
+            item = items[data.get('old_item')]
+            if item is None:
+                continue
+            variation = variations.get(data['old_variation']) if data.get('old_variation') else None
+            history.append({
+                'positionid': data.get('positionid'),
+                'item': item.data,
+                'variation': variation.data if variation is not None else None,
+                'price': str(data.get('old_price')),
+                'new_order': data.get('new_order'),
+            })
+        if history:
+            meta['ticket_transfer_history'] = history
+            Order.objects.filter(pk=order.pk).update(meta_info=json.dumps(meta))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('pretix_ticket_transfer', '0011_tickettransferposition'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_history, migrations.RunPython.noop),
+    ]
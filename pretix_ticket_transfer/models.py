@@ -0,0 +1,274 @@
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+from django_scopes import ScopedManager
+
+TICKET_TRANSFER_START = 1
+TICKET_TRANSFER_DONE = 2
+TICKET_TRANSFER_SENT = 23
+TICKET_TRANSFER_PENDING_PAYMENT = 3  # Transfer initiated, waiting for new owner to pay
+TICKET_TRANSFER_COMPLETED = 4  # Transfer completed, old owner refunded
+TICKET_TRANSFER_EXPIRED = 5  # New owner did not pay in time, transfer undone or canceled
+
+# States in which the tickets have left the source order for good
+TICKET_TRANSFER_SENT_STATES = (TICKET_TRANSFER_START, TICKET_TRANSFER_DONE, TICKET_TRANSFER_COMPLETED)
+
+
+class TicketTransferPayout(models.Model):
+    """
+    A SEPA credit transfer batch paying out the bank transfer refunds of many
+    transfers at once. The refunds are in transit while the batch is open and
+    are marked as done together once the file has been executed by the bank.
+    """
+    event = models.ForeignKey(
+        'pretixbase.Event', related_name='ticket_transfer_payouts', on_delete=models.CASCADE
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    debtor_name = models.CharField(max_length=190)
+    debtor_iban = models.CharField(max_length=190)
+    debtor_bic = models.CharField(max_length=190)
+    count = models.PositiveIntegerField(default=0)
+    total = models.DecimalField(max_digits=13, decimal_places=2, default=0)
+    done = models.DateTimeField(null=True, blank=True)
+
+    objects = ScopedManager(organizer='event__organizer')
+
+    class Meta:
+        ordering = ('-created',)
+
+
+class TicketTransfer(models.Model):
+    """
+    One row per transfer of positions from ``source_order`` to ``target_order``.
+
+    This mirrors the ``ticket_transfer*`` keys in ``Order.meta_info`` in a form
+    the database can index, so lookups by event and state do not need to scan
+    the JSON text of every order.
+    """
+    STATE_CHOICES = (
+        (TICKET_TRANSFER_START, _("open transfer")),
+        (TICKET_TRANSFER_DONE, _("finalized transfer")),
+        (TICKET_TRANSFER_PENDING_PAYMENT, _("pending payment")),
+        (TICKET_TRANSFER_COMPLETED, _("completed transfer")),
+        (TICKET_TRANSFER_EXPIRED, _("expired transfer")),
+    )
+
+    # Completion of transfers with payment runs in a background job once the new order is paid
+    COMPLETION_QUEUED = 'queued'
+    COMPLETION_DONE = 'done'
+    COMPLETION_FAILED = 'failed'
+    COMPLETION_CHOICES = (
+        (COMPLETION_QUEUED, _("queued")),
+        (COMPLETION_DONE, _("done")),
+        (COMPLETION_FAILED, _("failed")),
+    )
+
+    # The refund to the old owner is executed by a background queue, see refunds.py
+    REFUND_QUEUED = 'queued'
+    REFUND_EXECUTED = 'executed'
+    REFUND_FAILED = 'failed'
+    REFUND_EXECUTION_CHOICES = (
+        (REFUND_QUEUED, _("queued")),
+        (REFUND_EXECUTED, _("executed")),
+        (REFUND_FAILED, _("failed")),
+    )
+
+    event = models.ForeignKey(
+        'pretixbase.Event', related_name='ticket_transfers', on_delete=models.CASCADE
+    )
+    source_order = models.ForeignKey(
+        'pretixbase.Order', related_name='ticket_transfers_out', on_delete=models.CASCADE
+    )
+    target_order = models.ForeignKey(
+        'pretixbase.Order', related_name='ticket_transfers_in', on_delete=models.CASCADE,
+        null=True, blank=True
+    )
+    positions = models.JSONField(default=list)
+    state = models.PositiveSmallIntegerField(choices=STATE_CHOICES)
+    amount = models.DecimalField(max_digits=13, decimal_places=2, null=True, blank=True)
+    refund = models.ForeignKey(
+        'pretixbase.OrderRefund', related_name='+', on_delete=models.SET_NULL,
+        null=True, blank=True
+    )
+    refund_execution = models.CharField(max_length=20, choices=REFUND_EXECUTION_CHOICES, null=True, blank=True)
+    refund_next_attempt = models.DateTimeField(null=True, blank=True)
+    refund_attempts = models.PositiveIntegerField(default=0)
+    payout = models.ForeignKey(
+        TicketTransferPayout, related_name='transfers', on_delete=models.SET_NULL,
+        null=True, blank=True
+    )
+    expires = models.DateTimeField(null=True, blank=True)
+    completion_state = models.CharField(max_length=20, choices=COMPLETION_CHOICES, null=True, blank=True)
+    completion_queued = models.DateTimeField(null=True, blank=True)
+    completion_attempts = models.PositiveIntegerField(default=0)
+    completion_error = models.TextField(null=True, blank=True)
+    # set by the request that started the transfer, a repeated request with the
+    # same key gets the existing transfers instead of starting new ones
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    objects = ScopedManager(organizer='event__organizer')
+
+    class Meta:
+        ordering = ('-created',)
+        indexes = [
+            models.Index(fields=['event', 'state']),
+            models.Index(fields=['state', 'expires']),
+            models.Index(fields=['completion_state', 'completion_queued']),
+            models.Index(fields=['refund_execution', 'refund_next_attempt']),
+            models.Index(fields=['source_order', 'idempotency_key']),
+        ]
+
+    def __str__(self):
+        return '{} -> {} ({})'.format(self.source_order_id, self.target_order_id, self.state)
+
+    @property
+    def is_intermediated(self):
+        return self.state in (TICKET_TRANSFER_PENDING_PAYMENT, TICKET_TRANSFER_COMPLETED, TICKET_TRANSFER_EXPIRED)
+
+
+class TicketTransferNotification(models.Model):
+    """
+    Outbox entry for an email belonging to a transfer. Entries are written in the
+    same transaction as the transfer and sent by a background task after commit,
+    at most once per transfer and kind.
+    """
+    KIND_SPLIT_SOURCE = 'split_source'
+    KIND_SPLIT_TARGET = 'split_target'
+    KIND_PENDING_PAYMENT = 'pending_payment'
+    KIND_INITIATED = 'initiated'
+    KIND_COMPLETED_OLD_OWNER = 'completed_old_owner'
+    KIND_COMPLETED_NEW_OWNER = 'completed_new_owner'
+    KIND_CHOICES = (
+        (KIND_SPLIT_SOURCE, _("Transfer sent")),
+        (KIND_SPLIT_TARGET, _("Transfer received")),
+        (KIND_PENDING_PAYMENT, _("Payment required")),
+        (KIND_INITIATED, _("Transfer initiated")),
+        (KIND_COMPLETED_OLD_OWNER, _("Transfer completed (old owner)")),
+        (KIND_COMPLETED_NEW_OWNER, _("Transfer completed (new owner)")),
+    )
+
+    STATE_PENDING = 'pending'
+    STATE_SENT = 'sent'
+    STATE_FAILED = 'failed'
+    STATE_CHOICES = (
+        (STATE_PENDING, _("pending")),
+        (STATE_SENT, _("sent")),
+        (STATE_FAILED, _("failed")),
+    )
+
+    transfer = models.ForeignKey(
+        TicketTransfer, related_name='notifications', on_delete=models.CASCADE
+    )
+    order = models.ForeignKey(
+        'pretixbase.Order', related_name='+', on_delete=models.CASCADE
+    )
+    kind = models.CharField(max_length=50, choices=KIND_CHOICES)
+    invoices = models.JSONField(default=list)
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default=STATE_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    objects = ScopedManager(organizer='transfer__event__organizer')
+
+    class Meta:
+        ordering = ('created',)
+        constraints = [
+            models.UniqueConstraint(fields=['transfer', 'kind'], name='pretix_ticket_transfer_notification_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['state', 'created']),
+        ]
+
+
+class TicketTransferRefundAttempt(models.Model):
+    """
+    One attempt to execute the refund of a transfer with the payment provider.
+    """
+    transfer = models.ForeignKey(
+        TicketTransfer, related_name='refund_attempt_history', on_delete=models.CASCADE
+    )
+    refund = models.ForeignKey(
+        'pretixbase.OrderRefund', related_name='+', on_delete=models.CASCADE
+    )
+    started = models.DateTimeField()
+    finished = models.DateTimeField()
+    success = models.BooleanField()
+    error = models.TextField(null=True, blank=True)
+
+    objects = ScopedManager(organizer='transfer__event__organizer')
+
+    class Meta:
+        ordering = ('started',)
+
+
+class TicketTransferRequest(models.Model):
+    """
+    A confirmed transfer waiting for a background worker. Only used with surge
+    mode, see ``surge.py``. ``token`` is the token of the wizard that confirmed
+    it and becomes the idempotency key of the transfer.
+    """
+    STATE_QUEUED = 'queued'
+    STATE_RUNNING = 'running'
+    STATE_DONE = 'done'
+    STATE_FAILED = 'failed'
+    STATE_CHOICES = (
+        (STATE_QUEUED, _("queued")),
+        (STATE_RUNNING, _("running")),
+        (STATE_DONE, _("done")),
+        (STATE_FAILED, _("failed")),
+    )
+
+    event = models.ForeignKey(
+        'pretixbase.Event', related_name='ticket_transfer_requests', on_delete=models.CASCADE
+    )
+    order = models.ForeignKey(
+        'pretixbase.Order', related_name='ticket_transfer_requests', on_delete=models.CASCADE
+    )
+    token = models.CharField(max_length=64, unique=True)
+    pids = models.JSONField(default=list)
+    # recipients, bank details and the confirmed total, emptied once the request has run
+    data = models.JSONField(default=dict)
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default=STATE_QUEUED)
+    error = models.TextField(null=True, blank=True)
+    # codes of the new orders
+    result = models.JSONField(default=list)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    objects = ScopedManager(organizer='event__organizer')
+
+    class Meta:
+        ordering = ('created',)
+        indexes = [
+            models.Index(fields=['event', 'state', 'created']),
+        ]
+
+
+class TicketTransferPosition(models.Model):
+    """
+    Precomputed transfer eligibility of one order position, see
+    ``eligibility.py``. ``transferable`` covers the position itself: it is not
+    canceled, not an add-on and has no check-ins. The item rules depend on the
+    event settings and are applied when reading, so changing the settings does
+    not make the rows stale.
+    """
+    position = models.OneToOneField(
+        'pretixbase.OrderPosition', primary_key=True, related_name='ticket_transfer_flag', on_delete=models.CASCADE
+    )
+    event = models.ForeignKey(
+        'pretixbase.Event', related_name='+', on_delete=models.CASCADE
+    )
+    transferable = models.BooleanField()
+    price_with_addons = models.DecimalField(max_digits=13, decimal_places=2)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = ScopedManager(organizer='event__organizer')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['event', 'transferable']),
+        ]
@@ -0,0 +1,166 @@
+"""
+SEPA payout batches for the bank transfer refunds of transfers with payment.
+
+All open transfer refunds of an event are collected into one
+:py:class:`TicketTransferPayout`. Their refunds move to the *in transit* state,
+so they are neither exported a second time here nor by the bank transfer
+plugin's own refund export. Once the bank has executed the file, the whole
+batch is marked as done in one update.
+"""
+import datetime
+import io
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils.timezone import now
+from django.utils.translation import gettext as _
+from localflavor.generic.validators import BICValidator, IBANValidator
+from pretix.base.i18n import language
+from pretix.base.models import LogEntry, OrderRefund
+from pretix.helpers import OF_SELF
+
+from .models import TicketTransfer, TicketTransferPayout
+
+
+def open_payout_transfers(event):
+    """
+    Transfers of ``event`` whose bank transfer refund has not been paid out yet.
+    """
+    return TicketTransfer.objects.filter(
+        event=event,
+        payout__isnull=True,
+        refund__state=OrderRefund.REFUND_STATE_CREATED,
+        refund__provider='banktransfer',
+        refund__order__testmode=event.testmode,
+    )
+
+
+def _valid_bic(bic):
+    if not bic:
+        return None
+    try:
+        BICValidator()(bic)
+    except ValidationError:
+        return None
+    return bic
+
+
+def _valid_iban(iban):
+    if not iban:
+        return None
+    try:
+        IBANValidator()(iban)
+    except ValidationError:
+        return None
+    return iban
+
+
+def create_payout(event, debtor_name, debtor_iban, debtor_bic, user=None):
+    """
+    Collects all open transfer refunds of ``event`` that carry a valid account
+    into a new payout. Returns the payout, or ``None`` if there was nothing to
+    pay out, and the number of refunds skipped for lack of a valid account.
+    Call ``build_payout_xml`` in the same transaction, so the refunds stay open
+    if the file cannot be created.
+    """
+    with transaction.atomic():
+        transfers = list(
+            open_payout_transfers(event).select_for_update(of=OF_SELF).select_related('refund', 'refund__order')
+        )
+        valid = [t for t in transfers if _valid_iban(t.refund.info_data.get('iban')) and t.refund.info_data.get('payer')]
+        if not valid:
+            return None, len(transfers)
+
+        payout = TicketTransferPayout.objects.create(
+            event=event, debtor_name=debtor_name, debtor_iban=debtor_iban, debtor_bic=debtor_bic,
+            count=len(valid), total=sum((t.refund.amount for t in valid), Decimal('0.00')),
+        )
+        TicketTransfer.objects.filter(pk__in=[t.pk for t in valid]).update(payout=payout)
+        OrderRefund.objects.filter(pk__in=[t.refund_id for t in valid]).update(state=OrderRefund.REFUND_STATE_TRANSIT)
+        LogEntry.bulk_create_and_postprocess([
+            t.refund.order.log_action('pretix_ticket_transfer.refund.payout', {
+                'local_id': t.refund.local_id,
+                'payout': payout.pk,
+            }, user=user, save=False)
+            for t in valid
+        ])
+    return payout, len(transfers) - len(valid)
+
+
+def build_payout_xml(payout):
+    """
+    Returns file name, content type and content of the SEPA credit transfer
+    file of ``payout``. Raises ``ValueError`` if no valid file can be created.
+    """
+    from sepaxml import SepaTransfer
+    from sepaxml.validation import ValidationError as SepaValidationError
+
+    event = payout.event
+    if event.currency != 'EUR':
+        raise ValueError("Cannot create SEPA export for currency other than EUR.")
+
+    sepa = SepaTransfer({
+        'name': payout.debtor_name,
+        'IBAN': payout.debtor_iban,
+        'BIC': payout.debtor_bic,
+        'batch': True,
+        'currency': event.currency,
+    }, clean=True)
+    refunds = OrderRefund.objects.filter(
+        pk__in=payout.transfers.values('refund')
+    ).select_related('order').order_by('pk')
+    for refund in refunds.iterator():
+        info = refund.info_data
+        with language(refund.order.locale or event.settings.locale):
+            description = '{} {} {}'.format(refund.full_id, _('Refund'), refund.comment or '').strip()[:140]
+        payment = {
+            'name': info['payer'],
+            'IBAN': info['iban'],
+            'amount': int(refund.amount * 100),  # in euro-cents
+            'execution_date': datetime.date.today(),
+            'description': description,
+        }
+        bic = _valid_bic(info.get('bic'))
+        if bic:
+            payment['BIC'] = bic
+        sepa.add_payment(payment)
+
+    filename = 'ticket_transfer_refunds-{}_{}-{}.xml'.format(event.slug, payout.created.strftime('%Y-%m-%d'), payout.pk)
+    try:
+        data = sepa.export(validate=True)
+    except SepaValidationError as e:
+        raise ValueError(str(e)) from e
+    return filename, 'application/xml', io.BytesIO(data)
+
+
+def complete_payout(payout, user=None):
+    """
+    Marks all refunds of ``payout`` that are still in transit as done. Returns
+    the number of refunds changed. Transfer refunds are not linked to a payment,
+    so unlike ``OrderRefund.done`` no payment state needs to be updated.
+    """
+    with transaction.atomic():
+        payout = TicketTransferPayout.objects.select_for_update().get(pk=payout.pk)
+        if payout.done:
+            return 0
+        refunds = OrderRefund.objects.filter(
+            pk__in=payout.transfers.values('refund'), state=OrderRefund.REFUND_STATE_TRANSIT,
+        )
+        logs = [
+            r.order.log_action('pretix.event.order.refund.done', {
+                'local_id': r.local_id,
+                'provider': r.provider,
+            }, user=user, save=False)
+            for r in refunds.select_related('order')
+        ]
+        n = refunds.update(state=OrderRefund.REFUND_STATE_DONE, execution_date=now())
+        LogEntry.bulk_create_and_postprocess(logs)
+        payout.done = now()
+        payout.save(update_fields=['done'])
+    return n
+
+
+def open_payout_summary(event):
+    return open_payout_transfers(event).aggregate(count=Count('pk'), total=Sum('refund__amount'))
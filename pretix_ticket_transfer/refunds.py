@@ -0,0 +1,140 @@
+"""
+Queue for the refunds to old owners of transfers with payment.
+
+``complete_transfer_after_payment`` only creates the refund and queues it.
+Workers claim due refunds one at a time by pushing their next attempt into the
+future, execute them with the payment provider outside of any transaction and
+record every attempt. Failed attempts are retried with exponential backoff;
+after ``REFUND_MAX_ATTEMPTS`` the refund is marked as failed and shows up in
+the backend for manual processing.
+"""
+import logging
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils.timezone import now
+from pretix.base.models import OrderRefund
+
+from .models import TicketTransfer, TicketTransferRefundAttempt
+
+logger = logging.getLogger(__name__)
+
+REFUND_MAX_ATTEMPTS = 6
+REFUND_BACKOFF = timedelta(minutes=5)
+REFUND_BACKOFF_MAX = timedelta(hours=12)
+# a claimed refund is picked up again after this time if its worker died
+REFUND_LEASE = timedelta(minutes=15)
+
+
+def queue_refund(transfer):
+    """
+    Queues the refund of ``transfer`` for execution. Call inside the transaction
+    that created the refund.
+    """
+    transfer.refund_execution = TicketTransfer.REFUND_QUEUED
+    transfer.refund_next_attempt = now()
+    transfer.refund_attempts = 0
+    transfer.save(update_fields=['refund_execution', 'refund_next_attempt', 'refund_attempts'])
+
+
+def due_refunds():
+    return TicketTransfer.objects.filter(
+        refund_execution=TicketTransfer.REFUND_QUEUED,
+        refund_next_attempt__lte=now(),
+    )
+
+
+def claim_refund():
+    """
+    Returns the next due transfer refund and leases it to the caller, or ``None``
+    if nothing is due. Concurrent callers never get the same transfer.
+    """
+    with transaction.atomic():
+        transfer = due_refunds().select_for_update(skip_locked=True).select_related(
+            'refund', 'refund__order', 'refund__order__event', 'refund__payment',
+        ).order_by('refund_next_attempt').first()
+        if transfer:
+            transfer.refund_next_attempt = now() + REFUND_LEASE
+            transfer.save(update_fields=['refund_next_attempt'])
+    return transfer
+
+
+def _backoff(attempts):
+    return min(REFUND_BACKOFF * 2 ** (attempts - 1), REFUND_BACKOFF_MAX)
+
+
+def _prepare_bank_transfer(refund):
+    # The bank transfer provider only executes refunds that carry the
+    # account in its own keys, the transfer keeps it in ``bank_info``.
+    info = refund.info_data
+    bank_info = info.get('bank_info') or {}
+    if refund.provider == 'banktransfer' and not info.get('iban') and bank_info.get('iban'):
+        info.update({
+            'payer': bank_info.get('account_holder'),
+            'iban': bank_info.get('iban'),
+            'bic': bank_info.get('bic') or None,
+        })
+        refund.info_data = info
+        refund.save(update_fields=['info'])
+
+
+def execute_refund(transfer):
+    """
+    Executes the refund of a claimed ``transfer`` with its payment provider and
+    records the attempt. Returns True on success.
+    """
+    refund = transfer.refund
+    started = now()
+    error = None
+    if refund is None or refund.state != OrderRefund.REFUND_STATE_CREATED:
+        # canceled, done or processed by hand in the meantime
+        transfer.refund_execution = TicketTransfer.REFUND_EXECUTED
+        transfer.refund_next_attempt = None
+        transfer.save(update_fields=['refund_execution', 'refund_next_attempt'])
+        return True
+
+    try:
+        _prepare_bank_transfer(refund)
+        provider = refund.payment_provider
+        if not provider:
+            raise ValueError('Unknown payment provider {}'.format(refund.provider))
+        provider.execute_refund(refund)
+    except Exception as e:
+        logger.exception('Refund %s for ticket transfer %s could not be executed', refund.pk, transfer.pk)
+        error = str(e) or e.__class__.__name__
+
+    with transaction.atomic():
+        transfer.refund_attempts += 1
+        if error is None:
+            transfer.refund_execution = TicketTransfer.REFUND_EXECUTED
+            transfer.refund_next_attempt = None
+        elif transfer.refund_attempts >= REFUND_MAX_ATTEMPTS:
+            transfer.refund_execution = TicketTransfer.REFUND_FAILED
+            transfer.refund_next_attempt = None
+        else:
+            transfer.refund_next_attempt = now() + _backoff(transfer.refund_attempts)
+        transfer.save(update_fields=['refund_execution', 'refund_next_attempt', 'refund_attempts'])
+        TicketTransferRefundAttempt.objects.create(
+            transfer=transfer, refund=refund, started=started, finished=now(),
+            success=error is None, error=error,
+        )
+        if error is not None and transfer.refund_execution == TicketTransfer.REFUND_FAILED:
+            refund.order.log_action('pretix_ticket_transfer.refund.failed', {
+                'local_id': refund.local_id,
+                'attempts': transfer.refund_attempts,
+                'error': error,
+            })
+    return error is None
+
+
+def retry_refunds(transfers):
+    """
+    Queues failed or waiting refunds of ``transfers`` for an immediate attempt.
+    Returns the number of queued transfers.
+    """
+    return transfers.filter(
+        refund__state=OrderRefund.REFUND_STATE_CREATED,
+        refund_execution__in=(TicketTransfer.REFUND_QUEUED, TicketTransfer.REFUND_FAILED),
+    ).update(
+        refund_execution=TicketTransfer.REFUND_QUEUED, refund_next_attempt=now(), refund_attempts=0,
+    )
@@ -1,45 +1,68 @@
 import json
 from decimal import Decimal
+from django.core.signals import request_finished, request_started
 from django.dispatch import receiver
 from django.template.loader import get_template
 from django.middleware import csrf
 from django.urls import resolve, reverse
 from django import forms
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.signals import post_delete, post_save
 from django.utils.html import escape
 from django.utils.translation import gettext_lazy as _
 from django.utils.safestring import mark_safe
 from i18nfield.strings import LazyI18nString
-from pretix.base.models import Order, ItemVariation
-from pretix.base.signals import logentry_display, allow_ticket_download
+from django_scopes import scopes_disabled
+from pretix.base.models import Checkin, Order, OrderPosition
+from pretix.base.signals import logentry_display, allow_ticket_download, register_data_exporters
 from pretix.base.settings import settings_hierarkey, LazyI18nStringList
 from pretix.base.templatetags.rich_text import rich_text
 from pretix.base.templatetags.money import money_filter
 from pretix.presale.signals import order_info_top, order_info
-from pretix.control.signals import nav_event, nav_event_settings, order_search_forms
+from pretix.control.signals import nav_event, nav_event_settings, order_search_forms, order_info as control_order_info
 
 from .user_split import (
     user_split_positions, TICKET_TRANSFER_START, TICKET_TRANSFER_DONE, 
     TICKET_TRANSFER_SENT, TICKET_TRANSFER_PENDING_PAYMENT, complete_transfer_after_payment
 )
-from .utils import get_confirm_messages
-from pretix.base.signals import order_paid
+from .models import TicketTransfer, TicketTransferPosition, TICKET_TRANSFER_SENT_STATES
+from .eligibility import update_order_transfer_flags, update_transfer_flags
+from .tasks import queue_completion
+from .config import get_transfer_config
+from .state import POLLING_STATES, cached_transfer_state, invalidate_transfer_state
+from .instrumentation import instrumented, phase
+from .utils import clear_request_caches, get_confirm_messages, get_item_name_resolver, get_transfer_meta
+from pretix.base.signals import order_changed, order_paid, order_placed
 
 
 settings_hierarkey.add_default("pretix_ticket_transfer_confirm_texts", '[]', LazyI18nStringList)
 settings_hierarkey.add_default("pretix_ticket_transfer_global_confirm_texts", 'True', bool)
+settings_hierarkey.add_default("pretix_ticket_transfer_expired_action", 'return', str)
+settings_hierarkey.add_default("pretix_ticket_transfer_surge_mode", 'False', bool)
+settings_hierarkey.add_default("pretix_ticket_transfer_surge_concurrency", '4', int)
+
+LOGENTRY_PREFIXES = ('pretix_ticket_transfer.', 'pretix.event.order.email.ticket_transfer_')
+
+request_started.connect(clear_request_caches, dispatch_uid="ticket_transfer_clear_resolvers_started")
+request_finished.connect(clear_request_caches, dispatch_uid="ticket_transfer_clear_resolvers_finished")
 
 
 @receiver(signal=logentry_display, dispatch_uid="ticket_transfer_logentry_display")
 def pretixcontrol_logentry_display(sender, logentry, **kwargs):
   event_type = logentry.action_type
-  data = json.loads(logentry.data)
+  if not event_type.startswith(LOGENTRY_PREFIXES):
+    return None
+
+  data = logentry.parsed_data
 
   event = sender
 
   if event_type == 'pretix_ticket_transfer.changed.split':
-     old_item = str(event.items.get(pk=data['old_item']))
+     names = get_item_name_resolver(event)
+     old_item = names.item(data['old_item'])
      if data['old_variation']:
-         old_item += ' - ' + str(ItemVariation.objects.get(pk=data['old_variation']))
+         old_item += ' - ' + names.variation(data['old_variation'])
      url = reverse('control:event.order', kwargs={
          'event': event.slug,
          'organizer': event.organizer.slug,
@@ -58,7 +81,16 @@ def pretixcontrol_logentry_display(sender, logentry, **kwargs):
   plains = {
     'pretix.event.order.email.ticket_transfer_recipient': _('Ticket transfer recipient email sent'),
     'pretix.event.order.email.ticket_transfer_sender': _('Ticket transfer sender email sent'),
-    'pretix_ticket_transfer.changed.split_from': _('This order has been created by splitting the order {order}').format(order=data.get('original_order'))
+    'pretix_ticket_transfer.changed.split_from': _('This order has been created by splitting the order {order}').format(order=data.get('original_order')),
+    'pretix_ticket_transfer.changed.expired': (
+      _('The transfer to order {order} expired unpaid, the tickets have been returned to this order.')
+      if data.get('returned') else
+      _('The transfer to order {order} expired unpaid, the tickets have been canceled.')
+    ).format(order=data.get('new_order')),
+    'pretix_ticket_transfer.refund.failed': _('The ticket transfer refund {local_id} could not be executed after {attempts} attempts: {error}').format(
+      local_id=data.get('local_id'), attempts=data.get('attempts'), error=data.get('error')),
+    'pretix_ticket_transfer.refund.payout': _('The ticket transfer refund {local_id} has been added to SEPA payout {payout}.').format(
+      local_id=data.get('local_id'), payout=data.get('payout')),
   }
 
   if event_type in plains:
@@ -66,28 +98,39 @@ def pretixcontrol_logentry_display(sender, logentry, **kwargs):
 
 
 @receiver(order_info_top, dispatch_uid="ticket_transfer_order_info_target")
+@instrumented('orderinfo_target')
 def orderinfo_target(sender, order, request, **kwargs):
+  config = get_transfer_config(sender)
   ctx = {
     'order': order,
     'event': sender,
-    'title': str( sender.settings.get('pretix_ticket_transfer_title', as_type=LazyI18nString )),
+    'title': str( config.message('pretix_ticket_transfer_title')),
     'csrf_token': csrf.get_token( request ) }
+  meta = get_transfer_meta( order )
 
-  if order.meta_info_data and order.meta_info_data.get('ticket_transfer'):
-    if order.meta_info_data.get('ticket_transfer') == TICKET_TRANSFER_START:
-      ctx['message'] = str( rich_text( sender.settings.get( 'pretix_ticket_transfer_recipient_message', as_type=LazyI18nString )))
+  if meta.get('ticket_transfer'):
+    if meta.get('ticket_transfer') == TICKET_TRANSFER_START:
+      ctx['message'] = str( rich_text( config.message('pretix_ticket_transfer_recipient_message')))
       ctx['confirm_messages'] = get_confirm_messages(sender)
       template = get_template( 'pretix_ticket_transfer/order_info_accept.html' )
       return template.render( ctx )
 
-    elif order.meta_info_data.get('ticket_transfer') == TICKET_TRANSFER_DONE:
-      ctx['message'] = str(rich_text( sender.settings.get('pretix_ticket_transfer_recipient_done_message', as_type=LazyI18nString )))
+    elif meta.get('ticket_transfer') == TICKET_TRANSFER_DONE:
+      ctx['message'] = str(rich_text( config.message('pretix_ticket_transfer_recipient_done_message')))
       template = get_template( 'pretix_ticket_transfer/order_info_done.html' )
       if ctx['message']:
         return template.render( ctx )
 
-  elif order.meta_info_data and order.meta_info_data.get('ticket_transfer_sent'):
-    ctx['message'] = str(rich_text( sender.settings.get('pretix_ticket_transfer_done_message', as_type=LazyI18nString )))
+    elif meta.get('ticket_transfer') == TICKET_TRANSFER_PENDING_PAYMENT:
+      # the page polls the transfer state and reloads once it changes
+      ctx['etag'], body = cached_transfer_state( order )
+      ctx['state'] = json.loads( body )['state']
+      if ctx['state'] in POLLING_STATES:
+        template = get_template( 'pretix_ticket_transfer/order_info_pending.html' )
+        return template.render( ctx )
+
+  elif meta.get('ticket_transfer_sent'):
+    ctx['message'] = str(rich_text( config.message('pretix_ticket_transfer_done_message')))
     template = get_template( 'pretix_ticket_transfer/order_info_done.html' )
     if ctx['message']:
       return template.render( ctx )
@@ -95,29 +138,30 @@ def orderinfo_target(sender, order, request, **kwargs):
   return False
 
 @receiver(order_info, dispatch_uid="ticket_transfer_order_info_source")
+@instrumented('orderinfo_source')
 def orderinfo_source(sender, order, request, **kwargs):
   if order.status != Order.STATUS_PAID and order.status != Order.STATUS_CANCELED:
     return False
 
-  if order.meta_info_data.get('ticket_transfer') == TICKET_TRANSFER_START:
+  meta = get_transfer_meta( order )
+  if meta.get('ticket_transfer') == TICKET_TRANSFER_START:
     return False
 
   event = order.event
+  config = get_transfer_config(sender)
   pos = []
   log = []
 
-  pos = user_split_positions( order )
+  with phase('positions'):
+    pos = user_split_positions( order )
 
-  logentries = order.all_logentries( )
-  for l in logentries:
-    if l.action_type == 'pretix.event.order.changed.split':
-      data = json.loads( l.data )
-      old_item = str( event.items.get(pk=data['old_item']) )
-      if data['old_variation']:
-        old_item += ' - ' + str( ItemVariation.objects.get(pk=data['old_variation']) )
-        log.append( mark_safe( '{old_item}, {old_price}'.format(
-            old_item=escape(old_item),
-            old_price=money_filter(Decimal(data['old_price']), event.currency) )))
+  for entry in meta.get( 'ticket_transfer_history', [] ):
+    old_item = str( LazyI18nString( entry['item'] ))
+    if entry.get( 'variation' ):
+      old_item += ' - ' + str( LazyI18nString( entry['variation'] ))
+    log.append( mark_safe( '{old_item}, {old_price}'.format(
+        old_item=escape(old_item),
+        old_price=money_filter(Decimal(entry['price']), event.currency) )))
 
   if not len( pos ) and not len( log ):
     return False
@@ -128,17 +172,32 @@ def orderinfo_source(sender, order, request, **kwargs):
       'pos': pos,
       'log': log,
       'event': sender,
-      'title': str( sender.settings.get('pretix_ticket_transfer_title', as_type=LazyI18nString )),
-      'message': str(rich_text( sender.settings.get('pretix_ticket_transfer_message', as_type=LazyI18nString ))),
+      'title': str( config.message('pretix_ticket_transfer_title')),
+      'message': str(rich_text( config.message('pretix_ticket_transfer_message'))),
       'url': False }
 
-  template = get_template( 'pretix_ticket_transfer/order_info.html' )
-  return template.render( ctx )
+  with phase('render'):
+    template = get_template( 'pretix_ticket_transfer/order_info.html' )
+    return template.render( ctx )
+
+@receiver(control_order_info, dispatch_uid="ticket_transfer_control_order_info")
+def control_orderinfo(sender, order, request, **kwargs):
+  """
+  Shows the transfers from and to ``order`` on the backend order page, including
+  the state of the background job that completes transfers with payment.
+  """
+  transfers = list(TicketTransfer.objects.filter(
+    Q(source_order=order) | Q(target_order=order)
+  ).select_related('source_order', 'target_order'))
+  if not transfers:
+    return False
+  template = get_template( 'pretix_ticket_transfer/control/order_info.html' )
+  return template.render( { 'event': sender, 'transfers': transfers } )
 
 @receiver(allow_ticket_download, dispatch_uid="ticket_transfer_allow_ticket_download")
 def ticket_transfer_allow_ticket(sender, **kwargs):
     order = kwargs.get('order')
-    if order.meta_info_data.get('ticket_transfer') == TICKET_TRANSFER_START:
+    if get_transfer_meta(order).get('ticket_transfer') == TICKET_TRANSFER_START:
       return False
     return True
 
@@ -172,7 +231,7 @@ def navbar_info(sender, request, **kwargs):
                 },
             ),
             "active": url.namespace == "plugins:pretix_ticket_transfer"
-            and url.url_name == "stats",
+            and url.url_name in ("stats", "refunds", "payouts", "bulk", "bulk.process", "bulk.result"),
         }
     ]
 
@@ -202,24 +261,22 @@ class TransferSearchForm(forms.Form):
         super().__init__(*args, **kwargs)
 
     def filter_qs(self, queryset):
-        print(self.cleaned_data)
         status = self.cleaned_data.get("ticket_transfer")
         if status:
             if status == str(TICKET_TRANSFER_START):
-                queryset = queryset.filter(
-                  meta_info__contains='"ticket_transfer": 1',
-                )
+                queryset = queryset.filter(Exists(TicketTransfer.objects.filter(
+                  event=self.event, target_order=OuterRef('pk'), state=TICKET_TRANSFER_START,
+                )))
             if status == str(TICKET_TRANSFER_DONE):
-                queryset = queryset.filter(
-                  meta_info__contains='"ticket_transfer": 2',
-                )
+                queryset = queryset.filter(Exists(TicketTransfer.objects.filter(
+                  event=self.event, target_order=OuterRef('pk'), state=TICKET_TRANSFER_DONE,
+                )))
         sent = self.cleaned_data.get("ticket_transfer_sent")
         if sent:
-            print(f'sent {sent}')
             if sent == str(TICKET_TRANSFER_SENT):
-                queryset = queryset.filter(
-                  meta_info__contains='"ticket_transfer_sent": 23',
-                )
+                queryset = queryset.filter(Exists(TicketTransfer.objects.filter(
+                  event=self.event, source_order=OuterRef('pk'), state__in=TICKET_TRANSFER_SENT_STATES,
+                )))
 
         return queryset
 
@@ -237,17 +294,69 @@ class TransferSearchForm(forms.Form):
             result.append(ticket_transfer_string)
         return result
 
+@receiver(register_data_exporters, dispatch_uid="ticket_transfer_export_ledger")
+def register_transfer_exporter(sender, **kwargs):
+    from .exporters import TicketTransferExporter
+    return TicketTransferExporter
+
+
 @receiver(order_search_forms)
 def ticket_transfer_search_forms(request, sender, **kwargs):
     return TransferSearchForm(request.GET, event=sender, prefix="ticket_transfer")
 
 
+@receiver(post_save, sender=Order, dispatch_uid="ticket_transfer_order_saved")
+def invalidate_order_transfer_state(sender, instance, **kwargs):
+    """
+    Drops the cached transfer state of an order taking part in a transfer once
+    the change has been committed, so polls see the new state right away.
+    """
+    # checked on the text, parsing meta_info on every order save costs more than a cache delete
+    if instance.meta_info and 'ticket_transfer' in instance.meta_info:
+        transaction.on_commit(lambda: invalidate_transfer_state(instance))
+
+
 @receiver(order_paid, dispatch_uid="ticket_transfer_order_paid")
 def handle_transfer_payment(sender, order, **kwargs):
     """
     When a new owner pays for transferred tickets, complete the transfer
-    and process refund to old owner.
+    and process refund to old owner. This runs in a background job, so the
+    refund and the emails do not hold up the payment confirmation.
+    """
+    if get_transfer_meta(order).get('ticket_transfer') == TICKET_TRANSFER_PENDING_PAYMENT:
+        if not queue_completion(order):
+            # no transfer record to key the job on, complete right away
+            complete_transfer_after_payment(order)
+
+
+@receiver(order_placed, dispatch_uid="ticket_transfer_flags_order_placed")
+@receiver(order_changed, dispatch_uid="ticket_transfer_flags_order_changed")
+def update_flags_of_order(sender, order, **kwargs):
+    """
+    Keeps the transfer flags of the positions of ``order`` up to date, see
+    ``eligibility``. Order changes cover new, canceled and changed positions.
     """
-    if order.meta_info_data and order.meta_info_data.get('ticket_transfer') == TICKET_TRANSFER_PENDING_PAYMENT:
-        complete_transfer_after_payment(order)
+    update_order_transfer_flags(order)
+
+
+def _plugin_active_for_checkin(checkin):
+    # model signals are sent for every event, the check-in list and its event
+    # are usually loaded already when a check-in is saved
+    return 'pretix_ticket_transfer' in checkin.list.event.get_plugins()
+
+
+@receiver(post_save, sender=Checkin, dispatch_uid="ticket_transfer_flags_checkin_saved")
+def update_flags_of_checkin(sender, instance, created, **kwargs):
+    # a checked in position is never transferable, no need to compute anything
+    if created and instance.position_id and _plugin_active_for_checkin(instance):
+        with scopes_disabled():
+            TicketTransferPosition.objects.filter(
+                position_id=instance.position_id, transferable=True
+            ).update(transferable=False)
+
 
+@receiver(post_delete, sender=Checkin, dispatch_uid="ticket_transfer_flags_checkin_deleted")
+def update_flags_of_deleted_checkin(sender, instance, **kwargs):
+    if instance.position_id and _plugin_active_for_checkin(instance):
+        with scopes_disabled():
+            update_transfer_flags(OrderPosition.all.filter(pk=instance.position_id))
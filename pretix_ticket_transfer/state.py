@@ -0,0 +1,99 @@
+"""
+Transfer state of an order for polling clients.
+
+The order page of a recipient waiting for their transfer polls a small endpoint
+instead of being reloaded. The state is computed from the order once and kept in
+the cache, together with a strong ETag over the response body, under the order
+code and a hash of its secret. A poll that finds the cache filled does not touch
+the database, and one that sends the current ETag gets an empty 304. Saving an
+order that takes part in a transfer drops its cached state after commit. Orders
+that require a customer login are not cached, their state is computed on every
+poll.
+"""
+import hashlib
+import json
+
+from django.core.cache import cache
+from pretix.base.models import Order
+
+from .models import (
+    TICKET_TRANSFER_COMPLETED, TICKET_TRANSFER_DONE, TICKET_TRANSFER_EXPIRED, TICKET_TRANSFER_PENDING_PAYMENT,
+    TICKET_TRANSFER_START,
+)
+from .utils import get_transfer_meta
+
+STATE_CACHE_TIMEOUT = 120
+
+STATE_NAMES = {
+    TICKET_TRANSFER_START: 'open',
+    TICKET_TRANSFER_DONE: 'accepted',
+    TICKET_TRANSFER_PENDING_PAYMENT: 'pending_payment',
+    TICKET_TRANSFER_COMPLETED: 'completed',
+    TICKET_TRANSFER_EXPIRED: 'expired',
+}
+
+# states of a recipient's order that change without the recipient doing anything
+POLLING_STATES = ('pending_payment', 'completing')
+
+
+def state_cache_key(event_id, code, secret):
+    return 'pretix_ticket_transfer_state:{}:{}:{}'.format(
+        event_id, code, hashlib.sha256(secret.lower().encode()).hexdigest()[:32]
+    )
+
+
+def transfer_state(order):
+    """
+    Returns the transfer state of ``order`` as the recipient sees it. A paid
+    order whose transfer has not been completed yet is ``completing``.
+    """
+    meta = get_transfer_meta(order)
+    state = STATE_NAMES.get(meta.get('ticket_transfer'))
+    if state == 'pending_payment' and order.status == Order.STATUS_PAID:
+        state = 'completing'
+    if not state and meta.get('ticket_transfer_sent'):
+        state = 'sent'
+    return {
+        'state': state,
+        'order_status': order.status,
+    }
+
+
+def transfer_state_response(order):
+    """
+    Returns the ETag and the JSON body of the transfer state of ``order``.
+    """
+    body = json.dumps(transfer_state(order), sort_keys=True).encode()
+    return '"{}"'.format(hashlib.sha256(body).hexdigest()[:32]), body
+
+
+def requires_customer_login(order):
+    """
+    Whether ``order`` may only be accessed by its logged in customer, not with
+    its secret alone.
+    """
+    settings = order.event.organizer.settings
+    return bool(
+        order.customer_id and settings.customer_accounts and settings.customer_accounts_require_login_for_order_access
+        and order.customer.is_verified
+    )
+
+
+def cached_transfer_state(order):
+    """
+    Like ``transfer_state_response``, but served from and stored in the cache.
+    The cache is read with the order secret alone, so the state of an order
+    that requires a customer login is never stored.
+    """
+    if requires_customer_login(order):
+        return transfer_state_response(order)
+    key = state_cache_key(order.event_id, order.code, order.secret)
+    cached = cache.get(key)
+    if cached is None:
+        cached = transfer_state_response(order)
+        cache.set(key, cached, timeout=STATE_CACHE_TIMEOUT)
+    return cached
+
+
+def invalidate_transfer_state(order):
+    cache.delete(state_cache_key(order.event_id, order.code, order.secret))
@@ -0,0 +1,38 @@
+/*global $ */
+/*
+ * Order page of a recipient waiting for their transfer. Polls the transfer state
+ * with the ETag it was rendered with and reloads the page once the state has
+ * changed. Unchanged polls are answered with an empty 304.
+ */
+$(function () {
+    "use strict";
+
+    var $state = $("#tt-state");
+    if (!$state.length) {
+        return;
+    }
+    var etag = $state.attr("data-etag");
+    var delay = 5000;
+
+    function poll() {
+        $.ajax({
+            url: $state.attr("data-state-url"),
+            headers: {"If-None-Match": etag},
+            dataType: "json"
+        }).done(function (data, status, xhr) {
+            var current = xhr.getResponseHeader("ETag");
+            if (xhr.status === 200 && current && current !== etag) {
+                window.location.reload();
+                return;
+            }
+            schedule();
+        }).fail(schedule);
+    }
+
+    function schedule() {
+        delay = Math.min(delay * 1.2, 60000);
+        window.setTimeout(poll, delay);
+    }
+
+    window.setTimeout(poll, delay);
+});
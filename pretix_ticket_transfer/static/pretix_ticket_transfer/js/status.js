@@ -0,0 +1,33 @@
+/*global $ */
+/*
+ * Waiting page of a queued ticket transfer. Polls the status endpoint and
+ * reloads the page once the transfer has run, the page then sends the user on.
+ * Without JavaScript the page refreshes itself.
+ */
+$(function () {
+    "use strict";
+
+    var $status = $("#tt-status");
+    if (!$status.length) {
+        return;
+    }
+    var delay = 1000;
+
+    function poll() {
+        $.getJSON($status.attr("data-poll-url")).done(function (data) {
+            if (data.state === "done" || data.state === "failed") {
+                window.location.reload();
+                return;
+            }
+            schedule();
+        }).fail(schedule);
+    }
+
+    function schedule() {
+        // back off slowly, so a long queue does not turn into a flood of polls
+        delay = Math.min(delay * 1.5, 10000);
+        window.setTimeout(poll, delay);
+    }
+
+    window.setTimeout(poll, delay);
+});
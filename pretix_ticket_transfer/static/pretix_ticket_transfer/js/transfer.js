@@ -0,0 +1,147 @@
+/*global $, gettext */
+/*
+ * Client-side ticket transfer wizard. The page contains all steps, this switches
+ * between them and submits every step to a small JSON endpoint instead of
+ * rendering a new page. Without JavaScript the steps are plain form posts.
+ */
+$(function () {
+    "use strict";
+
+    var $wizard = $("#tt-wizard");
+    // only enhance a wizard that starts at the first step, later steps rendered
+    // by the server do not contain the ticket selection
+    if (!$wizard.length || !$wizard.find("form[data-step=step1]").length) {
+        return;
+    }
+    var $error = $("#tt-wizard-error");
+    var busy = false;
+
+    function show(step) {
+        $wizard.find("form[data-step]").addClass("hidden");
+        $wizard.find("form[data-step=" + step + "]").removeClass("hidden");
+        window.scrollTo(0, $wizard.offset().top);
+    }
+
+    function showError(message) {
+        $error.text(message).removeClass("hidden");
+    }
+
+    function positionLabel(p) {
+        var label = p.item;
+        if (p.variation) {
+            label += " " + p.variation;
+        }
+        if (p.attendee_name) {
+            label += " - " + p.attendee_name;
+        }
+        return label;
+    }
+
+    function fill(state) {
+        var $step2 = $wizard.find("form[data-step=step2]");
+        var $step3 = $wizard.find("form[data-step=step3]");
+        $.each(["account_holder", "iban", "bic", "bank_name"], function (i, key) {
+            var value = state.bank_info[key] || "";
+            $step2.find("[name=" + (key === "bank_name" ? key : "bank_" + key) + "]").val(value);
+            $step3.find("[data-field='bank_info." + key + "']").text(value)
+                .closest("p").toggleClass("hidden", !value && (key === "bic" || key === "bank_name"));
+        });
+        $step3.find("[data-field=email]").text(state.email);
+        $step3.find("[data-field=totalprice]").text(state.totalprice);
+        var $positions = $step3.find("[data-field=positions]").empty();
+        $.each(state.positions, function (i, p) {
+            var $label = $("<div role='cell' class='product'>").text(positionLabel(p));
+            if (p.recipient && p.recipient !== state.email) {
+                $label.append($("<br>"), $("<small>").text(gettext("Recipient") + ": " + p.recipient));
+            }
+            $positions.append(
+                $("<div role='rowgroup'>").append(
+                    $("<div role='row' class='row cart-row'>").append(
+                        $label,
+                        $("<div role='cell' class='totalprice price'>").text(p.price)
+                    )
+                )
+            );
+        });
+    }
+
+    function reloadPositions() {
+        $.getJSON($wizard.attr("data-positions-url"), function (data) {
+            var $list = $wizard.find("[data-field=orderpositions]").empty();
+            $.each(data.positions, function (i, p) {
+                var id = "select_pos_" + p.id;
+                $list.append(
+                    $("<div class='checkbox'>").append(
+                        $("<label>").attr("for", id).append(
+                            $("<input type='checkbox' name='pos[]'>").attr("id", id).val(p.id)
+                                .prop("checked", data.selected.indexOf(p.id) >= 0),
+                            document.createTextNode(" #" + p.positionid + " " + positionLabel(p))
+                        ),
+                        $("<input type='email' class='form-control input-sm' autocomplete='off'>")
+                            .attr("name", "recipient_" + p.id)
+                            .attr("placeholder", gettext("Other recipient for this ticket (optional)"))
+                            .attr("aria-label", gettext("Other recipient for this ticket (optional)"))
+                            .val(data.recipients[p.id] || "")
+                    )
+                );
+            });
+        });
+    }
+
+    function submit($form, url, done) {
+        if (busy) {
+            return;
+        }
+        busy = true;
+        $error.addClass("hidden");
+        $form.find("button").prop("disabled", true);
+        $.ajax({
+            url: url,
+            method: "POST",
+            data: $form.serialize(),
+            dataType: "json"
+        }).done(done).fail(function (xhr) {
+            var data = xhr.responseJSON || {};
+            showError(data.error || xhr.statusText);
+            if (data.state) {
+                fill(data.state);
+            }
+            if (data.step) {
+                if (data.step === "step1") {
+                    reloadPositions();
+                }
+                show(data.step);
+            }
+        }).always(function () {
+            busy = false;
+            $form.find("button").prop("disabled", false);
+        });
+    }
+
+    $wizard.on("submit", "form[data-step]", function (e) {
+        var $form = $(this);
+        var submitter = e.originalEvent && e.originalEvent.submitter;
+        var action = submitter ? submitter.name + "=" + submitter.value : "";
+        e.preventDefault();
+
+        if (action === "back=1") {
+            show("step1");
+        } else if (action === "back=2") {
+            show("step2");
+        } else if ($form.attr("data-step") === "step1") {
+            submit($form, $wizard.attr("data-recipient-url"), function (data) {
+                fill(data.state);
+                show(data.step);
+            });
+        } else if ($form.attr("data-step") === "step2") {
+            submit($form, $wizard.attr("data-bank-url"), function (data) {
+                fill(data.state);
+                show(data.step);
+            });
+        } else if ($form.attr("data-step") === "step3") {
+            submit($form, $wizard.attr("data-confirm-url"), function (data) {
+                window.location.href = data.redirect;
+            });
+        }
+    });
+});
@@ -0,0 +1,169 @@
+"""
+Queued transfer confirmation ("surge mode") for busy transfer windows.
+
+With ``pretix_ticket_transfer_surge_mode`` enabled, the last wizard step checks
+the selection, stores a :py:class:`TicketTransferRequest` and returns at once.
+The user waits on a status page that polls a small endpoint. Background workers
+run the queued requests through ``initiate_transfers_with_payment``, at most
+``pretix_ticket_transfer_surge_concurrency`` at a time per event, so a spike of
+confirmations neither ties up the web workers nor piles up on the same rows.
+Claims of an event are serialized with an advisory lock of the plugin, not on
+the event row every order, cart and check-in of the event goes through.
+The wizard token is the idempotency key of the transfer, so a request that is
+run twice, e.g. after its worker died, does not transfer twice.
+"""
+import logging
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.utils.timezone import now
+from django.utils.translation import gettext as _
+from pretix.base.i18n import language
+from pretix.base.services.orders import OrderError
+
+from .config import get_transfer_config
+from .models import TicketTransferRequest
+
+logger = logging.getLogger(__name__)
+
+# a running request is queued again after this time if its worker died
+REQUEST_LEASE = timedelta(minutes=10)
+
+# first key of the two-key advisory locks taken by claim_request, the second is
+# the event id, pretix itself only uses the single-key form
+CLAIM_LOCK_SPACE = 0x7474
+
+
+def queue_transfer_request(order, state):
+    """
+    Queues the transfer confirmed with the wizard ``state`` and starts a worker
+    after commit. A request confirmed before is only queued again if it has
+    failed. Returns the request.
+    """
+    from .tasks import process_transfer_requests
+
+    data = {
+        'email': state['email'],
+        'recipients': state.get('recipients', {}),
+        'bank_info': state['bank_info'],
+        'totalprice': str(state['totalprice']),
+    }
+    with transaction.atomic():
+        request, created = TicketTransferRequest.objects.select_for_update().get_or_create(
+            order=order, token=state['token'],
+            defaults={'event': order.event, 'pids': state['pids'], 'data': data},
+        )
+        if not created:
+            if request.state != TicketTransferRequest.STATE_FAILED:
+                return request
+            request.pids = state['pids']
+            request.data = data
+            request.state = TicketTransferRequest.STATE_QUEUED
+            request.error = None
+            request.started = request.finished = None
+            request.save(update_fields=['pids', 'data', 'state', 'error', 'started', 'finished'])
+
+        # always started, a worker checking the limit here could miss one that is
+        # about to finish, and claim_request keeps extra workers from running
+        process_transfer_requests.apply_async(kwargs={'event': order.event_id})
+    return request
+
+
+def running_requests(event):
+    return TicketTransferRequest.objects.filter(event=event, state=TicketTransferRequest.STATE_RUNNING)
+
+
+def _lock_claims(event):
+    # SQLite runs one writing transaction at a time, a racing claim fails on
+    # its write instead of exceeding the limit
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [CLAIM_LOCK_SPACE, event.pk])
+
+
+def claim_request(event):
+    """
+    Returns the oldest queued request of ``event`` and marks it as running, or
+    ``None`` if nothing is queued or the event has as many requests running as
+    it allows.
+    """
+    with transaction.atomic():
+        # claims of one event wait for each other here, so the count below is exact
+        _lock_claims(event)
+        if running_requests(event).count() >= get_transfer_config(event).surge_concurrency:
+            return None
+        request = TicketTransferRequest.objects.select_for_update(skip_locked=True).select_related(
+            'order', 'order__event'
+        ).filter(
+            event=event, state=TicketTransferRequest.STATE_QUEUED
+        ).order_by('created').first()
+        if request:
+            request.state = TicketTransferRequest.STATE_RUNNING
+            request.started = now()
+            request.save(update_fields=['state', 'started'])
+    return request
+
+
+def _check_request(request):
+    # the positions were checked when the request was queued, but it may have
+    # waited a while since
+    from .user_split import user_split_positions
+
+    pos = user_split_positions(request.order, request.pids)
+    if len(pos) != len(request.pids):
+        raise OrderError(_('Some of the selected tickets can no longer be transferred. Please start over.'))
+    if sum((p.price_with_addons for p in pos), Decimal('0.00')) != Decimal(request.data['totalprice']):
+        raise OrderError(_('The price of the selected tickets has changed. Please check the transfer again.'))
+
+
+def run_request(request):
+    """
+    Runs the transfer of a claimed ``request`` and records the outcome. Errors
+    are stored on the request for the status page.
+    """
+    from .user_split import initiate_transfers_with_payment
+
+    order = request.order
+    with language(order.locale, order.event.settings.region):
+        try:
+            _check_request(request)
+            new_orders = initiate_transfers_with_payment(order, request.pids, {
+                'email': request.data['email'],
+                'recipients': request.data.get('recipients', {}),
+                'bank_info': request.data['bank_info'],
+                'idempotency_key': request.token,
+            })
+            if not new_orders:
+                raise OrderError(_('Failed to initiate transfer. Please try again.'))
+        except OrderError as e:
+            request.state = TicketTransferRequest.STATE_FAILED
+            request.error = str(e)
+        except Exception:
+            logger.exception('Queued ticket transfer of order %s failed', order.code)
+            request.state = TicketTransferRequest.STATE_FAILED
+            request.error = _('Failed to initiate transfer. Please try again.')
+        else:
+            request.state = TicketTransferRequest.STATE_DONE
+            request.result = [o.code for o in new_orders]
+
+    # the bank details now live with the transfer, a failed request is queued
+    # again with the data of the wizard
+    request.data = {}
+    request.finished = now()
+    request.save(update_fields=['state', 'error', 'result', 'data', 'finished'])
+    return request
+
+
+def requeue_stale_requests():
+    """
+    Queues running requests again whose worker has not finished them in time.
+    Returns the ids of the events that have queued requests.
+    """
+    TicketTransferRequest.objects.filter(
+        state=TicketTransferRequest.STATE_RUNNING,
+        started__lt=now() - REQUEST_LEASE,
+    ).update(state=TicketTransferRequest.STATE_QUEUED, started=None)
+    return set(TicketTransferRequest.objects.filter(
+        state=TicketTransferRequest.STATE_QUEUED,
+    ).values_list('event_id', flat=True).distinct())
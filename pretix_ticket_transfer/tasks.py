@@ -0,0 +1,308 @@
+import logging
+import math
+from datetime import timedelta
+
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Q
+from django.dispatch import receiver
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.i18n import language
+from pretix.base.models import CachedFile, Invoice, User
+from pretix.base.services.tasks import ProfiledEventTask, TransactionAwareProfiledEventTask, TransactionAwareTask
+from pretix.base.signals import periodic_task
+from pretix.celery_app import app
+from pretix.helpers import OF_SELF
+from pretix.helpers.periodic import minimum_interval
+
+from .instrumentation import phase, trace
+from .models import (
+    TICKET_TRANSFER_COMPLETED, TICKET_TRANSFER_PENDING_PAYMENT, TicketTransfer, TicketTransferNotification,
+)
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATION_MAX_ATTEMPTS = 5
+COMPLETION_MAX_ATTEMPTS = 5
+EXPIRE_BATCH_SIZE = 100
+# refunds executed by one worker per run, and the number of workers started at most
+REFUND_BATCH_SIZE = 50
+REFUND_CONCURRENCY = 4
+
+
+class TransferCompletionError(Exception):
+    pass
+
+
+@app.task(base=TransactionAwareProfiledEventTask, bind=True, max_retries=NOTIFICATION_MAX_ATTEMPTS - 1,
+          default_retry_delay=60)
+def send_transfer_notification(self, event, notification: int):
+    """
+    Sends one outbox entry. The row is locked while sending, so concurrent
+    workers picking up the same entry skip it instead of sending twice.
+    """
+    from .user_split import NOTIFIERS
+
+    with trace('send_transfer_notification'), transaction.atomic():
+        n = TicketTransferNotification.objects.select_for_update(skip_locked=True).select_related(
+            'order', 'order__event'
+        ).filter(
+            pk=notification, state=TicketTransferNotification.STATE_PENDING
+        ).first()
+        if not n:
+            return
+
+        n.attempts += 1
+        try:
+            with phase('email'):
+                NOTIFIERS[n.kind](n.order, None, None, list(Invoice.objects.filter(pk__in=n.invoices)))
+        except Exception as e:
+            logger.exception('Ticket transfer notification could not be sent')
+            n.last_error = str(e)
+            if n.attempts >= NOTIFICATION_MAX_ATTEMPTS:
+                n.state = TicketTransferNotification.STATE_FAILED
+            n.save(update_fields=['attempts', 'last_error', 'state'])
+            if n.state == TicketTransferNotification.STATE_FAILED:
+                return
+        else:
+            n.state = TicketTransferNotification.STATE_SENT
+            n.sent = now()
+            n.save(update_fields=['attempts', 'state', 'sent'])
+            return
+
+    self.retry(kwargs={'event': event.pk, 'notification': notification}, countdown=60 * 2 ** (n.attempts - 1))
+
+
+def queue_notification(transfer, order, kind, invoices=()):
+    """
+    Writes an outbox entry for ``order`` and schedules sending it once the
+    surrounding transaction has been committed. Queuing the same kind twice for
+    one transfer has no effect.
+    """
+    n, created = TicketTransferNotification.objects.get_or_create(
+        transfer=transfer, kind=kind,
+        defaults={'order': order, 'invoices': [i.pk for i in invoices]}
+    )
+    if created:
+        send_transfer_notification.apply_async(kwargs={'event': transfer.event_id, 'notification': n.pk})
+    return n
+
+
+@app.task(base=TransactionAwareProfiledEventTask, bind=True, max_retries=COMPLETION_MAX_ATTEMPTS - 1,
+          default_retry_delay=60)
+def complete_transfer(self, event, order: int):
+    """
+    Completes the transfer with payment whose new order ``order`` has been paid.
+    The transfer row is locked while completing, so a second job for the same
+    order skips it, and a transfer that is no longer queued is left alone.
+    """
+    from .user_split import complete_transfer_after_payment
+
+    with transaction.atomic():
+        transfer = TicketTransfer.objects.select_for_update(of=OF_SELF, skip_locked=True).select_related(
+            'target_order', 'target_order__event'
+        ).filter(
+            target_order_id=order, completion_state=TicketTransfer.COMPLETION_QUEUED
+        ).first()
+        if not transfer:
+            return
+
+        transfer.completion_attempts += 1
+        try:
+            with transaction.atomic():
+                completed = complete_transfer_after_payment(transfer.target_order)
+            # False also means the transfer has been completed before, e.g. directly on payment
+            if not completed and not TicketTransfer.objects.filter(pk=transfer.pk, state=TICKET_TRANSFER_COMPLETED).exists():
+                raise TransferCompletionError(
+                    'Transfer to order {} is not pending payment or its source order has no matching pending '
+                    'transfer'.format(transfer.target_order.code)
+                )
+        except Exception as e:
+            logger.exception('Ticket transfer to order %s could not be completed', transfer.target_order.code)
+            transfer.completion_error = str(e)
+            if transfer.completion_attempts >= COMPLETION_MAX_ATTEMPTS:
+                transfer.completion_state = TicketTransfer.COMPLETION_FAILED
+            transfer.save(update_fields=['completion_attempts', 'completion_error', 'completion_state'])
+            if transfer.completion_state == TicketTransfer.COMPLETION_FAILED:
+                return
+        else:
+            # complete_transfer_after_payment saves the transfer state itself, only touch the job fields
+            transfer.completion_state = TicketTransfer.COMPLETION_DONE
+            transfer.completion_error = None
+            transfer.save(update_fields=['completion_attempts', 'completion_error', 'completion_state'])
+            return
+
+    self.retry(kwargs={'event': event.pk, 'order': order}, countdown=60 * 2 ** (transfer.completion_attempts - 1))
+
+
+def queue_completion(order):
+    """
+    Schedules the completion of the transfer with payment to ``order`` after the
+    surrounding transaction has been committed. Queuing a transfer that is
+    already queued or completed has no effect. Returns False if there is no
+    transfer record for ``order``.
+    """
+    transfers = TicketTransfer.objects.filter(target_order=order, state=TICKET_TRANSFER_PENDING_PAYMENT)
+    if not transfers.exists():
+        return False
+    queued = transfers.filter(
+        Q(completion_state__isnull=True) | Q(completion_state=TicketTransfer.COMPLETION_FAILED)
+    ).update(
+        completion_state=TicketTransfer.COMPLETION_QUEUED, completion_queued=now(),
+        completion_attempts=0, completion_error=None,
+    )
+    if queued:
+        complete_transfer.apply_async(kwargs={'event': order.event_id, 'order': order.pk})
+    return True
+
+
+@receiver(signal=periodic_task, dispatch_uid="ticket_transfer_requeue_completions")
+@scopes_disabled()
+def requeue_transfer_completions(sender, **kwargs):
+    """
+    Picks up completions whose job got lost, e.g. because the worker or the
+    broker went away between commit and dispatch.
+    """
+    qs = TicketTransfer.objects.filter(
+        completion_state=TicketTransfer.COMPLETION_QUEUED,
+        completion_queued__lt=now() - timedelta(minutes=30),
+    ).values_list('target_order_id', 'event_id')
+    for order, event_id in qs[:1000]:
+        complete_transfer.apply_async(kwargs={'event': event_id, 'order': order})
+
+
+@app.task(base=TransactionAwareTask)
+def execute_transfer_refunds(limit=REFUND_BATCH_SIZE):
+    """
+    Executes up to ``limit`` due transfer refunds, see :py:mod:`.refunds`.
+    """
+    from .refunds import claim_refund, execute_refund
+
+    with scopes_disabled():
+        for i in range(limit):
+            transfer = claim_refund()
+            if not transfer:
+                break
+            with trace('execute_transfer_refund'):
+                execute_refund(transfer)
+
+
+@receiver(signal=periodic_task, dispatch_uid="ticket_transfer_execute_refunds")
+@scopes_disabled()
+def dispatch_transfer_refunds(sender, **kwargs):
+    """
+    Starts as many refund workers as the due refunds need, but not more than
+    ``REFUND_CONCURRENCY``, so payment providers do not see a burst of requests.
+    """
+    from .refunds import due_refunds
+
+    due = due_refunds().count()
+    for i in range(min(REFUND_CONCURRENCY, math.ceil(due / REFUND_BATCH_SIZE))):
+        execute_transfer_refunds.apply_async()
+
+
+@app.task(base=TransactionAwareProfiledEventTask)
+def process_transfer_requests(event):
+    """
+    Runs queued transfer confirmations of ``event`` until none are left, see
+    :py:mod:`.surge`. A worker started while the event has enough running ones
+    finds nothing to claim and ends right away.
+    """
+    from .surge import claim_request, run_request
+
+    while True:
+        request = claim_request(event)
+        if not request:
+            break
+        with trace('process_transfer_request'):
+            run_request(request)
+
+
+@receiver(signal=periodic_task, dispatch_uid="ticket_transfer_requeue_requests")
+@scopes_disabled()
+def requeue_transfer_requests(sender, **kwargs):
+    """
+    Picks up queued transfer confirmations whose worker got lost or died.
+    """
+    from .surge import requeue_stale_requests
+
+    for event_id in requeue_stale_requests():
+        process_transfer_requests.apply_async(kwargs={'event': event_id})
+
+
+@app.task(base=ProfiledEventTask, bind=True)
+def bulk_transfer(self, event, fileid: str, user: int, locale: str):
+    """
+    Runs the transfers of an uploaded bulk transfer file, see :py:mod:`.bulk`,
+    and stores the per-row result as a CSV file. Returns its id and counts.
+    """
+    from .bulk import bulk_report_csv, parse_bulk_csv, run_bulk_transfer
+
+    def progress(value):
+        if not self.request.called_directly:
+            self.update_state(state='PROGRESS', meta={'value': value})
+
+    upload = CachedFile.objects.get(id=fileid)
+    with language(locale, event.settings.region):
+        rows = parse_bulk_csv(upload.file.read())
+        rows = run_bulk_transfer(event, rows, user=User.objects.get(pk=user), progress=progress)
+
+        report = CachedFile.objects.create(
+            expires=now() + timedelta(days=1), date=now(), session_key=upload.session_key,
+            filename='ticket_transfer_bulk-{}.csv'.format(event.slug), type='text/csv',
+        )
+        report.file.save('ticket_transfer_bulk.csv', ContentFile(bulk_report_csv(rows)))
+    return {
+        'report': str(report.id),
+        'done': sum(1 for r in rows if r['result'] == 'done'),
+        'failed': sum(1 for r in rows if r['result'] != 'done'),
+    }
+
+
+@receiver(signal=periodic_task, dispatch_uid="ticket_transfer_resend_notifications")
+@scopes_disabled()
+def resend_pending_notifications(sender, **kwargs):
+    """
+    Picks up outbox entries whose task got lost, e.g. because the worker or the
+    broker went away between commit and dispatch.
+    """
+    qs = TicketTransferNotification.objects.filter(
+        state=TicketTransferNotification.STATE_PENDING,
+        created__lt=now() - timedelta(minutes=30),
+    ).values_list('pk', 'transfer__event_id')
+    for pk, event_id in qs[:1000]:
+        send_transfer_notification.apply_async(kwargs={'event': event_id, 'notification': pk})
+
+
+@receiver(signal=periodic_task, dispatch_uid="ticket_transfer_expire_pending")
+@scopes_disabled()
+@minimum_interval(minutes_after_success=5)
+def expire_pending_transfers(sender, **kwargs):
+    """
+    Resolves transfers with payment whose new order has passed its payment
+    deadline. Transfers are processed in batches of ``EXPIRE_BATCH_SIZE``, one
+    transaction per batch. Rows locked by a concurrent run or payment are skipped
+    and picked up next time.
+    """
+    from .user_split import expire_pending_transfer
+
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                TicketTransfer.objects.select_for_update(of=OF_SELF, skip_locked=True).filter(
+                    state=TICKET_TRANSFER_PENDING_PAYMENT,
+                    expires__lt=now(),
+                    pk__gt=last_pk,
+                ).select_related('event', 'event__organizer').order_by('pk')[:EXPIRE_BATCH_SIZE]
+            )
+            for transfer in batch:
+                try:
+                    with transaction.atomic():
+                        expire_pending_transfer(transfer)
+                except Exception:
+                    logger.exception('Expired ticket transfer %s could not be resolved', transfer.pk)
+        if len(batch) < EXPIRE_BATCH_SIZE:
+            break
+        last_pk = batch[-1].pk
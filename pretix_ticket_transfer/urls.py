@@ -5,7 +5,21 @@ from .views import (
     TicketTransferSettingsView,
     TicketTransfer,
     TicketTransferAccept,
-    TicketTransferStats
+    TicketTransferOrderState,
+    TicketTransferBulk,
+    TicketTransferBulkProcess,
+    TicketTransferBulkResult,
+    TicketTransferPayoutDone,
+    TicketTransferPayoutDownload,
+    TicketTransferPayouts,
+    TicketTransferRefunds,
+    TicketTransferStats,
+    TicketTransferStatus,
+    TicketTransferStatusApi,
+    TicketTransferWizardBank,
+    TicketTransferWizardConfirm,
+    TicketTransferWizardPositions,
+    TicketTransferWizardRecipient,
 )
 
 event_patterns = [
@@ -14,6 +28,41 @@ event_patterns = [
         TicketTransfer.as_view(),
         name="generate",
     ),
+    event_url(
+        r"^order/(?P<order>[^/]+)/(?P<secret>[A-Za-z0-9]+)/ticket_transfer/positions$",
+        TicketTransferWizardPositions.as_view(),
+        name="wizard.positions",
+    ),
+    event_url(
+        r"^order/(?P<order>[^/]+)/(?P<secret>[A-Za-z0-9]+)/ticket_transfer/recipient$",
+        TicketTransferWizardRecipient.as_view(),
+        name="wizard.recipient",
+    ),
+    event_url(
+        r"^order/(?P<order>[^/]+)/(?P<secret>[A-Za-z0-9]+)/ticket_transfer/bank$",
+        TicketTransferWizardBank.as_view(),
+        name="wizard.bank",
+    ),
+    event_url(
+        r"^order/(?P<order>[^/]+)/(?P<secret>[A-Za-z0-9]+)/ticket_transfer/confirm$",
+        TicketTransferWizardConfirm.as_view(),
+        name="wizard.confirm",
+    ),
+    event_url(
+        r"^order/(?P<order>[^/]+)/(?P<secret>[A-Za-z0-9]+)/ticket_transfer/status/(?P<token>[A-Za-z0-9]+)$",
+        TicketTransferStatus.as_view(),
+        name="status",
+    ),
+    event_url(
+        r"^order/(?P<order>[^/]+)/(?P<secret>[A-Za-z0-9]+)/ticket_transfer/status/(?P<token>[A-Za-z0-9]+)/poll$",
+        TicketTransferStatusApi.as_view(),
+        name="status.poll",
+    ),
+    event_url(
+        r"^order/(?P<order>[^/]+)/(?P<secret>[A-Za-z0-9]+)/ticket_transfer/state$",
+        TicketTransferOrderState.as_view(),
+        name="state",
+    ),
     event_url(
         r"^order/(?P<order>[^/]+)/(?P<secret>[A-Za-z0-9]+)/ticket_transfer_accept$",
         TicketTransferAccept.as_view(),
@@ -26,4 +75,18 @@ urlpatterns = [
         TicketTransferSettingsView.as_view(), name='settings'),
     re_path(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/ticket_transfer/stats$',
         TicketTransferStats.as_view(), name='stats'),
+    re_path(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/ticket_transfer/refunds$',
+        TicketTransferRefunds.as_view(), name='refunds'),
+    re_path(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/ticket_transfer/payouts$',
+        TicketTransferPayouts.as_view(), name='payouts'),
+    re_path(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/ticket_transfer/payouts/(?P<payout>\d+)/download$',
+        TicketTransferPayoutDownload.as_view(), name='payouts.download'),
+    re_path(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/ticket_transfer/payouts/(?P<payout>\d+)/done$',
+        TicketTransferPayoutDone.as_view(), name='payouts.done'),
+    re_path(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/ticket_transfer/bulk$',
+        TicketTransferBulk.as_view(), name='bulk'),
+    re_path(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/ticket_transfer/bulk/(?P<file>[^/]+)$',
+        TicketTransferBulkProcess.as_view(), name='bulk.process'),
+    re_path(r'^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/ticket_transfer/bulk/(?P<file>[^/]+)/result$',
+        TicketTransferBulkResult.as_view(), name='bulk.result'),
 ]
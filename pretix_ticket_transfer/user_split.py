@@ -1,13 +1,21 @@
 import json
 import logging
+from collections import Counter
 from decimal import Decimal
-from django.db import transaction
+from django.db import models, transaction
+from django.db.models import prefetch_related_objects
+from django.db.models import Exists, Max, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.utils.timezone import now
 
 from pretix.base.signals import order_split, order_changed
 from pretix.base.secrets import assign_ticket_secret
+from pretix.base.models import Checkin, LogEntry, QuestionAnswer
 from pretix.base.models.orders import Order, OrderPosition, OrderFee, OrderRefund, OrderPayment, generate_secret
-from pretix.base.services.orders import OrderChangeManager, OrderError, error_messages
+from pretix.base.services.locking import lock_objects
+from pretix.base.services.orders import OrderChangeManager, OrderError, _cancel_order, error_messages
+from pretix.base.services import tickets
+from pretix.base.services.quotas import QuotaAvailability
 from pretix.base.models.tax import TaxRule
 from pretix.base.i18n import language
 from pretix.base.email import get_email_context
@@ -18,21 +26,54 @@ from pretix.base.services.mail import SendMailException
 from pretix.helpers import OF_SELF
 from pretix.helpers.models import modelcopy
 
+from .models import (
+    TicketTransfer, TicketTransferNotification, TICKET_TRANSFER_START, TICKET_TRANSFER_DONE, TICKET_TRANSFER_SENT,
+    TICKET_TRANSFER_PENDING_PAYMENT, TICKET_TRANSFER_COMPLETED, TICKET_TRANSFER_EXPIRED
+)
+from .config import get_transfer_config
+from .eligibility import flagged_transferable_positions
+from .instrumentation import instrumented, phase
+from .locks import lock_transfer, retry_on_contention
+from .refunds import queue_refund
+from .tasks import queue_notification
 from .utils import transfer_needs_accept
 
 logger = logging.getLogger(__name__)
 
-TICKET_TRANSFER_START = 1
-TICKET_TRANSFER_DONE = 2
-TICKET_TRANSFER_SENT = 23
-TICKET_TRANSFER_PENDING_PAYMENT = 3  # Transfer initiated, waiting for new owner to pay
-TICKET_TRANSFER_COMPLETED = 4  # Transfer completed, old owner refunded
+def assign_ticket_secrets(event, positions):
+    """
+    Calls ``assign_ticket_secret(event, position, force_invalidate=True, save=False)``
+    for every position, the caller saves the secrets in bulk. The issued gift
+    cards that ``assign_ticket_secret`` checks are prefetched in one query, so
+    only generators with a revocation list still write a row per position.
+    """
+    prefetch_related_objects(positions, 'issued_gift_cards')
+    for p in positions:
+        assign_ticket_secret(event, position=p, force_invalidate=True, save=False)
+
 
 class TicketTransferChangeManager(OrderChangeManager):
     """
     dont complete_cancel check
     no notify
+    one new order per recipient
     """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._split_recipients = {}
+        # new orders by recipient, all created in the same commit
+        self.split_orders = {}
+
+    def split(self, position, recipient=None):
+        """
+        Splits ``position`` and its add-ons off. Positions split for different
+        recipients end up in different new orders.
+        """
+        n = len(self._operations)
+        super().split(position)
+        for op in self._operations[n:]:
+            self._split_recipients[op.position.pk] = recipient
+
     def commit(self, check_quotas=True):
         if self._committed:
             # an order change can only be committed once
@@ -76,8 +117,8 @@ class TicketTransferChangeManager(OrderChangeManager):
             self._clear_tickets_cache()
             self.order.touch()
             self.order.create_transactions()
-            if self.split_order:
-                self.split_order.create_transactions()
+            for split_order in self.split_orders.values():
+                split_order.create_transactions()
 
         #if self.notify:
         #    notify_user_changed_order(
@@ -92,11 +133,26 @@ class TicketTransferChangeManager(OrderChangeManager):
 
         order_changed.send(self.order.event, order=self.order)
 
+    def _clear_tickets_cache(self):
+        super()._clear_tickets_cache()
+        for split_order in list(self.split_orders.values())[1:]:
+            tickets.invalidate_cache.apply_async(kwargs={'event': self.event.pk, 'order': split_order.pk})
+
+    def _create_split_order(self, split_positions):
+        groups = {}
+        for p in split_positions:
+            groups.setdefault(self._split_recipients.get(p.pk), []).append(p)
+        for recipient, positions in groups.items():
+            self.split_orders[recipient] = self._create_recipient_split_order(positions)
+            # the offsetting payment of this order is no longer available for the next one
+            self.__dict__.pop('completed_payment_sum', None)
+        return next(iter(self.split_orders.values()))
+
     """
     no invoice copy
     clear answers
     """
-    def _create_split_order(self, split_positions):
+    def _create_recipient_split_order(self, split_positions):
         split_order = Order.objects.get(pk=self.order.pk)
         split_order.pk = None
         split_order.code = None
@@ -108,23 +164,43 @@ class TicketTransferChangeManager(OrderChangeManager):
             'original_order': self.order.code
         })
 
+        prefetch_related_objects(split_positions, 'item', 'variation', 'subevent')
+
+        history = []
+        logs = []
         for op in split_positions:
-            self.order.log_action('pretix_ticket_transfer.changed.split', user=self.user, auth=self.auth, data={
+            history.append({
+                'positionid': op.positionid,
+                'item': op.item.name.data,
+                'variation': op.variation.value.data if op.variation else None,
+                'price': str(op.price),
+                'new_order': split_order.code,
+            })
+            logs.append(self.order.log_action('pretix_ticket_transfer.changed.split', user=self.user, auth=self.auth, data={
                 'position': op.pk,
                 'positionid': op.positionid,
-                'old_item': op.item.pk,
-                'old_variation': op.variation.pk if op.variation else None,
+                'old_item': op.item_id,
+                'old_variation': op.variation_id,
                 'old_price': op.price,
                 'new_order': split_order.code,
-            })
+            }, save=False))
             op.order = split_order
-            assign_ticket_secret(
-                self.event, position=op, force_invalidate=True,
-            )
-            op.save()
+            op.attendee_name_cached = op.attendee_name
+
+        with phase('secrets'):
+            assign_ticket_secrets(self.event, split_positions)
+        LogEntry.bulk_create_and_postprocess(logs)
+        OrderPosition.all.bulk_update(split_positions, ['order', 'secret', 'attendee_name_parts', 'attendee_name_cached'])
 
         ## clear answers
-            op.answers.clear()
+        QuestionAnswer.objects.filter(orderposition__in=split_positions).delete()
+
+        # transfer history for the order page of the source order, so it can be shown without queries
+        meta = self.order.meta_info_data
+        meta.setdefault('ticket_transfer_history', [])
+        meta['ticket_transfer_history'] += history
+        self.order.meta_info = json.dumps(meta)
+        self.order.save(update_fields=['meta_info'])
 
         #try:
         #    ia = modelcopy(self.order.invoice_address)
@@ -136,12 +212,16 @@ class TicketTransferChangeManager(OrderChangeManager):
 
         split_order.total = sum([p.price for p in split_positions if not p.canceled])
 
+        new_fees = []
         for fee in self.order.fees.exclude(fee_type=OrderFee.FEE_TYPE_PAYMENT):
             new_fee = modelcopy(fee)
             new_fee.pk = None
             new_fee.order = split_order
+            if new_fee.tax_rate is None:
+                new_fee._calculate_tax()
             split_order.total += new_fee.value
-            new_fee.save()
+            new_fees.append(new_fee)
+        OrderFee.objects.bulk_create(new_fees)
 
         if split_order.total != Decimal('0.00') and self.order.status != Order.STATUS_PAID:
             pp = self._get_payment_provider()
@@ -158,7 +238,10 @@ class TicketTransferChangeManager(OrderChangeManager):
                 fee.delete()
             split_order.total += fee.value
 
-        remaining_total = sum([p.price for p in self.order.positions.all()]) + sum([f.value for f in self.order.fees.all()])
+        remaining_total = (
+            (self.order.positions.aggregate(s=Sum('price'))['s'] or Decimal('0.00')) +
+            (self.order.fees.aggregate(s=Sum('value'))['s'] or Decimal('0.00'))
+        )
         offset_amount = min(max(0, self.completed_payment_sum - remaining_total), split_order.total)
         if offset_amount >= split_order.total:
             split_order.status = Order.STATUS_PAID
@@ -309,110 +392,213 @@ def notify_user_transfer_completed_new_owner(order, user=None, auth=None, invoic
         except SendMailException:
             logger.exception('Ticket transfer completed (new owner) email could not be sent')
 
-def user_split_positions( order, pids=None ):
+NOTIFIERS = {
+    TicketTransferNotification.KIND_SPLIT_SOURCE: notify_user_split_order_source,
+    TicketTransferNotification.KIND_SPLIT_TARGET: notify_user_split_order_target,
+    TicketTransferNotification.KIND_PENDING_PAYMENT: notify_user_transfer_pending_payment,
+    TicketTransferNotification.KIND_INITIATED: notify_user_transfer_initiated,
+    TicketTransferNotification.KIND_COMPLETED_OLD_OWNER: notify_user_transfer_completed_old_owner,
+    TicketTransferNotification.KIND_COMPLETED_NEW_OWNER: notify_user_transfer_completed_new_owner,
+}
 
-  pos = []
-  positions = order.positions.select_related('item')
+def user_split_positions( order, pids=None ):
+  """
+  Returns the positions of ``order`` that may be transferred, each annotated with
+  ``price_with_addons``. Check-ins and add-on prices are resolved in the same
+  query as the positions, so the number of queries does not depend on the
+  number of positions. The item whitelist comes from the compiled per-event
+  transfer configuration.
+
+  Without ``pids`` the positions are shown, not transferred, and are read from
+  the precomputed flags (see ``eligibility``) where every position has one.
+  Orders placed before the flags existed are checked live, this never writes,
+  ``ticket_transfer_rebuild_flags`` fills their flags in.
+  """
+  if pids is None:
+    pos = flagged_transferable_positions( order )
+    if pos is not None:
+      return pos
+
+  positions = order.positions.all()
   if pids:
     positions = positions.filter(pk__in=pids)
+  return transferable_positions( order.event, positions )
+
+def transferable_positions( event, positions ):
+  """
+  Filters the ``positions`` queryset of ``event`` down to the positions that may
+  be transferred, in one query however many orders they belong to.
+  """
+  config = get_transfer_config( event )
+  if config.items_all is None:
+    return []   # default to false
+
+  addon_total = OrderPosition.objects.filter(
+      addon_to=OuterRef('pk')
+  ).order_by().values('addon_to').annotate(s=Sum('price')).values('s')
+  positions = positions.filter(
+      item__admission=True,
+      addon_to__isnull=True,
+  ).annotate(
+      has_checkins=Exists(Checkin.all.filter(position=OuterRef('pk'))),
+      addon_total=Coalesce(Subquery(addon_total), Value(Decimal('0.00')), output_field=models.DecimalField()),
+  ).select_related('item', 'variation')
+
+  pos = []
   for p in positions:
-    if not p.item.admission or p.addon_to:
+    if p.has_checkins:
       continue
-    if p.all_checkins.exists():
+    if not config.is_item_eligible( p.item_id ):
       continue
-    if order.event.settings.get( 'pretix_ticket_transfer_items_all' ) == None:
-      continue   # default to false
-    elif order.event.settings.get( 'pretix_ticket_transfer_items_all' ) == True:
-      pos.append( p )
-    elif order.event.settings.get( 'pretix_ticket_transfer_items_all' ) == False:
-      if p.item.id in json.loads( order.event.settings.get( 'pretix_ticket_transfer_items' )):
-        pos.append( p )
-  for p in pos:
-    p.price_with_addons = p.price
-    for addon in p.addons.all():
-        if not addon.canceled:
-            p.price_with_addons += addon.price
+    p.price_with_addons = p.price + p.addon_total
+    pos.append( p )
   return pos
 
+def _recipient(data, position):
+    recipients = data.get('recipients') or {}
+    return recipients.get(str(position.pk)) or recipients.get(position.pk) or data.get('email')
+
+def _pending_transfers(meta):
+    """
+    Pending transfers with payment of a source order by new order code.
+    """
+    pending = meta.get('ticket_transfer_pending') or {}
+    if 'to_order' in pending:
+        # stored before an order could have more than one pending transfer
+        pending = {pending['to_order']: pending}
+    return pending
+
+
 def initiate_transfer_with_payment(order, pids, data):
     """
     Initiate a ticket transfer that requires payment from the new owner.
-    Creates a new order for the recipient that needs to be paid.
+    Returns the new order, or None. See ``initiate_transfers_with_payment``.
+    """
+    new_orders = initiate_transfers_with_payment(order, pids, data)
+    return new_orders[0] if new_orders else None
+
+
+@instrumented('initiate_transfer_with_payment')
+@retry_on_contention
+def initiate_transfers_with_payment(order, pids, data):
+    """
+    Initiate a ticket transfer that requires payment from the new owners.
+    Creates a new order for every recipient that needs to be paid, all under one
+    lock in one commit. ``data['email']`` is the recipient, ``data['recipients']``
+    may map single position ids to other recipients.
     Stores bank info for refund in original order metadata.
+    Returns the new orders, or an empty list. A repeated call with the same
+    ``data['idempotency_key']`` returns the new orders of the first one.
     """
     with transaction.atomic():
         event = order.event
-        positions = OrderPosition.objects.filter(pk__in=pids).select_for_update(nowait=True).all()
+        with phase('lock'):
+            lock_transfer(order, pids)
+        if data.get('idempotency_key'):
+            existing = TicketTransfer.objects.filter(
+                source_order=order, idempotency_key=data['idempotency_key']
+            ).select_related('target_order').order_by('pk')
+            if existing:
+                return [t.target_order for t in existing]
         ocm = TicketTransferChangeManager(
             order,
             notify=False,
             reissue_invoice=False)
 
-        pos = user_split_positions(order, pids)
+        with phase('positions'):
+            pos = user_split_positions(order, pids)
         success = 0
         for p in pos:
             p.attendee_name_parts = {}
-            ocm.split(p)
+            ocm.split(p, recipient=_recipient(data, p))
             success += 1
 
             if p.meta_info_data and p.meta_info_data.get('vouchergen_voucher_code'):
                 from pretix_vouchergen.utils import cancel_voucher
-                cancel_voucher(p.meta_info_data.get('vouchergen_voucher_code'))
+                with phase('voucher_cancel'):
+                    cancel_voucher(p.meta_info_data.get('vouchergen_voucher_code'))
 
                 meta = p.meta_info_data
                 del meta['vouchergen_voucher_code']
                 p.meta_info_data = meta
                 p.save()
 
-        if success == len(pos):
-            ocm.commit(check_quotas=False)
-
-            split_order = ocm.split_order
-            split_order.email_known_to_work = False
-
-            if data.get('email'):
-                split_order.email = data.get('email')
-
-            # Set new order to PENDING status - requires payment
-            split_order.status = Order.STATUS_PENDING
-            split_order.set_expires(now(), list(set(p.subevent_id for p in split_order.positions.all() if p.subevent_id)))
-            
-            # Store transfer metadata
-            meta = split_order.meta_info_data
-            meta['doistep'] = {}
-            meta['contact_form_data'] = {}
-            meta['confirm_messages'] = []
-            meta['ticket_transfer'] = TICKET_TRANSFER_PENDING_PAYMENT
-            meta['transfer_from_order'] = order.code
-            split_order.meta_info = json.dumps(meta)
-            split_order.save()
-
-            # Store bank info and transfer info in original order
-            meta = order.meta_info_data
-            meta['ticket_transfer_pending'] = {
-                'to_order': split_order.code,
-                'to_email': data.get('email'),
-                'bank_info': data.get('bank_info', {}),
-                'positions': pids,
-                'amount': str(split_order.total)
-            }
-            order.meta_info = json.dumps(meta)
-            order.save()
-
-            # Send email to new owner with payment link
-            notify_user_transfer_pending_payment(
-                split_order, ocm.user, ocm.auth,
-                list(split_order.invoices.all()) if ocm.event.settings.invoice_email_attachment else [])
-
-            # Send confirmation to old owner
-            notify_user_transfer_initiated(
-                order, ocm.user, ocm.auth,
-                ocm._invoices if ocm.event.settings.invoice_email_attachment else [])
-
-            return split_order
-    return None
-
-
+        # nothing left to transfer if another transfer took the positions while this one waited for the lock
+        if pos and success == len(pos):
+            with phase('commit'):
+                ocm.commit(check_quotas=False)
+
+            pending = _pending_transfers(order.meta_info_data)
+            transfers = []
+
+            for email, split_order in ocm.split_orders.items():
+                split_order.email_known_to_work = False
+
+                if email:
+                    split_order.email = email
+                split_pos = [p for p in pos if _recipient(data, p) == email]
+                split_pids = [p.pk for p in split_pos]
+
+                with phase('meta'):
+                    # Set new order to PENDING status - requires payment
+                    split_order.status = Order.STATUS_PENDING
+                    split_order.set_expires(now(), list(set(p.subevent_id for p in split_pos if p.subevent_id)))
+
+                    # Store transfer metadata
+                    meta = split_order.meta_info_data
+                    meta['doistep'] = {}
+                    meta['contact_form_data'] = {}
+                    meta['confirm_messages'] = []
+                    meta['ticket_transfer'] = TICKET_TRANSFER_PENDING_PAYMENT
+                    meta['transfer_from_order'] = order.code
+                    split_order.meta_info = json.dumps(meta)
+                    split_order.save()
+
+                    pending[split_order.code] = {
+                        'to_order': split_order.code,
+                        'to_email': email,
+                        'bank_info': data.get('bank_info', {}),
+                        'positions': split_pids,
+                        'amount': str(split_order.total)
+                    }
+
+                with phase('record'):
+                    transfer = TicketTransfer.objects.create(
+                        event=event,
+                        source_order=order,
+                        target_order=split_order,
+                        positions=split_pids,
+                        state=TICKET_TRANSFER_PENDING_PAYMENT,
+                        amount=split_order.total,
+                        expires=split_order.expires,
+                        idempotency_key=data.get('idempotency_key'),
+                    )
+                    transfers.append(transfer)
+
+                with phase('notifications'):
+                    # Email to new owner with payment link, sent after commit
+                    queue_notification(
+                        transfer, split_order, TicketTransferNotification.KIND_PENDING_PAYMENT,
+                        list(split_order.invoices.all()) if ocm.event.settings.invoice_email_attachment else [])
+
+            with phase('meta'):
+                # Store bank info and transfer info in original order
+                meta = order.meta_info_data
+                meta['ticket_transfer_pending'] = pending
+                order.meta_info = json.dumps(meta)
+                order.save()
+
+            with phase('notifications'):
+                # Confirmation to old owner, sent after commit, once for all recipients
+                queue_notification(
+                    transfers[0], order, TicketTransferNotification.KIND_INITIATED,
+                    ocm._invoices if ocm.event.settings.invoice_email_attachment else [])
+
+            return list(ocm.split_orders.values())
+    return []
+
+
+@instrumented('complete_transfer_after_payment')
 def complete_transfer_after_payment(new_order):
     """
     Complete the transfer when new owner has paid.
@@ -432,126 +618,309 @@ def complete_transfer_after_payment(new_order):
             logger.error(f'Original order {original_order_code} not found for transfer completion')
             return False
 
-        transfer_info = original_order.meta_info_data.get('ticket_transfer_pending', {})
+        transfer_info = _pending_transfers(original_order.meta_info_data).get(new_order.code)
         if not transfer_info:
             return False
 
-        # Mark transfer as completed
-        meta = new_order.meta_info_data
-        meta['ticket_transfer'] = TICKET_TRANSFER_COMPLETED
-        new_order.meta_info = json.dumps(meta)
-        new_order.save()
+        with phase('meta'):
+            # Mark transfer as completed
+            meta = new_order.meta_info_data
+            meta['ticket_transfer'] = TICKET_TRANSFER_COMPLETED
+            new_order.meta_info = json.dumps(meta)
+            new_order.save()
+
+        with phase('record'):
+            transfer = TicketTransfer.objects.filter(
+                event=new_order.event,
+                target_order=new_order,
+                state=TICKET_TRANSFER_PENDING_PAYMENT,
+            ).first() or TicketTransfer(
+                event=new_order.event,
+                source_order=original_order,
+                target_order=new_order,
+                positions=transfer_info.get('positions', []),
+                amount=Decimal(transfer_info.get('amount', '0.00')),
+            )
+            transfer.state = TICKET_TRANSFER_COMPLETED
+            transfer.save()
 
         # Process refund to old owner
         refund_amount = Decimal(transfer_info.get('amount', '0.00'))
         if refund_amount > Decimal('0.00'):
             # Create refund for the original order
-            refund = original_order.refunds.create(
-                state=OrderRefund.REFUND_STATE_CREATED,
-                source=OrderRefund.REFUND_SOURCE_ADMIN,
-                amount=refund_amount,
-                provider='banktransfer',  # Default to bank transfer, can be configured
-                comment=_('Refund for ticket transfer to order {order}').format(order=new_order.code),
-                info=json.dumps({
-                    'bank_info': transfer_info.get('bank_info', {}),
-                    'transfer_to': new_order.code
+            with phase('refund'):
+                bank_info = transfer_info.get('bank_info', {})
+                refund = original_order.refunds.create(
+                    state=OrderRefund.REFUND_STATE_CREATED,
+                    source=OrderRefund.REFUND_SOURCE_ADMIN,
+                    amount=refund_amount,
+                    provider='banktransfer',  # Default to bank transfer, can be configured
+                    comment=_('Refund for ticket transfer to order {order}').format(order=new_order.code),
+                    info=json.dumps({
+                        # account in the keys the bank transfer provider reads
+                        'payer': bank_info.get('account_holder'),
+                        'iban': bank_info.get('iban'),
+                        'bic': bank_info.get('bic') or None,
+                        'bank_info': bank_info,
+                        'transfer_to': new_order.code
+                    })
+                )
+                transfer.refund = refund
+                transfer.save(update_fields=['refund'])
+                original_order.log_action('pretix.event.order.refund.created', {
+                    'local_id': refund.local_id,
+                    'provider': refund.provider,
+                    'reason': 'ticket_transfer'
                 })
-            )
-            original_order.log_action('pretix.event.order.refund.created', {
-                'local_id': refund.local_id,
-                'provider': refund.provider,
-                'reason': 'ticket_transfer'
-            })
 
-            # Try to execute refund if provider supports it
-            try:
-                if refund.payment_provider:
-                    refund.payment_provider.execute_refund(refund)
-            except Exception as e:
-                logger.exception(f'Failed to execute refund for transfer: {e}')
-                # Refund is created but may need manual processing
-
-        # Update original order metadata
-        meta = original_order.meta_info_data
-        meta['ticket_transfer_sent'] = TICKET_TRANSFER_SENT
-        meta['ticket_transfer_completed'] = {
-            'to_order': new_order.code,
-            'completed_at': now().isoformat(),
-            'refund_amount': str(refund_amount)
-        }
-        if 'ticket_transfer_pending' in meta:
-            del meta['ticket_transfer_pending']
-        original_order.meta_info = json.dumps(meta)
-        original_order.save()
+                # Executed with the payment provider by the refund queue, see refunds.py
+                queue_refund(transfer)
+
+        with phase('meta'):
+            # Update original order metadata
+            meta = original_order.meta_info_data
+            meta['ticket_transfer_sent'] = TICKET_TRANSFER_SENT
+            meta['ticket_transfer_completed'] = {
+                'to_order': new_order.code,
+                'completed_at': now().isoformat(),
+                'refund_amount': str(refund_amount)
+            }
+            pending = _pending_transfers(meta)
+            pending.pop(new_order.code, None)
+            if pending:
+                meta['ticket_transfer_pending'] = pending
+            else:
+                meta.pop('ticket_transfer_pending', None)
+            original_order.meta_info = json.dumps(meta)
+            original_order.save()
 
-        # Send success emails
-        notify_user_transfer_completed_old_owner(
-            original_order, None, None,
-            list(original_order.invoices.all()) if original_order.event.settings.invoice_email_attachment else [])
+        with phase('notifications'):
+            # Success emails, sent after commit
+            queue_notification(
+                transfer, original_order, TicketTransferNotification.KIND_COMPLETED_OLD_OWNER,
+                list(original_order.invoices.all()) if original_order.event.settings.invoice_email_attachment else [])
 
-        notify_user_transfer_completed_new_owner(
-            new_order, None, None,
-            list(new_order.invoices.all()) if new_order.event.settings.invoice_email_attachment else [])
+            queue_notification(
+                transfer, new_order, TicketTransferNotification.KIND_COMPLETED_NEW_OWNER,
+                list(new_order.invoices.all()) if new_order.event.settings.invoice_email_attachment else [])
 
         return True
 
 
-def user_split( order, pids, data ):
+EXPIRED_ACTION_RETURN = 'return'
+EXPIRED_ACTION_CANCEL = 'cancel'
+
+
+def _positions_fit_quotas(event, positions):
+    quotas = Counter()
+    for p in positions:
+        for q in p.quotas:
+            quotas[q] += 1
+    lock_objects([q for q in quotas if q.size is not None], shared_lock_objects=[event])
+    qa = QuotaAvailability()
+    qa.queue(*quotas)
+    qa.compute()
+    return all(qa.results[q][1] is None or qa.results[q][1] >= n for q, n in quotas.items())
+
+
+def _return_offset(original_order, new_order):
+    """
+    Books the payment the split moved from ``original_order`` to ``new_order``
+    back with a counter refund and payment, the way the split booked it.
+    """
+    amount = sum((
+        p.amount for p in new_order.payments.filter(provider='offsetting', state=OrderPayment.PAYMENT_STATE_CONFIRMED)
+        if original_order.code in p.info_data.get('orders', [])
+    ), Decimal('0.00'))
+    if amount <= Decimal('0.00'):
+        return
+    new_order.refunds.create(
+        state=OrderRefund.REFUND_STATE_DONE,
+        amount=amount,
+        execution_date=now(),
+        provider='offsetting',
+        info=json.dumps({'orders': [original_order.code]})
+    )
+    original_order.payments.create(
+        state=OrderPayment.PAYMENT_STATE_CONFIRMED,
+        amount=amount,
+        payment_date=now(),
+        provider='offsetting',
+        info=json.dumps({'orders': [new_order.code]})
+    )
+
+
+def expire_pending_transfer(transfer):
+    """
+    Resolves a transfer whose new owner did not pay in time. The pending order is
+    canceled. Depending on the ``pretix_ticket_transfer_expired_action`` setting,
+    its positions are then moved back to the source order, as long as the quotas
+    still allow it, together with the payment the split moved to the pending
+    order. Must be called inside a transaction. Returns False if the
+    transfer is not due yet.
+    """
+    event = transfer.event
+    new_order = Order.objects.select_for_update(of=OF_SELF).get(pk=transfer.target_order_id)
+    if new_order.status == Order.STATUS_PAID:
+        return False  # completion is handled by the order_paid receiver
+    if new_order.status == Order.STATUS_PENDING and new_order.expires >= now():
+        # the deadline has been extended in the backend
+        transfer.expires = new_order.expires
+        transfer.save(update_fields=['expires', 'modified'])
+        return False
+
+    original_order = Order.objects.select_for_update(of=OF_SELF).get(pk=transfer.source_order_id)
+    action = event.settings.pretix_ticket_transfer_expired_action
+
+    if new_order.status != Order.STATUS_CANCELED:
+        _cancel_order(new_order, send_mail=False)
+
+    returned = False
+    if action == EXPIRED_ACTION_RETURN:
+        positions = list(new_order.all_positions.filter(canceled=False).select_related(
+            'item', 'variation', 'subevent'
+        ).order_by('positionid'))
+        if positions and _positions_fit_quotas(event, positions):
+            next_id = (original_order.all_positions.aggregate(m=Max('positionid'))['m'] or 0) + 1
+            for p in positions:
+                p.order = original_order
+                p.positionid = next_id
+                next_id += 1
+                # the ticket may have been downloaded by the new owner while pending
+                assign_ticket_secret(event, position=p, force_invalidate=True, save=False)
+            OrderPosition.all.bulk_update(positions, ['order', 'positionid', 'secret'])
+
+            original_order.total = (
+                (original_order.positions.aggregate(s=Sum('price'))['s'] or Decimal('0.00')) +
+                (original_order.fees.aggregate(s=Sum('value'))['s'] or Decimal('0.00'))
+            )
+            original_order.save(update_fields=['total'])
+            original_order.create_transactions()
+            _return_offset(original_order, new_order)
+            returned = True
+
+    meta = new_order.meta_info_data
+    meta['ticket_transfer'] = TICKET_TRANSFER_EXPIRED
+    new_order.meta_info = json.dumps(meta)
+    new_order.save(update_fields=['meta_info'])
+
+    meta = original_order.meta_info_data
+    pending = _pending_transfers(meta)
+    if pending.pop(new_order.code, None):
+        if pending:
+            meta['ticket_transfer_pending'] = pending
+        else:
+            del meta['ticket_transfer_pending']
+    if returned:
+        meta['ticket_transfer_history'] = [
+            h for h in meta.get('ticket_transfer_history', []) if h.get('new_order') != new_order.code
+        ]
+    original_order.meta_info = json.dumps(meta)
+    original_order.save(update_fields=['meta_info'])
+
+    original_order.log_action('pretix_ticket_transfer.changed.expired', data={
+        'new_order': new_order.code,
+        'returned': returned,
+    })
+
+    transfer.state = TICKET_TRANSFER_EXPIRED
+    transfer.save(update_fields=['state', 'modified'])
+    return True
+
+@instrumented('user_split')
+@retry_on_contention
+def user_split( order, pids, data, user=None ):
+  """
+  Splits the positions ``pids`` of ``order`` into new orders. ``data['email']`` is
+  the recipient, ``data['recipients']`` may map single position ids to other
+  recipients. Every recipient gets one new order, all created under one lock
+  in one commit. Returns the transfer records, one per recipient, or False if
+  not all positions could be split. A repeated call with the same
+  ``data['idempotency_key']`` returns the transfers of the first one.
+  """
   with transaction.atomic():
     event = order.event
-    positions = OrderPosition.objects.filter(pk__in=pids).select_for_update(nowait=True).all()
+    with phase('lock'):
+      lock_transfer( order, pids )
+    if data.get('idempotency_key'):
+      existing = list(TicketTransfer.objects.filter(source_order=order, idempotency_key=data['idempotency_key']).order_by('pk'))
+      if existing:
+        return existing
     ocm = TicketTransferChangeManager(
         order,
+        user=user,
         notify=False,
         reissue_invoice=False )
 
-    pos = user_split_positions( order, pids )
+    with phase('positions'):
+      pos = user_split_positions( order, pids )
     success = 0
     for p in pos:
       p.attendee_name_parts = {}
-      ocm.split(p)
+      ocm.split(p, recipient=_recipient(data, p))
       success+= 1
 
       if p.meta_info_data and p.meta_info_data.get('vouchergen_voucher_code'):
         from pretix_vouchergen.utils import cancel_voucher
-        cancel_voucher( p.meta_info_data.get('vouchergen_voucher_code'))
+        with phase('voucher_cancel'):
+          cancel_voucher( p.meta_info_data.get('vouchergen_voucher_code'))
 
         meta = p.meta_info_data
         del meta['vouchergen_voucher_code']
         p.meta_info_data = meta
         p.save()
 
-    if success == len(pos):
-
-      ocm.commit(check_quotas=False)
-
-      split_order = ocm.split_order
-      split_order.email_known_to_work = False
-
-      if data.get('email'):
-        split_order.email = data.get('email')
-
-      meta = split_order.meta_info_data
-      meta['doistep'] = {}
-      meta['contact_form_data'] = {}
-      meta['confirm_messages'] = []
-      meta['ticket_transfer'] = TICKET_TRANSFER_START if transfer_needs_accept(event) else TICKET_TRANSFER_DONE
-      split_order.meta_info = json.dumps(meta)
-      split_order.save()
-
-      meta = order.meta_info_data
-      meta['ticket_transfer_sent'] = TICKET_TRANSFER_SENT
-      order.meta_info = json.dumps(meta)
-      order.save()
+    # nothing left to transfer if another transfer took the positions while this one waited for the lock
+    if pos and success == len(pos):
+
+      with phase('commit'):
+        ocm.commit(check_quotas=False)
+
+      state = TICKET_TRANSFER_START if transfer_needs_accept(event) else TICKET_TRANSFER_DONE
+      transfers = []
+
+      for email, split_order in ocm.split_orders.items():
+        split_order.email_known_to_work = False
+
+        if email:
+          split_order.email = email
+
+        with phase('meta'):
+          meta = split_order.meta_info_data
+          meta['doistep'] = {}
+          meta['contact_form_data'] = {}
+          meta['confirm_messages'] = []
+          meta['ticket_transfer'] = state
+          split_order.meta_info = json.dumps(meta)
+          split_order.save()
+
+        with phase('record'):
+          transfers.append(TicketTransfer.objects.create(
+              event=event,
+              source_order=order,
+              target_order=split_order,
+              positions=[p.pk for p in pos if _recipient(data, p) == email],
+              state=state,
+              amount=split_order.total,
+              idempotency_key=data.get('idempotency_key'),
+          ))
+
+        with phase('notifications'):
+          queue_notification(
+              transfers[-1], split_order, TicketTransferNotification.KIND_SPLIT_TARGET,
+              list(split_order.invoices.all()) if ocm.event.settings.invoice_email_attachment else [] )
+
+      with phase('meta'):
+        meta = order.meta_info_data
+        meta['ticket_transfer_sent'] = TICKET_TRANSFER_SENT
+        order.meta_info = json.dumps(meta)
+        order.save()
 
-      notify_user_split_order_source(
-          order, ocm.user, ocm.auth,
-          ocm._invoices if ocm.event.settings.invoice_email_attachment else [] )
-      notify_user_split_order_target(
-          split_order, ocm.user, ocm.auth,
-          list(split_order.invoices.all()) if ocm.event.settings.invoice_email_attachment else [] )
+      with phase('notifications'):
+        # one email to the sender, however many recipients
+        queue_notification(
+            transfers[0], order, TicketTransferNotification.KIND_SPLIT_SOURCE,
+            ocm._invoices if ocm.event.settings.invoice_email_attachment else [] )
 
-      return True
+      return transfers
     return False
-
-
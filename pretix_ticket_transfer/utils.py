@@ -1,13 +1,126 @@
+import json
+import threading
+import time
+from types import MappingProxyType
+
+from django.core.cache import cache
+from django.utils.translation import get_language
+from pretix.base.models import ItemVariation
 from pretix.base.templatetags.rich_text import rich_text
 from pretix.presale.signals import checkout_confirm_messages
 
+from .config import CACHE_TIMEOUT, get_transfer_config
+
+# (event pk, language) -> (config version, rendered messages)
+_rendered = {}
+
 
 def get_confirm_messages(event):
-    msgs = {}
-    for index, text in enumerate(event.settings.pretix_ticket_transfer_confirm_texts):
-        msgs['ticket_transfer_confirm_text_%i' % index] = rich_text(str(text))
-    return msgs
+    """
+    Returns the confirm texts of ``event`` rendered to sanitized HTML in the
+    active language. Rendering runs once per event, language and settings version.
+    """
+    config = get_transfer_config(event)
+    language = get_language()
+
+    local = _rendered.get((event.pk, language))
+    if local and local[0] == config.version:
+        return dict(local[1])
+
+    key = 'pretix_ticket_transfer_confirm_messages:{}:{}:{}'.format(event.pk, config.version, language)
+    msgs = cache.get(key)
+    if msgs is None:
+        msgs = {}
+        for index, text in enumerate(config.confirm_texts):
+            msgs['ticket_transfer_confirm_text_%i' % index] = rich_text(str(text))
+        cache.set(key, msgs, timeout=CACHE_TIMEOUT)
+
+    _rendered[(event.pk, language)] = (config.version, msgs)
+    return dict(msgs)
 
 
 def transfer_needs_accept(event):
-    return bool(get_confirm_messages(event))
+    return bool(get_transfer_config(event).confirm_texts)
+
+
+class ItemNameResolver:
+    """
+    Resolves item and variation names of one event. All items and variations
+    are loaded in bulk on first use, so resolving many names costs two queries.
+    """
+    def __init__(self, event):
+        self.event = event
+        self.created = time.monotonic()
+        self._items = None
+        self._variations = None
+
+    def _load(self):
+        self._items = {i.pk: i for i in self.event.items.all()}
+        self._variations = {v.pk: v for v in ItemVariation.objects.filter(item__event=self.event)}
+
+    def item(self, pk):
+        if self._items is None:
+            self._load()
+        return str(self._items.get(pk, '?'))
+
+    def variation(self, pk):
+        if self._variations is None:
+            self._load()
+        return str(self._variations.get(pk, '?'))
+
+
+_request_local = threading.local()
+
+# upper bound for resolvers used outside of a request, e.g. in background tasks
+RESOLVER_MAX_AGE = 60
+
+
+def get_item_name_resolver(event):
+    """
+    Returns the :py:class:`ItemNameResolver` of ``event`` for the current request.
+    """
+    resolvers = getattr(_request_local, 'resolvers', None)
+    if resolvers is None:
+        resolvers = _request_local.resolvers = {}
+    resolver = resolvers.get(event.pk)
+    if resolver is None or resolver.created + RESOLVER_MAX_AGE < time.monotonic():
+        resolver = resolvers[event.pk] = ItemNameResolver(event)
+    return resolver
+
+
+def clear_request_caches(**kwargs):
+    _request_local.resolvers = {}
+    _request_local.transfer_meta = {}
+
+
+# upper bound for orders remembered outside of a request, e.g. while rendering tickets in bulk
+TRANSFER_META_MAX_ORDERS = 1000
+
+NO_TRANSFER_META = MappingProxyType({})
+
+
+def get_transfer_meta(order):
+    """
+    Returns the ``ticket_transfer*`` keys of ``order.meta_info``, read-only.
+    ``meta_info`` also carries the data of other plugins, so an order without
+    any of our keys is recognized on the raw text without parsing it, and an
+    order is parsed at most once per request, no matter how many instances of
+    it the handlers get. Use ``order.meta_info_data`` to change the data.
+    """
+    raw = order.meta_info
+    if not raw or 'ticket_transfer' not in raw:
+        return NO_TRANSFER_META
+
+    known = getattr(_request_local, 'transfer_meta', None)
+    if known is None or len(known) > TRANSFER_META_MAX_ORDERS:
+        known = _request_local.transfer_meta = {}
+    hit = known.get(order.pk)
+    if hit and hit[0] == raw:
+        return hit[1]
+
+    data = order.__dict__.get('meta_info_data')
+    if data is None:
+        data = json.loads(raw)
+    meta = MappingProxyType({k: v for k, v in data.items() if k.startswith('ticket_transfer')})
+    known[order.pk] = (raw, meta)
+    return meta
@@ -1,35 +1,62 @@
+import csv
+import io
 import json
 import operator
+from datetime import timedelta
+
 from django import forms
-from django.http import Http404
+from django.conf import settings
+from django.core.cache import cache
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from django.utils.cache import get_conditional_response
 from django.utils.functional import cached_property
-from django.views.generic import TemplateView
+from django.utils.timezone import now
+from django.views.generic import TemplateView, View
 from django.urls import reverse
-from django.shortcuts import redirect
+from django.shortcuts import get_object_or_404, redirect
 from django.middleware import csrf
-from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
 from django.contrib import messages
 from django.db import transaction
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.utils import translation
 from django.utils.translation import gettext_lazy as _
-from i18nfield.strings import LazyI18nString
-from pretix.base.models import Event, Order, OrderPosition
+from pretix.base.models import CachedFile, Event, Order, OrderPosition, OrderRefund
+from pretix.base.views.tasks import AsyncAction
 from pretix.base.forms import SettingsForm
 from pretix.base.settings import LazyI18nStringList
 from pretix.control.permissions import EventPermissionRequiredMixin
 from pretix.control.views.event import EventSettingsFormView, EventSettingsViewMixin
 from pretix.control.forms.event import ConfirmTextFormset
+from pretix.plugins.banktransfer.views import SepaXMLExportForm
 from pretix.presale.views import EventViewMixin
 from pretix.presale.views.order import OrderDetailMixin
 from pretix.multidomain.urlreverse import eventreverse
+from pretix.base.templatetags.money import money_filter
 from pretix.base.templatetags.rich_text import rich_text
 from i18nfield.forms import I18nFormField, I18nTextarea
 
+from .models import (
+    TicketTransfer as TicketTransferModel, TicketTransferPayout as TicketTransferPayoutModel,
+    TicketTransferRefundAttempt, TicketTransferRequest as TicketTransferRequestModel, TICKET_TRANSFER_SENT_STATES,
+)
+from .bulk import BulkTransferError, parse_bulk_csv, validate_bulk_rows
+from .eligibility import event_transferable_positions
+from .payouts import build_payout_xml, complete_payout, create_payout, open_payout_summary
+from .refunds import retry_refunds
+from .tasks import bulk_transfer
 from .user_split import (
-    user_split_positions, initiate_transfer_with_payment,
-    TICKET_TRANSFER_START, TICKET_TRANSFER_DONE, TICKET_TRANSFER_SENT
+    user_split_positions,
+    TICKET_TRANSFER_START, TICKET_TRANSFER_DONE,
+    TICKET_TRANSFER_PENDING_PAYMENT, TICKET_TRANSFER_COMPLETED, EXPIRED_ACTION_RETURN, EXPIRED_ACTION_CANCEL
 )
+from .config import get_transfer_config, invalidate_transfer_config
+from .state import cached_transfer_state, state_cache_key
 from .utils import get_confirm_messages
+from .wizard import (
+    WizardError, clear_wizard_state, confirm_transfer, load_wizard_state, position_summary, queue_confirmation,
+    require_wizard_state, recipients_from_post, select_positions, set_bank_info,
+)
 
 class TicketTransferSettingsForm(SettingsForm):
     pretix_ticket_transfer_title = I18nFormField(
@@ -160,6 +187,26 @@ class TicketTransferSettingsForm(SettingsForm):
         help_text=_('placeholders: {list}'.format(list = ', '.join(['{code}', '{event}', '{event_slug}', '{name}', '{total}', '{total_with_currency}', '{url}']))),
         widget_kwargs={'attrs': { 'rows': '8' }} )
 
+    pretix_ticket_transfer_expired_action = forms.ChoiceField(
+        label=_("Unpaid transfers"),
+        choices=(
+            (EXPIRED_ACTION_RETURN, _("Return the tickets to the original order")),
+            (EXPIRED_ACTION_CANCEL, _("Cancel the tickets")),
+        ),
+        widget=forms.RadioSelect,
+        help_text=_("What happens to the tickets of a transfer with payment once the payment deadline of the new order has passed.") )
+
+    pretix_ticket_transfer_surge_mode = forms.BooleanField(
+        label=_("Queue transfer confirmations"),
+        required=False,
+        help_text=_("Confirmed transfers are carried out in the background while the customer waits on a status page. "
+                    "Keeps the shop responsive when many transfers are confirmed at the same time.") )
+    pretix_ticket_transfer_surge_concurrency = forms.IntegerField(
+        label=_("Queued transfers carried out at the same time"),
+        min_value=1,
+        max_value=50,
+        widget=forms.NumberInput(attrs={'data-display-dependency': '#id_pretix_ticket_transfer_surge_mode'}) )
+
     # Optional: Formular-Texte
     pretix_ticket_transfer_bank_details_intro = I18nFormField(
         label=_("Bank details form - introduction text"),
@@ -224,7 +271,9 @@ class TicketTransferSettingsView(EventSettingsViewMixin, EventSettingsFormView):
             messages.error(self.request, _('We could not save your changes. See below for details.'))
             return self.render_to_response(self.get_context_data(form=self.get_form()))
         self.save_confirm_texts_formset()
-        return super().post(request, *args, **kwargs)
+        response = super().post(request, *args, **kwargs)
+        transaction.on_commit(lambda: invalidate_transfer_config(self.request.event))
+        return response
 
     @cached_property
     def confirm_texts_formset(self):
@@ -245,6 +294,7 @@ class TicketTransferSettingsView(EventSettingsViewMixin, EventSettingsFormView):
             for form_data in sorted((d for d in self.confirm_texts_formset.cleaned_data if d), key=operator.itemgetter("ORDER"))
             if form_data and not form_data.get("DELETE", False)
         )
+        transaction.on_commit(lambda: invalidate_transfer_config(self.request.event))
 
     def get_success_url(self, **kwargs):
         return reverse('plugins:pretix_ticket_transfer:settings', kwargs={
@@ -258,198 +308,266 @@ class TicketTransferSettingsView(EventSettingsViewMixin, EventSettingsFormView):
         return kwargs
 
 class TicketTransfer(EventViewMixin, OrderDetailMixin, TemplateView):
+    """
+    Three step wizard: select tickets and recipient, enter refund bank details,
+    confirm. Eligibility and prices are computed once in the first step and kept
+    with the entered data in a signed, expiring session record (see ``wizard``),
+    only the final confirmation checks the positions again.
+    """
     template_name = "pretix_ticket_transfer/transfer.html"
 
     def get_context_data(self, *args, **kwargs):
         ctx = super().get_context_data(*args, **kwargs)
         ctx['order'] = self.order
+        ctx['title'] = get_transfer_config(self.order.event).message('pretix_ticket_transfer_title')
+        ctx['message'] = str(rich_text( get_transfer_config(self.order.event).message('pretix_ticket_transfer_step2_message')))
+        ctx['step3_message'] = str(rich_text( get_transfer_config(self.order.event).message('pretix_ticket_transfer_step3_message')))
+        return ctx
+
+    def get(self, request, *args, **kwargs):
+        ctx = self.get_context_data(*args, **kwargs)
+        return self.render_step1(ctx, load_wizard_state(request, self.order))
+
+    def render_step1(self, ctx, state, pids=None, email=None, email_repeat=None, recipients=None):
         ctx['orderpositions'] = user_split_positions( self.order )
+        if pids is None:
+          pids = state['pids'] if state else []
+        if recipients is None:
+          recipients = state.get('recipients', {}) if state else {}
+        selected = {str(pid) for pid in pids}
+        for p in ctx['orderpositions']:
+          p.recipient = recipients.get(str(p.pk), '')
+        ctx['pos'] = [p for p in ctx['orderpositions'] if str(p.pk) in selected]
+        ctx['email'] = email if email is not None else (state['email'] if state else '')
+        ctx['email_repeat'] = email_repeat if email_repeat is not None else ctx['email']
+        return self.render_to_response(ctx)
 
-        ctx['title'] = self.order.event.settings.get('pretix_ticket_transfer_title', as_type=LazyI18nString )
-        ctx['message'] = str(rich_text( self.order.event.settings.get('pretix_ticket_transfer_step2_message', as_type=LazyI18nString )))
-        return ctx
+    def render_step(self, ctx, state, step):
+        ctx[step] = True
+        ctx['pos'] = state['positions']
+        ctx['totalprice'] = state['totalprice']
+        ctx['email'] = state['email']
+        ctx['bank_info'] = state['bank_info']
+        return self.render_to_response(ctx)
 
     def post(self, request, *args, **kwargs):
         if self.order.status != Order.STATUS_PAID:
           raise Http404()
 
-        error = False
-        pos = []
-        pids = request.POST.getlist('pos[]')
-        email = request.POST.get('email')
-        email_repeat = request.POST.get('email_repeat')
-        confirm = request.POST.get('confirm')
-        step2 = request.POST.get('step2')
-        step3 = request.POST.get('step3')  # Bank info step
-
         ctx = self.get_context_data(*args, **kwargs)
         ctx['csrf_token'] = csrf.get_token(request)
 
-        # Get selected positions (skip validation if we're confirming transfer)
-        if pids and not (step3 and confirm):
-          pos = user_split_positions( self.order, pids )
-          if not len( pids ) == len( pos ):
-            error = _("Invalid ticket selection")
-        else:
-          # If no pids in POST, try to get from previous step
-          pos = []
-          # For confirmation step, get pids from POST directly
-          if step3 and confirm and not pids:
-            pids = request.POST.getlist('pos[]')
-            if pids:
-              pos = user_split_positions( self.order, pids )
-
-        # Step 3: Process transfer confirmation (highest priority - check first)
-        if step3 and confirm:
-          # Get pids from POST if not already set
-          if not pids:
-            pids = request.POST.getlist('pos[]')
-          
-          bank_info = {
-            'account_holder': request.POST.get('bank_account_holder', ''),
-            'iban': request.POST.get('bank_iban', ''),
-            'bic': request.POST.get('bank_bic', ''),
-            'bank_name': request.POST.get('bank_name', ''),
-          }
-          email = request.POST.get('email', '')
-          
-          if not pids:
-            messages.error( self.request, _('No tickets selected. Please start over.') )
-            return redirect(
-                eventreverse(
-                    self.request.event,
-                    "presale:event.order",
-                    kwargs={"order": self.order.code, "secret": self.order.secret} ))
-          
-          data = {
-            'email': email,
-            'bank_info': bank_info
-          }
-          
-          new_order = initiate_transfer_with_payment(self.order, pids, data)
-          if new_order:
+        # every step submits with a button naming the action
+        try:
+          if request.POST.get('confirm'):
+            if get_transfer_config(self.order.event).surge_mode:
+              transfer_request = queue_confirmation(request, self.order)
+              return redirect(transfer_status_url(self.order, transfer_request))
+            confirm_transfer(request, self.order)
             messages.success( self.request, _('Ticket transfer initiated. The new owner will receive payment instructions.') )
             return redirect(
                 eventreverse(
                     self.request.event,
                     "presale:event.order",
                     kwargs={"order": self.order.code, "secret": self.order.secret} ))
-          else:
-            messages.error( self.request, _('Failed to initiate transfer. Please try again.') )
-
-        # Step 2: Handle bank info form submission (Continue button clicked from step 2)
-        elif step2 and step3 and not confirm:
-          bank_info = {
-            'account_holder': request.POST.get('bank_account_holder', ''),
-            'iban': request.POST.get('bank_iban', ''),
-            'bic': request.POST.get('bank_bic', ''),
-            'bank_name': request.POST.get('bank_name', ''),
-          }
-          
-          # Validate bank info
-          if not bank_info.get('account_holder'):
-            error = _("Please enter account holder name")
-          if not bank_info.get('iban'):
-            error = _("Please enter IBAN")
-          
-          if error:
-            messages.warning( self.request, error)
-            ctx['step2'] = True
-            ctx['email'] = request.POST.get('email', '')
-            ctx['email_repeat'] = request.POST.get('email', '')
-            ctx['bank_info'] = bank_info
-            if pids:
-              ctx['pids'] = pids
-          else:
-            # Move to step 3: Confirm
-            ctx['step3'] = True
-            ctx['email'] = request.POST.get('email', '')
-            ctx['bank_info'] = bank_info
-            ctx['message'] = str(rich_text( self.order.event.settings.get('pretix_ticket_transfer_step3_message', as_type=LazyI18nString )))
-            # Preserve positions
-            if pids:
-              ctx['pids'] = pids
-
-        # Step 1: Select tickets and enter email
-        elif not step2 and not step3 and email:
-          try:
-            validate_email(email)
-          except ValidationError:
-            error = _("Please enter a valid email address")
-          if email != email_repeat:
-            error = _("The email addresses do not match")
-          if not len( pids ):
-            error = _("Please select ticket(s) for transfer")
-
-          if error:
-            messages.warning( self.request, error)
-          else:
-            # Move to step 2: Bank info
-            ctx['step2'] = True
-            ctx['email'] = email
-            ctx['email_repeat'] = email_repeat
-            if pids:
-              ctx['pids'] = pids
-
-        # Step 2: Show bank info form (coming from step 1, or Go back from step 3)
-        elif step2 and not step3:
-          # Check if this is "Go back" from step 3 (step2 button with empty value)
-          if step2 == '':
-            # Go back to step 1
-            ctx['email'] = request.POST.get('email', '')
-            ctx['email_repeat'] = request.POST.get('email', '')
-            if pids:
-              ctx['pids'] = pids
-          else:
-            # Show step 2 (bank info form) - coming from step 1
-            ctx['step2'] = True
-            ctx['email'] = request.POST.get('email', '')
-            ctx['email_repeat'] = request.POST.get('email', '')
-            ctx['bank_info'] = ctx.get('bank_info', {})
-            # Preserve positions
-            if pids:
-              ctx['pids'] = pids
-            elif not pos:
-              # If no positions yet, get from previous context
-              pos = user_split_positions(self.order)
-              ctx['pids'] = [p.id for p in pos]
-
-        # Step 3: Display confirmation (not submitting yet)
-        elif step3 and not confirm:
-            # Just displaying step 3 confirmation (not submitting yet)
-            # Get bank info and positions from POST or context
-            if not ctx.get('bank_info'):
-              ctx['bank_info'] = {
-                'account_holder': request.POST.get('bank_account_holder', ''),
-                'iban': request.POST.get('bank_iban', ''),
-                'bic': request.POST.get('bank_bic', ''),
-                'bank_name': request.POST.get('bank_name', ''),
-              }
-            ctx['step3'] = True
-            ctx['email'] = ctx.get('email', request.POST.get('email', ''))
-            if pids:
-              ctx['pids'] = pids
-            ctx['message'] = str(rich_text( self.order.event.settings.get('pretix_ticket_transfer_step3_message', as_type=LazyI18nString )))
-
-        # Preserve positions and calculate total
-        if not pos and pids:
-          pos = user_split_positions(self.order, pids)
-        
-        totalprice = 0
-        for position in pos:
-          totalprice+= position.price_with_addons
-
-        ctx['pos'] = pos
-        ctx['totalprice'] = totalprice
-        ctx['email'] = ctx.get('email', email or "")
-        ctx['email_repeat'] = ctx.get('email_repeat', email_repeat or ctx.get('email', ''))
-        ctx['bank_info'] = ctx.get('bank_info', {})
-        
-        # Preserve pids in hidden fields for all steps
-        ctx['pids'] = pids
 
+          elif request.POST.get('back') == '1':
+            return self.render_step1(ctx, load_wizard_state(request, self.order))
+
+          elif request.POST.get('back') == '2':
+            return self.render_step(ctx, require_wizard_state(request, self.order), 'step2')
+
+          elif request.POST.get('step2'):
+            state = set_bank_info(request, self.order, request.POST)
+            return self.render_step(ctx, state, 'step3')
+
+          elif request.POST.get('step1'):
+            pids = request.POST.getlist('pos[]')
+            state = select_positions(
+              request, self.order,
+              pids, request.POST.get('email', ''), request.POST.get('email_repeat', ''),
+              recipients_from_post(request.POST, pids)
+            )
+            return self.render_step(ctx, state, 'step2')
+
+        except WizardError as e:
+          messages.warning( self.request, e.message )
+          if e.state:
+            return self.render_step(ctx, e.state, e.step)
+          if request.POST.get('step1'):
+            return self.render_step1(
+              ctx, None,
+              pids=request.POST.getlist('pos[]'), email=request.POST.get('email', ''),
+              email_repeat=request.POST.get('email_repeat', ''),
+              recipients=recipients_from_post(request.POST, request.POST.getlist('pos[]'))
+            )
+          return self.render_step1(ctx, None)
+
+        # Entry from the order page
+        return self.render_step1(ctx, load_wizard_state(request, self.order))
+
+
+def wizard_state_json(event, state):
+    return {
+        'email': state['email'],
+        'bank_info': state['bank_info'],
+        'positions': [
+            dict(p, price=money_filter(p['price'], event.currency))
+            for p in state['positions']
+        ],
+        'totalprice': money_filter(state['totalprice'], event.currency),
+    }
+
+
+class TicketTransferWizardApi(OrderDetailMixin, View):
+    """
+    Base of the JSON endpoints behind the client-side transfer wizard. They share
+    the steps and the session state with the :py:class:`TicketTransfer` view, but
+    skip the page render.
+    """
+    def dispatch(self, request, *args, **kwargs):
+        if not self.order or self.order.status != Order.STATUS_PAID:
+            return JsonResponse({'error': str(_('Unknown order code or not authorized to access this order.'))}, status=404)
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        except WizardError as e:
+            data = {'error': str(e.message), 'step': e.step}
+            if e.state:
+                data['state'] = wizard_state_json(request.event, e.state)
+            return JsonResponse(data, status=400)
+
+    def state_response(self, state, step):
+        return JsonResponse({'step': step, 'state': wizard_state_json(self.request.event, state)})
+
+
+class TicketTransferWizardPositions(TicketTransferWizardApi):
+    def get(self, request, *args, **kwargs):
+        state = load_wizard_state(request, self.order)
+        return JsonResponse({
+            'positions': [
+                dict(position_summary(p), price=money_filter(p.price_with_addons, request.event.currency))
+                for p in user_split_positions(self.order)
+            ],
+            'selected': state['pids'] if state else [],
+            'email': state['email'] if state else '',
+            'recipients': state.get('recipients', {}) if state else {},
+        })
+
+
+class TicketTransferWizardRecipient(TicketTransferWizardApi):
+    def post(self, request, *args, **kwargs):
+        pids = request.POST.getlist('pos[]')
+        state = select_positions(
+            request, self.order,
+            pids, request.POST.get('email', ''), request.POST.get('email_repeat', ''),
+            recipients_from_post(request.POST, pids)
+        )
+        return self.state_response(state, 'step2')
+
+
+class TicketTransferWizardBank(TicketTransferWizardApi):
+    def post(self, request, *args, **kwargs):
+        return self.state_response(set_bank_info(request, self.order, request.POST), 'step3')
+
+
+class TicketTransferWizardConfirm(TicketTransferWizardApi):
+    def post(self, request, *args, **kwargs):
+        if get_transfer_config(self.order.event).surge_mode:
+            transfer_request = queue_confirmation(request, self.order)
+            return JsonResponse({'redirect': transfer_status_url(self.order, transfer_request)})
+        confirm_transfer(request, self.order)
+        messages.success(request, _('Ticket transfer initiated. The new owner will receive payment instructions.'))
+        return JsonResponse({
+            'redirect': eventreverse(
+                request.event, "presale:event.order",
+                kwargs={"order": self.order.code, "secret": self.order.secret}
+            ),
+        })
+
+def transfer_status_url(order, transfer_request):
+    return eventreverse(
+        order.event, "plugins:pretix_ticket_transfer:status",
+        kwargs={"order": order.code, "secret": order.secret, "token": transfer_request.token}
+    )
+
+
+class TicketTransferStatus(EventViewMixin, OrderDetailMixin, TemplateView):
+    """
+    Waiting page of a transfer confirmed in surge mode (see ``surge``). It polls
+    :py:class:`TicketTransferStatusApi` and reloads once the transfer has run,
+    without JavaScript it refreshes itself. A finished transfer sends the user
+    on to the order, a failed one back to the wizard.
+    """
+    template_name = "pretix_ticket_transfer/status.html"
+
+    def get(self, request, *args, **kwargs):
+        if not self.order:
+            raise Http404(_('Unknown order code or not authorized to access this order.'))
+        transfer_request = get_object_or_404(TicketTransferRequestModel, order=self.order, token=kwargs['token'])
+
+        if transfer_request.state == TicketTransferRequestModel.STATE_DONE:
+            state = load_wizard_state(request, self.order)
+            if state and state.get('token') == transfer_request.token:
+                clear_wizard_state(request, self.order)
+                messages.success(request, _('Ticket transfer initiated. The new owner will receive payment instructions.'))
+            return redirect(eventreverse(
+                request.event, "presale:event.order",
+                kwargs={"order": self.order.code, "secret": self.order.secret}
+            ))
+        if transfer_request.state == TicketTransferRequestModel.STATE_FAILED:
+            messages.warning(request, transfer_request.error)
+            return redirect(eventreverse(
+                request.event, "plugins:pretix_ticket_transfer:generate",
+                kwargs={"order": self.order.code, "secret": self.order.secret}
+            ))
+
+        ctx = self.get_context_data(*args, **kwargs)
+        ctx['order'] = self.order
+        ctx['transfer_request'] = transfer_request
         return self.render_to_response(ctx)
 
+
+class TicketTransferStatusApi(OrderDetailMixin, View):
+    """
+    State of a transfer queued in surge mode, polled by the waiting page. One
+    indexed lookup besides the order.
+    """
+    def get(self, request, *args, **kwargs):
+        if not self.order:
+            return JsonResponse({'error': str(_('Unknown order code or not authorized to access this order.'))}, status=404)
+        state = TicketTransferRequestModel.objects.filter(
+            order=self.order, token=kwargs['token']
+        ).values_list('state', flat=True).first()
+        if state is None:
+            return JsonResponse({'error': str(_('Unknown ticket transfer.'))}, status=404)
+        return JsonResponse({'state': state})
+
+
+class TicketTransferOrderState(OrderDetailMixin, View):
+    """
+    Transfer state of an order for its polling order page, see ``state``. A
+    cached state is served without loading the order, only a cache miss checks
+    the secret and fills the cache. The state of an order that is only
+    accessible to a logged in customer is never cached.
+    """
+    def dispatch(self, request, *args, **kwargs):
+        # skips the access check of OrderDetailMixin, get() does it on a cache miss
+        return super(OrderDetailMixin, self).dispatch(request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        cached = cache.get(state_cache_key(request.event.pk, kwargs['order'], kwargs['secret']))
+        if cached is None:
+            if not self.order:
+                return JsonResponse({'error': str(_('Unknown order code or not authorized to access this order.'))}, status=404)
+            cached = cached_transfer_state(self.order)
+
+        etag, body = cached
+        response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return get_conditional_response(request, etag=etag, response=response)
+
+
 class TicketTransferAccept(EventViewMixin, OrderDetailMixin, TemplateView):
     def post(self, request, *args, **kwargs):
         positions = self.order.positions.select_related('item')
@@ -472,6 +590,12 @@ class TicketTransferAccept(EventViewMixin, OrderDetailMixin, TemplateView):
         self.order.meta_info = json.dumps(meta)
         self.order.save()
 
+        TicketTransferModel.objects.filter(
+            event=self.request.event,
+            target_order=self.order,
+            state=TICKET_TRANSFER_START,
+        ).update(state=TICKET_TRANSFER_DONE, modified=now())
+
         for msg in msgs.values():
             self.order.log_action('pretix.event.order.consent', data={'msg': msg})
         messages.success(self.request, _('Ticket transfer completed'))
@@ -486,41 +610,44 @@ class TicketTransferStats(EventPermissionRequiredMixin, TemplateView):
     permission = "can_change_event_settings"
     template_name = "pretix_ticket_transfer/control/stats.html"
 
+    cache_timeout = 60
+
+    counter_keys = {
+        TICKET_TRANSFER_START: 'start',
+        TICKET_TRANSFER_DONE: 'done',
+        TICKET_TRANSFER_PENDING_PAYMENT: 'pending_payment',
+        TICKET_TRANSFER_COMPLETED: 'completed',
+    }
+
+    def get_counter(self):
+        """
+        Counts transfers per state and target order status, and distinct sending
+        orders per source order status, in a single aggregate query.
+        """
+        statuses = [s for s, __ in Order.STATUS_CHOICE]
+        sent = Q(state__in=TICKET_TRANSFER_SENT_STATES)
+
+        aggregates = {'all': Count('pk')}
+        for state, key in self.counter_keys.items():
+            aggregates[key] = Count('pk', filter=Q(state=state))
+            for status in statuses:
+                aggregates[f'{key}_{status}'] = Count('pk', filter=Q(state=state, target_order__status=status))
+        aggregates['sent'] = Count('source_order', distinct=True, filter=sent)
+        for status in statuses:
+            aggregates[f'sent_{status}'] = Count('source_order', distinct=True, filter=sent & Q(source_order__status=status))
+
+        return TicketTransferModel.objects.filter(event=self.request.event).aggregate(**aggregates)
+
     def get_context_data(self, *args, **kwargs):
         ctx = super().get_context_data(*args, **kwargs)
         ctx['rows'] = []
-
-        map = {
-            TICKET_TRANSFER_START: 'start',
-            TICKET_TRANSFER_DONE: 'done',
-            TICKET_TRANSFER_SENT: 'sent',
-        } 
-        counter = {'all':0, 'start':0, 'done':0, 'sent':0}
-        def count(*i):
-          counter['all']+= 1
-          for k in i:
-            k = map.get(k,k)
-            print(f'k {k}')
-            counter[k] = counter.get(k,0) + 1
-
-
-        orders = Order.objects.filter(
-                event=self.request.event,
-                meta_info__contains='"ticket_transfer":')
-        for o in orders:
-          count(o.meta_info_data.get('ticket_transfer'), f'{o.status}')
-          #count(o.meta_info_data.get('ticket_transfer'))
-
-
-        sent = Order.objects.filter(
-                event=self.request.event,
-                meta_info__contains='"ticket_transfer_sent": 23')
-        for o in sent:
-          count(o.meta_info_data.get('ticket_transfer_sent'), f'sent_{o.status}')
-
-        print(counter)
-        ctx['counter'] = counter
-
+        ctx['counter'] = self.request.event.cache.get_or_set(
+            'ticket_transfer_stats', self.get_counter, timeout=self.cache_timeout
+        )
+        ctx['transferable'] = self.request.event.cache.get_or_set(
+            'ticket_transfer_transferable', lambda: event_transferable_positions(self.request.event).count(),
+            timeout=self.cache_timeout
+        )
         return ctx
 
 
@@ -535,3 +662,226 @@ class TicketTransferStats(EventPermissionRequiredMixin, TemplateView):
 
         #orders = Order.objects.filter(order__meta_info__ticket_transfer)
         #orders = Order.objects.raw("select id,code,meta_info from pretixbase_order where meta_info like '%%ticket_transfer%%'")
+
+
+class TicketTransferRefunds(EventPermissionRequiredMixin, TemplateView):
+    """
+    Lists transfer refunds the refund queue could not execute so far and allows
+    to queue them again.
+    """
+    permission = "can_change_orders"
+    template_name = "pretix_ticket_transfer/control/refunds.html"
+
+    def get_queryset(self):
+        last_error = TicketTransferRefundAttempt.objects.filter(
+            transfer=OuterRef('pk'), success=False
+        ).order_by('-started').values('error')[:1]
+        return TicketTransferModel.objects.filter(
+            event=self.request.event,
+            refund__state=OrderRefund.REFUND_STATE_CREATED,
+        ).filter(
+            Q(refund_execution=TicketTransferModel.REFUND_FAILED)
+            | Q(refund_execution=TicketTransferModel.REFUND_QUEUED, refund_attempts__gt=0)
+        ).annotate(
+            last_error=Subquery(last_error),
+        ).select_related('source_order', 'target_order', 'refund').order_by('refund_next_attempt', 'pk')
+
+    def get_context_data(self, *args, **kwargs):
+        ctx = super().get_context_data(*args, **kwargs)
+        ctx['transfers'] = self.get_queryset()
+        return ctx
+
+    def post(self, request, *args, **kwargs):
+        qs = self.get_queryset()
+        if 'retry_all' not in request.POST:
+            qs = qs.filter(pk__in=[pk for pk in request.POST.getlist('transfer') if pk.isdigit()])
+        n = retry_refunds(TicketTransferModel.objects.filter(pk__in=qs.values('pk')))
+        messages.success(request, _('{num} refunds have been queued again.').format(num=n))
+        return redirect(reverse('plugins:pretix_ticket_transfer:refunds', kwargs={
+            'organizer': request.event.organizer.slug,
+            'event': request.event.slug,
+        }))
+
+
+class TicketTransferPayouts(EventPermissionRequiredMixin, TemplateView):
+    """
+    Pays out all open bank transfer refunds of transfers with one SEPA file and
+    marks them as done together once the bank has executed it.
+    """
+    permission = "can_change_orders"
+    template_name = "pretix_ticket_transfer/control/payouts.html"
+
+    @cached_property
+    def form(self):
+        form = SepaXMLExportForm(self.request.POST if self.request.method == "POST" else None)
+        form.set_initial_from_event(self.request.event)
+        return form
+
+    def get_success_url(self):
+        return reverse('plugins:pretix_ticket_transfer:payouts', kwargs={
+            'organizer': self.request.event.organizer.slug,
+            'event': self.request.event.slug,
+        })
+
+    def get_context_data(self, *args, **kwargs):
+        ctx = super().get_context_data(*args, **kwargs)
+        ctx['form'] = self.form
+        ctx['open'] = open_payout_summary(self.request.event)
+        ctx['payouts'] = TicketTransferPayoutModel.objects.filter(event=self.request.event)
+        return ctx
+
+    def post(self, request, *args, **kwargs):
+        if request.event.currency != 'EUR':
+            messages.error(request, _('SEPA files can only be created for events in EUR.'))
+            return redirect(self.get_success_url())
+        if not self.form.is_valid():
+            return self.render_to_response(self.get_context_data())
+
+        try:
+            with transaction.atomic():
+                payout, skipped = create_payout(
+                    request.event, self.form.cleaned_data['account_holder'], self.form.cleaned_data['iban'],
+                    self.form.cleaned_data['bic'], user=request.user,
+                )
+                # the refunds stay open if the file cannot be created
+                if payout:
+                    filename, content_type, data = build_payout_xml(payout)
+        except ValueError as e:
+            messages.error(request, _('The SEPA file could not be created: {error}').format(error=str(e)))
+            return redirect(self.get_success_url())
+        if skipped:
+            messages.warning(request, _('{num} refunds have no valid bank account and need to be processed manually.').format(num=skipped))
+        if not payout:
+            messages.warning(request, _('There are no refunds to pay out.'))
+            return redirect(self.get_success_url())
+        return FileResponse(data, as_attachment=True, filename=filename, content_type=content_type)
+
+
+class TicketTransferPayoutDownload(EventPermissionRequiredMixin, View):
+    permission = "can_change_orders"
+
+    def get(self, request, *args, **kwargs):
+        payout = get_object_or_404(TicketTransferPayoutModel, event=request.event, pk=kwargs['payout'])
+        filename, content_type, data = build_payout_xml(payout)
+        return FileResponse(data, as_attachment=True, filename=filename, content_type=content_type)
+
+
+class TicketTransferPayoutDone(EventPermissionRequiredMixin, View):
+    permission = "can_change_orders"
+
+    def post(self, request, *args, **kwargs):
+        payout = get_object_or_404(TicketTransferPayoutModel, event=request.event, pk=kwargs['payout'])
+        n = complete_payout(payout, user=request.user)
+        messages.success(request, _('{num} refunds have been marked as done.').format(num=n))
+        return redirect(reverse('plugins:pretix_ticket_transfer:payouts', kwargs={
+            'organizer': request.event.organizer.slug,
+            'event': request.event.slug,
+        }))
+
+
+class TicketTransferBulk(EventPermissionRequiredMixin, TemplateView):
+    """
+    Upload of a CSV file with transfers the organizer runs for many orders at
+    once, see ``bulk``.
+    """
+    permission = "can_change_orders"
+    template_name = "pretix_ticket_transfer/control/bulk.html"
+
+    def post(self, request, *args, **kwargs):
+        if 'file' not in request.FILES:
+            return redirect(request.path)
+        if not request.FILES['file'].name.lower().endswith('.csv'):
+            messages.error(request, _('Please only upload CSV files.'))
+            return redirect(request.path)
+        if request.FILES['file'].size > settings.FILE_UPLOAD_MAX_SIZE_OTHER:
+            messages.error(request, _('Please do not upload files larger than 10 MB.'))
+            return redirect(request.path)
+
+        cf = CachedFile.objects.create(
+            expires=now() + timedelta(days=1),
+            date=now(),
+            filename='ticket_transfer_bulk.csv',
+            type='text/csv',
+        )
+        cf.bind_to_session(request)
+        cf.file.save('ticket_transfer_bulk.csv', request.FILES['file'])
+        return redirect(reverse('plugins:pretix_ticket_transfer:bulk.process', kwargs={
+            'organizer': request.event.organizer.slug,
+            'event': request.event.slug,
+            'file': cf.id,
+        }))
+
+
+class TicketTransferBulkProcess(EventPermissionRequiredMixin, AsyncAction, TemplateView):
+    """
+    Shows the validated rows of an uploaded bulk transfer file and runs the
+    transfers in the background.
+    """
+    permission = "can_change_orders"
+    template_name = "pretix_ticket_transfer/control/bulk_process.html"
+    task = bulk_transfer
+    known_errortypes = ['BulkTransferError']
+
+    @cached_property
+    def file(self):
+        try:
+            cf = get_object_or_404(CachedFile, id=self.kwargs['file'], filename='ticket_transfer_bulk.csv')
+        except (ValueError, ValidationError):
+            raise Http404()
+        if not cf.allowed_for_session(self.request):
+            raise Http404()
+        return cf
+
+    def get_upload_url(self):
+        return reverse('plugins:pretix_ticket_transfer:bulk', kwargs={
+            'organizer': self.request.event.organizer.slug,
+            'event': self.request.event.slug,
+        })
+
+    def get_error_url(self):
+        return self.get_upload_url()
+
+    def get_success_url(self, value):
+        return reverse('plugins:pretix_ticket_transfer:bulk.result', kwargs={
+            'organizer': self.request.event.organizer.slug,
+            'event': self.request.event.slug,
+            'file': value['report'],
+        })
+
+    def get_success_message(self, value):
+        return _('{done} transfers have been made, {failed} rows have not been transferred.').format(
+            done=value['done'], failed=value['failed'])
+
+    def get(self, request, *args, **kwargs):
+        if 'async_id' in request.GET and settings.HAS_CELERY:
+            return self.get_result(request)
+        try:
+            rows = validate_bulk_rows(request.event, parse_bulk_csv(self.file.file.read()))
+        except BulkTransferError as e:
+            messages.error(request, str(e))
+            return redirect(self.get_upload_url())
+        ctx = self.get_context_data(**kwargs)
+        ctx['rows'] = rows
+        ctx['valid'] = sum(1 for r in rows if not r['error'])
+        return self.render_to_response(ctx)
+
+    def post(self, request, *args, **kwargs):
+        return self.do(request.event.pk, str(self.file.id), request.user.pk, translation.get_language())
+
+
+class TicketTransferBulkResult(EventPermissionRequiredMixin, TemplateView):
+    permission = "can_change_orders"
+    template_name = "pretix_ticket_transfer/control/bulk_result.html"
+
+    def get_context_data(self, *args, **kwargs):
+        ctx = super().get_context_data(*args, **kwargs)
+        try:
+            cf = get_object_or_404(CachedFile, id=self.kwargs['file'], type='text/csv')
+        except (ValueError, ValidationError):
+            raise Http404()
+        if not cf.allowed_for_session(self.request) or not cf.file:
+            raise Http404()
+        reader = csv.DictReader(io.StringIO(cf.file.read().decode('utf-8')))
+        ctx['report'] = cf
+        ctx['rows'] = list(reader)
+        return ctx
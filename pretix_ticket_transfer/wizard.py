@@ -0,0 +1,262 @@
+from decimal import Decimal
+
+from django.core import signing
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.utils.crypto import get_random_string
+from django.utils.translation import gettext_lazy as _
+from localflavor.generic.validators import IBANValidator
+from pretix.base.services.orders import OrderError
+
+from .models import TicketTransfer, TicketTransferRequest
+
+# seconds a started transfer wizard stays valid without being completed
+WIZARD_MAX_AGE = 1800
+
+SESSION_KEY = 'pretix_ticket_transfer_wizard:{}'
+
+
+def _salt(order):
+    # binds the record to the order, a record copied between orders does not verify
+    return 'pretix_ticket_transfer.wizard:{}:{}'.format(order.code, order.secret)
+
+
+def position_summary(p):
+    """
+    Returns the parts of a transferable position shown in the wizard, so later
+    steps do not need to load the positions again.
+    """
+    return {
+        'id': p.pk,
+        'positionid': p.positionid,
+        'item': str(p.item.name),
+        'variation': str(p.variation) if p.variation else None,
+        'attendee_name': p.attendee_name_cached or None,
+        'price': str(p.price_with_addons),
+    }
+
+
+def load_wizard_state(request, order):
+    """
+    Returns the wizard state of ``order`` stored in the session of ``request``,
+    or ``None`` if there is none or it is expired or tampered with.
+    """
+    token = request.session.get(SESSION_KEY.format(order.code))
+    if not token:
+        return None
+    try:
+        state = signing.loads(token, salt=_salt(order), max_age=WIZARD_MAX_AGE)
+    except signing.BadSignature:
+        clear_wizard_state(request, order)
+        return None
+    for p in state['positions']:
+        p['price'] = Decimal(p['price'])
+    state['totalprice'] = Decimal(state['totalprice'])
+    return state
+
+
+def save_wizard_state(request, order, state):
+    """
+    Stores ``state`` signed in the session. Storing restarts the expiry.
+    """
+    data = dict(state)
+    data['positions'] = [dict(p, price=str(p['price'])) for p in state['positions']]
+    data['totalprice'] = str(state['totalprice'])
+    request.session[SESSION_KEY.format(order.code)] = signing.dumps(data, salt=_salt(order), compress=True)
+
+
+def clear_wizard_state(request, order):
+    request.session.pop(SESSION_KEY.format(order.code), None)
+
+
+def new_wizard_state(positions, email, recipients=None):
+    """
+    ``recipients`` maps position ids to recipients other than ``email``.
+    """
+    recipients = recipients or {}
+    summaries = [dict(position_summary(p), recipient=recipients.get(str(p.pk)) or email) for p in positions]
+    return {
+        'pids': [p['id'] for p in summaries],
+        'positions': summaries,
+        'totalprice': sum((p.price_with_addons for p in positions), Decimal('0.00')),
+        'email': email,
+        'recipients': {str(p['id']): p['recipient'] for p in summaries if p['recipient'] != email},
+        'bank_info': {},
+        # sent along with the confirmation, so a repeated confirmation does not transfer twice
+        'token': get_random_string(32),
+    }
+
+
+def recipients_from_post(data, pids):
+    """
+    Reads the optional recipients of single positions from the ``recipient_<id>``
+    fields of the first step.
+    """
+    recipients = {}
+    for pid in pids:
+        email = data.get('recipient_{}'.format(pid), '').strip()
+        if email:
+            recipients[str(pid)] = email
+    return recipients
+
+
+class WizardError(Exception):
+    """
+    Raised by the wizard steps. ``step`` is the step the user should see next,
+    ``state`` the wizard state to show it with, if there is one.
+    """
+    def __init__(self, message, step, state=None):
+        super().__init__(message)
+        self.message = message
+        self.step = step
+        self.state = state
+
+
+def select_positions(request, order, pids, email, email_repeat, recipients=None):
+    """
+    First step: validates the selected positions and the recipients and starts a
+    new wizard state. Single positions may go to other ``recipients`` than
+    ``email``, each recipient gets an own order. Bank details entered before are
+    kept.
+    """
+    from .user_split import user_split_positions
+
+    error = None
+    try:
+        validate_email(email)
+    except ValidationError:
+        error = _("Please enter a valid email address")
+    for recipient in (recipients or {}).values():
+        try:
+            validate_email(recipient)
+        except ValidationError:
+            error = _("Please enter a valid email address for every recipient")
+    if email != email_repeat:
+        error = _("The email addresses do not match")
+    if not pids:
+        error = _("Please select ticket(s) for transfer")
+    if error:
+        raise WizardError(error, 'step1')
+
+    try:
+        pos = user_split_positions(order, [int(pid) for pid in pids])
+    except (TypeError, ValueError):
+        pos = []
+    if len(pos) != len(pids):
+        raise WizardError(_("Invalid ticket selection"), 'step1')
+
+    previous = load_wizard_state(request, order)
+    state = new_wizard_state(pos, email, recipients)
+    state['bank_info'] = previous['bank_info'] if previous else {}
+    save_wizard_state(request, order, state)
+    return state
+
+
+def require_wizard_state(request, order):
+    state = load_wizard_state(request, order)
+    if not state:
+        raise WizardError(_('Your ticket transfer session has expired. Please start over.'), 'step1')
+    return state
+
+
+def set_bank_info(request, order, data):
+    """
+    Second step: validates the refund bank details and stores them.
+    """
+    state = require_wizard_state(request, order)
+    state['bank_info'] = {
+        'account_holder': data.get('bank_account_holder', '').strip(),
+        'iban': data.get('bank_iban', '').replace(' ', '').upper(),
+        'bic': data.get('bank_bic', '').strip(),
+        'bank_name': data.get('bank_name', '').strip(),
+    }
+    if not state['bank_info']['iban']:
+        raise WizardError(_("Please enter IBAN"), 'step2', state)
+    try:
+        IBANValidator()(state['bank_info']['iban'])
+    except ValidationError:
+        raise WizardError(_("Please enter a valid IBAN"), 'step2', state)
+    if not state['bank_info']['account_holder']:
+        raise WizardError(_("Please enter account holder name"), 'step2', state)
+    save_wizard_state(request, order, state)
+    return state
+
+
+def _confirmation_state(request, order):
+    state = require_wizard_state(request, order)
+    if not state['bank_info']:
+        raise WizardError(_('Your ticket transfer session has expired. Please start over.'), 'step1')
+    return state
+
+
+def _check_confirmation(request, order, state):
+    from .user_split import user_split_positions
+
+    # Tickets might have been checked in or changed since the first step
+    pos = user_split_positions(order, state['pids'])
+    if len(pos) != len(state['pids']):
+        clear_wizard_state(request, order)
+        raise WizardError(_('Some of the selected tickets can no longer be transferred. Please start over.'), 'step1')
+    if sum((p.price_with_addons for p in pos), Decimal('0.00')) != state['totalprice']:
+        bank_info = state['bank_info']
+        state = new_wizard_state(pos, state['email'], state.get('recipients'))
+        state['bank_info'] = bank_info
+        save_wizard_state(request, order, state)
+        raise WizardError(_('The price of the selected tickets has changed. Please check the transfer again.'), 'step3', state)
+
+
+def confirm_transfer(request, order):
+    """
+    Last step: checks the stored positions once more and initiates the transfer.
+    Returns the new orders, one per recipient.
+    """
+    from .user_split import initiate_transfers_with_payment
+
+    state = _confirmation_state(request, order)
+
+    if state.get('token'):
+        # the transfer has been made by an earlier request with this confirmation
+        done = TicketTransfer.objects.filter(
+            source_order=order, idempotency_key=state['token']
+        ).select_related('target_order').order_by('pk')
+        if done:
+            clear_wizard_state(request, order)
+            return [t.target_order for t in done]
+
+    _check_confirmation(request, order, state)
+
+    try:
+        new_orders = initiate_transfers_with_payment(order, state['pids'], {
+            'email': state['email'],
+            'recipients': state.get('recipients', {}),
+            'bank_info': state['bank_info'],
+            'idempotency_key': state.get('token'),
+        })
+    except OrderError as e:
+        raise WizardError(str(e), 'step3', state)
+    if not new_orders:
+        raise WizardError(_('Failed to initiate transfer. Please try again.'), 'step3', state)
+    clear_wizard_state(request, order)
+    return new_orders
+
+
+def queue_confirmation(request, order):
+    """
+    Last step in surge mode: checks the stored positions like
+    ``confirm_transfer``, but only queues the transfer. Returns the queued
+    request. The wizard state is kept until the status page has seen the
+    request succeed, so a failed request can be confirmed again.
+    """
+    from .surge import queue_transfer_request
+
+    state = _confirmation_state(request, order)
+    if not state.get('token'):
+        state['token'] = get_random_string(32)
+        save_wizard_state(request, order, state)
+
+    queued = TicketTransferRequest.objects.filter(order=order, token=state['token']).first()
+    if queued and queued.state != TicketTransferRequest.STATE_FAILED:
+        return queued
+
+    _check_confirmation(request, order, state)
+    return queue_transfer_request(order, state)
@@ -0,0 +1,60 @@
+import datetime
+from decimal import Decimal
+
+import pytest
+from django.utils.timezone import now
+from django_scopes import scope, scopes_disabled
+from pretix.base.models import Event, Item, Order, OrderPosition, Organizer
+
+BANK_INFO = {'iban': 'DE89370400440532013000', 'account_holder': 'A B'}
+
+
+@pytest.fixture
+def event():
+    with scopes_disabled():
+        o = Organizer.objects.create(name='Dummy', slug='dummy', plugins='pretix.plugins.banktransfer')
+        event = Event.objects.create(
+            organizer=o, name='Dummy', slug='dummy',
+            date_from=now() + datetime.timedelta(days=10),
+            plugins='pretix_ticket_transfer,pretix.plugins.banktransfer',
+        )
+        event.settings.pretix_ticket_transfer_items_all = True
+        for k in ('sender', 'recipient'):
+            event.settings.set('pretix_ticket_transfer_%s_subject' % k, 'Subject {code}')
+            event.settings.set('pretix_ticket_transfer_%s_mailtext' % k, 'Text {code}')
+        return event
+
+
+@pytest.fixture
+def order(event):
+    """
+    A paid order with two tickets, the first one with an add-on.
+    """
+    with scopes_disabled():
+        ticket = Item.objects.create(event=event, name='Ticket', default_price=Decimal('23.00'), admission=True)
+        addon = Item.objects.create(event=event, name='Addon', default_price=Decimal('5.00'), admission=False)
+        q = event.quotas.create(name='Quota', size=None)
+        q.items.add(ticket, addon)
+        o = Order.objects.create(
+            code='FOO', event=event, email='dummy@dummy.test', status=Order.STATUS_PAID,
+            datetime=now(), expires=now() + datetime.timedelta(days=10), total=Decimal('51.00'),
+            locale='en', sales_channel=event.organizer.sales_channels.get(identifier='web'),
+        )
+        p1 = OrderPosition.objects.create(order=o, item=ticket, price=Decimal('23.00'), positionid=1)
+        OrderPosition.objects.create(order=o, item=addon, price=Decimal('5.00'), positionid=2, addon_to=p1)
+        OrderPosition.objects.create(order=o, item=ticket, price=Decimal('23.00'), positionid=3)
+        o.payments.create(amount=o.total, state='confirmed', provider='manual')
+        return o
+
+
+@pytest.fixture
+def pending_transfer(event, order):
+    """
+    The new order of a transfer with payment of the first ticket of ``order``,
+    not paid yet.
+    """
+    from pretix_ticket_transfer.user_split import initiate_transfer_with_payment, user_split_positions
+
+    with scope(organizer=event.organizer):
+        pos = user_split_positions(order)
+        return initiate_transfer_with_payment(order, [pos[0].pk], {'email': 'new@example.org', 'bank_info': BANK_INFO})
@@ -0,0 +1,55 @@
+import json
+from io import StringIO
+
+import pytest
+from django.core.management import CommandError, call_command
+from django_scopes import scopes_disabled
+from pretix.base.models import Order, OrderPosition
+
+from pretix_ticket_transfer.models import TicketTransfer, TicketTransferPosition
+
+
+def _fixtures(event):
+    out = StringIO()
+    call_command('ticket_transfer_fixtures', organizer='bench', event=event, orders=20, transfers=5, stdout=out)
+    return json.loads(out.getvalue())
+
+
+@pytest.mark.django_db
+def test_fixtures_of_several_events():
+    first = _fixtures('one')
+    second = _fixtures('two')
+    assert first['orders'] == second['orders'] == 25
+    with scopes_disabled():
+        assert Order.objects.filter(event__organizer__slug='bench').count() == 50
+        assert TicketTransfer.objects.count() == 10
+        # generated with their transfer flags, like orders placed in the shop
+        positions = OrderPosition.all.filter(order__event__organizer__slug='bench')
+        assert TicketTransferPosition.objects.count() == positions.count()
+        checked_in = positions.filter(all_checkins__isnull=False).values('pk')
+        assert not TicketTransferPosition.objects.filter(position__in=checked_in, transferable=True).exists()
+
+
+@pytest.mark.django_db
+def test_rebuild_flags():
+    _fixtures('one')
+    with scopes_disabled():
+        TicketTransferPosition.objects.all().delete()
+    out = StringIO()
+    call_command('ticket_transfer_rebuild_flags', organizer='bench', stdout=out)
+    with scopes_disabled():
+        count = TicketTransferPosition.objects.count()
+    assert out.getvalue() == 'bench/one: {} positions\n'.format(count)
+    assert count > 0
+
+
+@pytest.mark.django_db
+def test_benchmark_needs_flags():
+    _fixtures('one')
+    out = StringIO()
+    call_command('ticket_transfer_benchmark', organizer='bench', event='one', repeat=2, skip_writes=True, stdout=out)
+    assert 'user_split_positions' in json.loads(out.getvalue())['results']
+    with scopes_disabled():
+        TicketTransferPosition.objects.all()[:1].get().delete()
+    with pytest.raises(CommandError):
+        call_command('ticket_transfer_benchmark', organizer='bench', event='one', repeat=2, skip_writes=True, stdout=out)
@@ -0,0 +1,68 @@
+import pytest
+from django_scopes import scope
+from pretix.base.models import Order
+
+from pretix_ticket_transfer import tasks, user_split
+from pretix_ticket_transfer.models import TICKET_TRANSFER_COMPLETED, TicketTransfer
+
+
+def _pay(order):
+    p = order.payments.create(amount=order.total, provider='manual', state='created')
+    p.confirm()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_order_paid_queues_completion(event, pending_transfer, monkeypatch):
+    queued = []
+    monkeypatch.setattr(tasks.complete_transfer, 'apply_async', lambda kwargs: queued.append(kwargs))
+    with scope(organizer=event.organizer):
+        _pay(pending_transfer)
+        t = TicketTransfer.objects.get()
+        assert t.completion_state == TicketTransfer.COMPLETION_QUEUED
+        assert t.state != TICKET_TRANSFER_COMPLETED
+    assert queued == [{'event': event.pk, 'order': pending_transfer.pk}]
+
+    tasks.complete_transfer.apply(kwargs=queued[0])
+    with scope(organizer=event.organizer):
+        t = TicketTransfer.objects.get()
+        assert t.completion_state == TicketTransfer.COMPLETION_DONE
+        assert t.completion_attempts == 1
+        assert t.state == TICKET_TRANSFER_COMPLETED
+
+    # a second job for the same order does nothing
+    tasks.complete_transfer.apply(kwargs=queued[0])
+    with scope(organizer=event.organizer):
+        assert TicketTransfer.objects.get().completion_attempts == 1
+        assert TicketTransfer.objects.get().refund.amount == pending_transfer.total
+
+
+@pytest.mark.django_db(transaction=True)
+def test_completion_retries_and_fails(event, pending_transfer, monkeypatch):
+    calls = []
+
+    def not_pending(order):
+        calls.append(order.pk)
+        return False
+
+    monkeypatch.setattr(user_split, 'complete_transfer_after_payment', not_pending)
+    with scope(organizer=event.organizer):
+        _pay(pending_transfer)
+        t = TicketTransfer.objects.get()
+        assert t.completion_state == TicketTransfer.COMPLETION_FAILED
+        assert t.completion_attempts == tasks.COMPLETION_MAX_ATTEMPTS
+        assert 'no matching pending transfer' in t.completion_error
+        assert t.state != TICKET_TRANSFER_COMPLETED
+    assert len(calls) == tasks.COMPLETION_MAX_ATTEMPTS
+
+
+@pytest.mark.django_db(transaction=True)
+def test_completion_of_completed_transfer(event, pending_transfer, monkeypatch):
+    monkeypatch.setattr(tasks.complete_transfer, 'apply_async', lambda kwargs: None)
+    with scope(organizer=event.organizer):
+        _pay(pending_transfer)
+        assert user_split.complete_transfer_after_payment(Order.objects.get(pk=pending_transfer.pk))
+    tasks.complete_transfer.apply(kwargs={'event': event.pk, 'order': pending_transfer.pk})
+    with scope(organizer=event.organizer):
+        t = TicketTransfer.objects.get()
+        assert t.completion_state == TicketTransfer.COMPLETION_DONE
+        assert t.completion_error is None
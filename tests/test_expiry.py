@@ -0,0 +1,49 @@
+import datetime
+from decimal import Decimal
+
+import pytest
+from django.db import transaction
+from django.utils.timezone import now
+from django_scopes import scope
+from pretix.base.models import Order
+
+from pretix_ticket_transfer.models import TICKET_TRANSFER_EXPIRED, TicketTransfer
+from pretix_ticket_transfer.user_split import expire_pending_transfer
+
+
+def _expire(event, new_order):
+    Order.objects.filter(pk=new_order.pk).update(expires=now() - datetime.timedelta(hours=1))
+    with transaction.atomic():
+        transfer = TicketTransfer.objects.select_related('event').get(target_order=new_order)
+        assert expire_pending_transfer(transfer)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_expired_transfer_returned(event, order, pending_transfer):
+    with scope(organizer=event.organizer):
+        assert Order.objects.get(pk=order.pk).pending_sum == Decimal('0.00')
+        _expire(event, pending_transfer)
+
+        o = Order.objects.get(pk=order.pk)
+        new = Order.objects.get(pk=pending_transfer.pk)
+        assert TicketTransfer.objects.get().state == TICKET_TRANSFER_EXPIRED
+        assert new.status == Order.STATUS_CANCELED
+        assert o.positions.count() == 3 and o.total == Decimal('51.00')
+        # the payment moved by the split is back where it came from
+        assert o.payment_refund_sum == Decimal('51.00')
+        assert o.pending_sum == Decimal('0.00')
+        assert new.payment_refund_sum == Decimal('0.00')
+        offset = o.payments.get(provider='offsetting')
+        assert offset.amount == Decimal('28.00') and offset.info_data == {'orders': [new.code]}
+        assert new.refunds.get(provider='offsetting').amount == Decimal('28.00')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_expired_transfer_canceled(event, order, pending_transfer):
+    event.settings.pretix_ticket_transfer_expired_action = 'cancel'
+    with scope(organizer=event.organizer):
+        _expire(event, pending_transfer)
+        o = Order.objects.get(pk=order.pk)
+        assert o.positions.count() == 1
+        assert not o.payments.filter(provider='offsetting').exists()
+        assert not Order.objects.get(pk=pending_transfer.pk).refunds.exists()
@@ -0,0 +1,55 @@
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django_scopes import scope
+from pretix.base.models import Checkin
+
+from pretix_ticket_transfer.eligibility import update_order_transfer_flags
+from pretix_ticket_transfer.models import TicketTransferPosition
+from pretix_ticket_transfer.user_split import user_split_positions
+
+
+def _transferable(order):
+    return set(TicketTransferPosition.objects.filter(
+        position__order=order, transferable=True
+    ).values_list('position__positionid', flat=True))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_flags_follow_checkins(event, order):
+    with scope(organizer=event.organizer):
+        update_order_transfer_flags(order)
+        assert [p.positionid for p in user_split_positions(order)] == [1, 3]
+        assert _transferable(order) == {1, 3}
+        c = Checkin.objects.create(position=order.positions.get(positionid=1), list=event.checkin_lists.create(name='l'))
+        assert _transferable(order) == {3}
+        assert [p.positionid for p in user_split_positions(order)] == [3]
+        c.delete()
+        assert _transferable(order) == {1, 3}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_checkins_of_other_events_ignored(event, order):
+    with scope(organizer=event.organizer):
+        update_order_transfer_flags(order)
+        event.disable_plugin('pretix_ticket_transfer')
+        event.save()
+        clist = event.checkin_lists.create(name='l')
+        with CaptureQueriesContext(connection) as ctx:
+            c = Checkin.objects.create(position=order.positions.get(positionid=1), list=clist)
+            c.delete()
+        assert not [q for q in ctx.captured_queries if 'ticket_transfer' in q['sql']]
+        assert _transferable(order) == {1, 3}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_unflagged_order_read_without_writes(event, order):
+    with scope(organizer=event.organizer):
+        # placed without the order_placed signal, like orders from before the flags
+        assert not TicketTransferPosition.objects.exists()
+        with CaptureQueriesContext(connection) as ctx:
+            pos = user_split_positions(order)
+        assert [p.positionid for p in pos] == [1, 3]
+        assert [str(p.price_with_addons) for p in pos] == ['28.00', '23.00']
+        assert not [q for q in ctx.captured_queries if not q['sql'].startswith('SELECT')]
+        assert not TicketTransferPosition.objects.exists()
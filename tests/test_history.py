@@ -0,0 +1,45 @@
+import importlib
+
+import pytest
+from django.apps import apps
+from django.test import RequestFactory
+from django_scopes import scope
+from pretix.base.models import Order
+
+from pretix_ticket_transfer.signals import orderinfo_source
+
+migration = importlib.import_module('pretix_ticket_transfer.migrations.0012_backfill_transfer_history')
+
+
+def _log_split(order, position, new_order):
+    order.log_action('pretix_ticket_transfer.changed.split', data={
+        'position': position.pk,
+        'positionid': position.positionid,
+        'old_item': position.item_id,
+        'old_variation': None,
+        'old_price': position.price,
+        'new_order': new_order,
+    })
+
+
+@pytest.mark.django_db
+def test_history_backfilled_from_split_log(event, order):
+    with scope(organizer=event.organizer):
+        p1, p3 = order.positions.get(positionid=1), order.positions.get(positionid=3)
+        # split before the history was recorded, the second one expired and came back
+        _log_split(order, p1, 'NEW01')
+        _log_split(order, p3, 'NEW02')
+        order.log_action('pretix_ticket_transfer.changed.expired', data={'new_order': 'NEW02', 'returned': True})
+
+        migration.backfill_history(apps, None)
+
+        order = Order.objects.get(pk=order.pk)
+        assert order.meta_info_data['ticket_transfer_history'] == [{
+            'positionid': 1, 'item': p1.item.name.data, 'variation': None, 'price': '23.00', 'new_order': 'NEW01',
+        }]
+        request = RequestFactory().get('/')
+        assert str(p1.item.name) in orderinfo_source(event, order=order, request=request)
+
+        # a history recorded at split time is left alone
+        migration.backfill_history(apps, None)
+        assert Order.objects.get(pk=order.pk).meta_info == order.meta_info
@@ -0,0 +1,112 @@
+import threading
+
+import pytest
+from django.db import OperationalError, connection, transaction
+from django_scopes import scope, scopes_disabled
+from pretix.base.models import Order
+from pretix.base.services.orders import OrderError
+
+from pretix_ticket_transfer import locks, user_split
+from pretix_ticket_transfer.models import TicketTransfer
+
+BANK_INFO = {'iban': 'DE89370400440532013000', 'account_holder': 'A B'}
+
+
+def _confirm_concurrently(order, confirmations):
+    """
+    Runs ``initiate_transfers_with_payment`` once for every ``(pids, token)``
+    in its own thread and connection, all started at the same time.
+    """
+    barrier = threading.Barrier(len(confirmations))
+    results = [None] * len(confirmations)
+
+    def confirm(i, pids, token):
+        try:
+            with scopes_disabled():
+                o = Order.objects.select_related('event', 'event__organizer').get(pk=order.pk)
+                barrier.wait()
+                results[i] = user_split.initiate_transfers_with_payment(o, pids, {
+                    'email': 'new{}@example.org'.format(i), 'bank_info': BANK_INFO, 'idempotency_key': token,
+                })
+        except Exception as e:
+            results[i] = e
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=confirm, args=(i, pids, token)) for i, (pids, token) in enumerate(confirmations)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_confirmations(event, order):
+    if connection.vendor != 'postgresql':
+        pytest.skip('needs row locks of PostgreSQL')
+    with scope(organizer=event.organizer):
+        p1, p3 = [p.pk for p in user_split.user_split_positions(order)]
+
+    # the same confirmation sent several times transfers once
+    results = _confirm_concurrently(order, [([p1], 'same')] * 6)
+    assert not [r for r in results if isinstance(r, Exception) and not isinstance(r, locks.TransferBusyError)], results
+    codes = {tuple(o.code for o in r) for r in results if isinstance(r, list)}
+    assert len(codes) == 1
+    with scopes_disabled():
+        assert TicketTransfer.objects.filter(source_order=order).count() == 1
+
+    # different confirmations of the same position, only one of them may transfer it
+    results = _confirm_concurrently(order, [([p3], 'token{}'.format(i)) for i in range(6)])
+    assert not [r for r in results if isinstance(r, Exception) and not isinstance(r, OrderError)], results
+    with scopes_disabled():
+        assert TicketTransfer.objects.filter(source_order=order).count() == 2
+        assert Order.objects.filter(all_positions__pk=p3).count() == 1
+        assert Order.objects.filter(all_positions__pk=p1).count() == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_retry_on_contention(event, order, monkeypatch):
+    monkeypatch.setattr(locks.time, 'sleep', lambda s: None)
+    real = user_split.lock_transfer
+    calls = []
+
+    def flaky(order, pids):
+        calls.append(1)
+        if len(calls) < locks.LOCK_ATTEMPTS:
+            raise OperationalError('database is locked')
+        return real(order, pids)
+
+    monkeypatch.setattr(user_split, 'lock_transfer', flaky)
+    with scope(organizer=event.organizer):
+        pos = user_split.user_split_positions(order)
+        assert user_split.user_split(order, [pos[0].pk], {'email': 'a@example.org'})
+    assert len(calls) == locks.LOCK_ATTEMPTS
+
+    def busy(order, pids):
+        raise OperationalError('database is locked')
+
+    monkeypatch.setattr(user_split, 'lock_transfer', busy)
+    with scope(organizer=event.organizer):
+        with pytest.raises(locks.TransferBusyError):
+            user_split.user_split(order, [pos[1].pk], {'email': 'b@example.org'})
+
+
+@pytest.mark.django_db(transaction=True)
+def test_no_retry_inside_transaction(event, order, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(locks.time, 'sleep', sleeps.append)
+    calls = []
+
+    def busy(order, pids):
+        calls.append(1)
+        raise OperationalError('database is locked')
+
+    monkeypatch.setattr(user_split, 'lock_transfer', busy)
+    with scope(organizer=event.organizer):
+        pos = user_split.user_split_positions(order)
+        with transaction.atomic():
+            with pytest.raises(OperationalError):
+                user_split.user_split(order, [pos[0].pk], {'email': 'a@example.org'})
+    # the caller holds the locks, it is not kept waiting and decides itself
+    assert calls == [1] and sleeps == []
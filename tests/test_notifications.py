@@ -0,0 +1,45 @@
+import pytest
+from django.core import mail
+from django.db import transaction
+from django_scopes import scope
+
+from pretix_ticket_transfer import tasks
+from pretix_ticket_transfer.models import TicketTransferNotification
+from pretix_ticket_transfer.user_split import user_split, user_split_positions
+
+
+@pytest.mark.django_db(transaction=True)
+def test_notifications_sent_after_commit(event, order):
+    with scope(organizer=event.organizer):
+        pos = user_split_positions(order)
+        with transaction.atomic():
+            transfer, = user_split(order, [pos[0].pk], {'email': 'new@example.org'})
+            kinds = set(TicketTransferNotification.objects.values_list('kind', 'state'))
+            assert kinds == {
+                (TicketTransferNotification.KIND_SPLIT_SOURCE, TicketTransferNotification.STATE_PENDING),
+                (TicketTransferNotification.KIND_SPLIT_TARGET, TicketTransferNotification.STATE_PENDING),
+            }
+            assert len(mail.outbox) == 0
+
+        assert sorted(m.to[0] for m in mail.outbox) == ['dummy@dummy.test', 'new@example.org']
+        assert set(TicketTransferNotification.objects.values_list('state', flat=True)) == {
+            TicketTransferNotification.STATE_SENT
+        }
+
+        # queueing or sending an entry again does not send it twice
+        n = tasks.queue_notification(transfer, order, TicketTransferNotification.KIND_SPLIT_SOURCE)
+        tasks.send_transfer_notification.apply(kwargs={'event': event.pk, 'notification': n.pk})
+        assert TicketTransferNotification.objects.count() == 2
+        assert len(mail.outbox) == 2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_notifications_not_sent_on_rollback(event, order):
+    with scope(organizer=event.organizer):
+        pos = user_split_positions(order)
+        with pytest.raises(ValueError):
+            with transaction.atomic():
+                user_split(order, [pos[0].pk], {'email': 'new@example.org'})
+                raise ValueError('rolled back')
+        assert not TicketTransferNotification.objects.exists()
+    assert len(mail.outbox) == 0
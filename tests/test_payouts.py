@@ -0,0 +1,74 @@
+import pytest
+import sepaxml
+from django_scopes import scope
+from pretix.base.models import OrderRefund, User
+from sepaxml.validation import ValidationError as SepaValidationError
+
+from pretix_ticket_transfer.models import TicketTransfer, TicketTransferPayout
+from pretix_ticket_transfer.payouts import build_payout_xml, create_payout
+from pretix_ticket_transfer.user_split import initiate_transfer_with_payment, user_split_positions
+
+DEBTOR = ('Festival', 'DE02120300000000202051', 'BYLADEM1001')
+
+
+def _paid_transfers(event, order, ibans):
+    pos = user_split_positions(order)
+    for p, iban in zip(pos, ibans):
+        new = initiate_transfer_with_payment(order, [p.pk], {
+            'email': 'new@example.org', 'bank_info': {'iban': iban, 'account_holder': 'A B'},
+        })
+        new.payments.create(amount=new.total, provider='manual', state='created').confirm()
+    return list(TicketTransfer.objects.select_related('refund').order_by('pk'))
+
+
+@pytest.fixture
+def admin_client(event, client):
+    user = User.objects.create_user('admin@localhost', 'admin')
+    team = event.organizer.teams.create(all_events=True, all_event_permissions=True)
+    team.members.add(user)
+    client.login(email='admin@localhost', password='admin')
+    return client
+
+
+@pytest.mark.django_db(transaction=True)
+def test_payout_skips_invalid_iban(event, order):
+    with scope(organizer=event.organizer):
+        good, bad = _paid_transfers(event, order, ['DE89370400440532013000', 'DE89370400440532013001'])
+        payout, skipped = create_payout(event, *DEBTOR)
+        assert skipped == 1 and payout.count == 1
+        assert list(payout.transfers.all()) == [good]
+        bad.refresh_from_db()
+        assert bad.payout is None and bad.refund.state == OrderRefund.REFUND_STATE_CREATED
+        name, ct, data = build_payout_xml(payout)
+        assert b'DE89370400440532013000' in data.getvalue()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_failed_export_leaves_refunds_open(event, order, admin_client, monkeypatch):
+    def fail(self, *args, **kwargs):
+        raise SepaValidationError('invalid file')
+
+    monkeypatch.setattr(sepaxml.SepaTransfer, 'export', fail)
+    with scope(organizer=event.organizer):
+        transfer, = _paid_transfers(event, order, ['DE89370400440532013000'])
+    r = admin_client.post('/control/event/dummy/dummy/ticket_transfer/payouts', dict(zip(('account_holder', 'iban', 'bic'), DEBTOR)))
+    assert r.status_code == 302
+    with scope(organizer=event.organizer):
+        assert not TicketTransferPayout.objects.exists()
+        transfer.refresh_from_db()
+        assert transfer.payout is None and transfer.refund.state == OrderRefund.REFUND_STATE_CREATED
+    assert b'could not be created' in admin_client.get(r['Location']).content
+
+
+@pytest.mark.django_db(transaction=True)
+def test_wizard_rejects_invalid_iban(event, order, client):
+    event.live = True
+    event.save()
+    url = '/dummy/dummy/order/FOO/{}/ticket_transfer'.format(order.secret)
+    with scope(organizer=event.organizer):
+        p3 = order.positions.get(positionid=3)
+    client.post(url, {'step1': '1', 'pos[]': [p3.pk], 'email': 'b@example.org', 'email_repeat': 'b@example.org'})
+    r = client.post(url, {'step2': '1', 'bank_account_holder': 'A B', 'bank_iban': 'DE89 3704 0044 0532 0130 01'})
+    assert r.status_code == 200 and b'valid IBAN' in r.content
+    r = client.post(url, {'step2': '1', 'bank_account_holder': 'A B', 'bank_iban': 'DE89 3704 0044 0532 0130 00'})
+    assert b'valid IBAN' not in r.content
@@ -0,0 +1,95 @@
+from datetime import timedelta
+
+import pytest
+from django.utils.timezone import now
+from django_scopes import scope
+from pretix.base.models import OrderRefund
+
+from pretix_ticket_transfer import refunds, tasks
+from pretix_ticket_transfer.models import TicketTransfer
+
+
+class FakeProvider:
+    def __init__(self, fail=True):
+        self.fail = fail
+        self.calls = []
+
+    def execute_refund(self, refund):
+        self.calls.append(refund.pk)
+        if self.fail:
+            raise ValueError('provider down')
+        refund.done()
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    provider = FakeProvider()
+    monkeypatch.setattr(OrderRefund, 'payment_provider', property(lambda self: provider))
+    return provider
+
+
+@pytest.fixture
+def queued_refund(event, pending_transfer):
+    with scope(organizer=event.organizer):
+        p = pending_transfer.payments.create(amount=pending_transfer.total, provider='manual', state='created')
+        p.confirm()
+        t = TicketTransfer.objects.get()
+        assert t.refund_execution == TicketTransfer.REFUND_QUEUED
+        return t
+
+
+def _transfer():
+    return TicketTransfer.objects.select_related('refund').get()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_claim_leases_refund(event, queued_refund, provider):
+    with scope(organizer=event.organizer):
+        claimed = refunds.claim_refund()
+        assert claimed.pk == queued_refund.pk
+        assert claimed.refund_next_attempt > now() + refunds.REFUND_LEASE - timedelta(minutes=1)
+        # leased to the first worker
+        assert refunds.claim_refund() is None
+
+        # until the lease runs out
+        TicketTransfer.objects.filter(pk=claimed.pk).update(refund_next_attempt=now())
+        assert refunds.claim_refund().pk == claimed.pk
+    assert provider.calls == []
+
+
+@pytest.mark.django_db(transaction=True)
+def test_failing_refund_backs_off_and_fails(event, queued_refund, provider):
+    with scope(organizer=event.organizer):
+        for attempt in range(1, refunds.REFUND_MAX_ATTEMPTS):
+            before = now()
+            assert refunds.execute_refund(refunds.claim_refund()) is False
+            t = _transfer()
+            assert t.refund_attempts == attempt
+            assert t.refund_execution == TicketTransfer.REFUND_QUEUED
+            backoff = min(refunds.REFUND_BACKOFF * 2 ** (attempt - 1), refunds.REFUND_BACKOFF_MAX)
+            assert before + backoff <= t.refund_next_attempt <= now() + backoff
+            # not due before the backoff has passed
+            assert refunds.claim_refund() is None
+            TicketTransfer.objects.filter(pk=t.pk).update(refund_next_attempt=now())
+
+        assert refunds.execute_refund(refunds.claim_refund()) is False
+        t = _transfer()
+        assert t.refund_execution == TicketTransfer.REFUND_FAILED
+        assert t.refund_next_attempt is None
+        assert t.refund.state == OrderRefund.REFUND_STATE_CREATED
+        assert [a.error for a in t.refund_attempt_history.all()] == ['provider down'] * refunds.REFUND_MAX_ATTEMPTS
+        assert t.refund.order.all_logentries().filter(action_type='pretix_ticket_transfer.refund.failed').exists()
+        assert refunds.claim_refund() is None
+
+    # the worker leaves failed refunds alone, a retry from the backend queues them again
+    tasks.execute_transfer_refunds.apply()
+    assert len(provider.calls) == refunds.REFUND_MAX_ATTEMPTS
+    provider.fail = False
+    with scope(organizer=event.organizer):
+        assert refunds.retry_refunds(TicketTransfer.objects.all()) == 1
+    tasks.execute_transfer_refunds.apply()
+    with scope(organizer=event.organizer):
+        t = _transfer()
+        assert t.refund_execution == TicketTransfer.REFUND_EXECUTED
+        assert t.refund_attempts == 1
+        assert t.refund.state == OrderRefund.REFUND_STATE_DONE
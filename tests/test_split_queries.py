@@ -0,0 +1,51 @@
+import datetime
+from decimal import Decimal
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+from django_scopes import scope
+from pretix.base.models import Order, OrderPosition
+
+from pretix_ticket_transfer.user_split import TicketTransferChangeManager, user_split, user_split_positions
+
+
+def _order(event, code, count):
+    ticket = event.items.get(name='Ticket')
+    o = Order.objects.create(
+        code=code, event=event, email='dummy@dummy.test', status=Order.STATUS_PAID,
+        datetime=now(), expires=now() + datetime.timedelta(days=10), total=Decimal('23.00') * (count + 1),
+        locale='en', sales_channel=event.organizer.sales_channels.get(identifier='web'),
+    )
+    for i in range(count + 1):
+        OrderPosition.objects.create(order=o, item=ticket, price=Decimal('23.00'), positionid=i + 1)
+    o.payments.create(amount=o.total, state='confirmed', provider='manual')
+    return o
+
+
+# transaction=True, settings changed in an open transaction are read from the database on every access
+@pytest.mark.django_db(transaction=True)
+def test_split_queries_independent_of_position_count(event, order, monkeypatch):
+    counts = []
+    create_split_order = TicketTransferChangeManager._create_split_order
+
+    def counted(self, split_positions):
+        # pretix' OrderChangeManager checks every position on its own before, the split itself is ours
+        with CaptureQueriesContext(connection) as ctx:
+            split_order = create_split_order(self, split_positions)
+        counts.append(len(ctx.captured_queries))
+        return split_order
+
+    monkeypatch.setattr(TicketTransferChangeManager, '_create_split_order', counted)
+    with scope(organizer=event.organizer):
+        # fills the content type cache of the log entries
+        user_split(order, [user_split_positions(order)[0].pk], {'email': 'new@example.org'})
+        for code, count in (('NNNNN', 4), ('MMMMM', 8)):
+            o = _order(event, code, count)
+            pids = [p.pk for p in user_split_positions(o)[1:]]
+            transfers = user_split(o, pids, {'email': 'new@example.org'})
+            new = transfers[0].target_order
+            assert new.positions.count() == count
+            assert len({p.secret for p in new.positions.all()} | {p.secret for p in o.positions.all()}) == count + 1
+    assert counts[2] == counts[1], counts
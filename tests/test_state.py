@@ -0,0 +1,55 @@
+import pytest
+from django.core.cache import cache, caches
+from django_scopes import scope
+from pretix.base.models import Order
+
+from pretix_ticket_transfer.state import cached_transfer_state, state_cache_key
+
+
+@pytest.fixture
+def locmem_cache(settings):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    caches._settings = None
+    caches._connections = type(caches._connections)()
+    yield
+    cache.clear()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_state_cached_and_invalidated(event, pending_transfer, client, locmem_cache):
+    event.live = True
+    event.save()
+    url = '/dummy/dummy/order/{}/{}/ticket_transfer/state'.format(pending_transfer.code, pending_transfer.secret)
+    r = client.get(url)
+    assert r.status_code == 200 and r.json() == {'state': 'pending_payment', 'order_status': 'n'}
+    etag = r['ETag']
+    assert client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 304
+    assert client.get(url.replace('/state', 'x/state')).status_code == 404
+
+    with scope(organizer=event.organizer):
+        o = Order.objects.get(pk=pending_transfer.pk)
+        o.status = Order.STATUS_PAID
+        o.save(update_fields=['status'])
+    r = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert r.status_code == 200 and r.json()['state'] == 'completing' and r['ETag'] != etag
+
+
+@pytest.mark.django_db(transaction=True)
+def test_state_of_customer_order_not_cached(event, pending_transfer, client, locmem_cache):
+    event.live = True
+    event.save()
+    organizer = event.organizer
+    organizer.settings.customer_accounts = True
+    organizer.settings.customer_accounts_require_login_for_order_access = True
+    with scope(organizer=organizer):
+        customer = organizer.customers.create(email='new@example.org', is_verified=True)
+        o = Order.objects.get(pk=pending_transfer.pk)
+        o.customer = customer
+        o.save(update_fields=['customer'])
+        o = Order.objects.select_related('event__organizer').get(pk=o.pk)
+        etag, body = cached_transfer_state(o)
+    assert cache.get(state_cache_key(event.pk, o.code, o.secret)) is None
+
+    # the secret alone gives no access to the state, not even after the customer has seen it
+    url = '/dummy/dummy/order/{}/{}/ticket_transfer/state'.format(o.code, o.secret)
+    assert client.get(url).status_code == 404
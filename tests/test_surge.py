@@ -0,0 +1,60 @@
+from decimal import Decimal
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django_scopes import scope
+
+from pretix_ticket_transfer import surge, tasks
+from pretix_ticket_transfer.config import invalidate_transfer_config
+from pretix_ticket_transfer.models import TicketTransferRequest
+
+
+def _state(pid, token):
+    return {
+        'token': token, 'pids': [pid], 'email': 'new@example.org', 'recipients': {},
+        'bank_info': {'iban': 'DE89370400440532013000', 'account_holder': 'A B'}, 'totalprice': Decimal('28.00'),
+    }
+
+
+@pytest.mark.django_db(transaction=True)
+def test_request_queued_at_limit_is_picked_up(event, order, monkeypatch):
+    event.settings.pretix_ticket_transfer_surge_mode = True
+    event.settings.pretix_ticket_transfer_surge_concurrency = 1
+    invalidate_transfer_config(event)
+    started = []
+    monkeypatch.setattr(tasks.process_transfer_requests, 'apply_async', lambda kwargs: started.append(kwargs))
+
+    with scope(organizer=event.organizer):
+        p1, p3 = order.positions.get(positionid=1), order.positions.get(positionid=3)
+        surge.queue_transfer_request(order, _state(p1.pk, 'first'))
+        running = surge.claim_request(event)
+        assert running.token == 'first'
+
+        # queued while the only slot is taken, a worker is started anyway
+        p3_state = dict(_state(p3.pk, 'second'), totalprice=Decimal('23.00'))
+        surge.queue_transfer_request(order, p3_state)
+        assert len(started) == 2
+        # and finds the limit reached
+        tasks.process_transfer_requests.apply(kwargs=started[1])
+        assert TicketTransferRequest.objects.get(token='second').state == TicketTransferRequest.STATE_QUEUED
+
+        # the next claim of the running worker gets it
+        surge.run_request(running)
+    tasks.process_transfer_requests.apply(kwargs=started[0])
+    with scope(organizer=event.organizer):
+        assert set(TicketTransferRequest.objects.values_list('state', flat=True)) == {TicketTransferRequest.STATE_DONE}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_claim_does_not_lock_event(event, order, monkeypatch):
+    event.settings.pretix_ticket_transfer_surge_mode = True
+    invalidate_transfer_config(event)
+    monkeypatch.setattr(tasks.process_transfer_requests, 'apply_async', lambda kwargs: None)
+
+    with scope(organizer=event.organizer):
+        surge.queue_transfer_request(order, _state(order.positions.get(positionid=1).pk, 'first'))
+        with CaptureQueriesContext(connection) as ctx:
+            assert surge.claim_request(event).token == 'first'
+    # every order and check-in of the event goes through that row
+    assert not [q for q in ctx.captured_queries if 'FROM "pretixbase_event"' in q['sql']]